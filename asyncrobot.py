@@ -0,0 +1,117 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Local files
+import bernielib as bl
+
+
+"""
+asyncio front-end for the robot.
+
+The smoothieboard (cartesian_port) and the load cells controller (loadcell_port) are
+independent devices. Each of them gets its own worker thread here, so a protocol can
+run operations on both at the same time with asyncio.gather(), e.g. zero the load cells
+while the robot travels to the sample:
+
+    async def probe(ar, sample):
+        await asyncio.gather(ar.moveToSample(sample), ar.tareAll())
+        return await ar.moveDownUntilPress(step=0.1, threshold=100, tare=False)
+
+Transactions on each port are serialized by the robot itself, so operations that use
+both controllers (like moveDownUntilPress) are safe to run alongside the others.
+
+Part of BernieLib.
+"""
+
+
+class asyncRobot():
+    """
+    Exposes high level robot operations as coroutines.
+    """
+
+    def __init__(self, robot=None, **robot_kwargs):
+        """
+        Inputs
+            robot
+                Existing robot object. If not provided, a new one is created with robot_kwargs.
+            robot_kwargs
+                Passed to bernielib.robot(), like cartesian_port_name and loadcell_port_name.
+        """
+        if robot is None:
+            robot = bl.robot(**robot_kwargs)
+        self.robot = robot
+        # One worker per controller; operations on the same controller run in order.
+        self.cartesian_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cartesian')
+        self.loadcell_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='loadcell')
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+
+    def close(self, close_robot=False):
+        """
+        Stops the workers. If close_robot is True, also closes the robot ports.
+        """
+        self.cartesian_executor.shutdown(wait=True)
+        self.loadcell_executor.shutdown(wait=True)
+        if close_robot:
+            self.robot.close()
+
+
+    async def _run(self, executor, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
+
+
+    async def runCartesian(self, method_name, *args, **kwargs):
+        """
+        Runs any robot method by name on the motion controller worker.
+        """
+        return await self._run(self.cartesian_executor, getattr(self.robot, method_name), *args, **kwargs)
+
+
+    async def runLoadCell(self, method_name, *args, **kwargs):
+        """
+        Runs any robot method by name on the load cells controller worker.
+        """
+        return await self._run(self.loadcell_executor, getattr(self.robot, method_name), *args, **kwargs)
+
+
+    # Motion operations
+
+    async def move(self, *args, **kwargs):
+        return await self.runCartesian('move', *args, **kwargs)
+
+    async def moveTo(self, *args, **kwargs):
+        return await self.runCartesian('moveTo', *args, **kwargs)
+
+    async def moveToSample(self, sample, z=None, z_hop=10):
+        return await self.runCartesian('moveToSample', sample, z=z, z_hop=z_hop)
+
+    async def uptakeLiquid(self, sample, volume, **kwargs):
+        return await self.runCartesian('uptakeLiquid', sample, volume, **kwargs)
+
+    async def dispenseLiquid(self, sample, volume, **kwargs):
+        return await self.runCartesian('dispenseLiquid', sample, volume, **kwargs)
+
+    async def moveDownUntilPress(self, step, threshold, z_max=180, tare=True, continuous=False):
+        return await self.runCartesian('moveDownUntilPress', step, threshold, z_max=z_max, tare=tare,
+                                       continuous=continuous)
+
+    async def getPosition(self, axis=None):
+        return await self.runCartesian('getPosition', axis=axis)
+
+
+    # Load cells operations
+
+    async def tareAll(self):
+        return await self.runLoadCell('tareAll')
+
+    async def getCombinedLoad(self):
+        return await self.runLoadCell('getCombinedLoad')
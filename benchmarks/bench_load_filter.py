@@ -0,0 +1,82 @@
+"""
+False triggers of a load probe against the approach speed, with and without filtering.
+
+Emulated traces: the pipette approaches a surface at constant speed while the load cells
+are read at the HX711 fast rate. The readings carry the HX711 noise, the vibration of the
+moving robot (growing with the speed) and occasional spikes. A probe triggering before
+the true load reaches the threshold is counted as false; for the correct ones, the extra
+travel past the threshold point is measured.
+
+Run from the repository root:
+    python benchmarks/bench_load_filter.py
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from loadfilter import loadFilter
+
+
+SAMPLE_RATE = 80            # readings per second
+THRESHOLD = 100             # approx. grams
+STIFFNESS = 2000            # load per mm of pressing
+APPROACH = 3                # mm travelled before the contact
+PRESS = 0.5                 # mm travelled after the contact
+NOISE = 8                   # HX711 noise, standard deviation
+VIBRATION_PER_SPEED = 12    # vibration amplitude per mm/s of speed
+VIBRATION_FREQUENCY = 23    # Hz
+SPIKE_PROBABILITY = 0.01
+SPIKE_LOAD = 250
+TRIALS = 300
+
+SPEEDS = [0.5, 1, 2, 4, 8]  # mm/s
+PROFILES = {
+    'raw': {},
+    'median 3': {'median': 3},
+    'median 5 + ema 0.5': {'median': 5, 'ema_alpha': 0.5},
+    'median 5 + ema + rate': {'median': 5, 'ema_alpha': 0.5, 'rate_threshold': 4000},
+}
+
+
+def emulatedTrace(speed, rng):
+    """
+    Returns (times, loads, time at which the true load reaches the threshold).
+    """
+    duration = (APPROACH + PRESS) / speed
+    times = np.arange(0, duration, 1.0 / SAMPLE_RATE)
+    depth = np.maximum(0, times * speed - APPROACH)
+    phase = rng.uniform(0, 2 * np.pi)
+    vibration = VIBRATION_PER_SPEED * speed * np.sin(2 * np.pi * VIBRATION_FREQUENCY * times + phase)
+    spikes = (rng.random(len(times)) < SPIKE_PROBABILITY) * SPIKE_LOAD
+    loads = STIFFNESS * depth + rng.normal(0, NOISE, len(times)) + vibration + spikes
+    threshold_time = (APPROACH + THRESHOLD / STIFFNESS) / speed
+    return times, loads, threshold_time
+
+
+def run(speed, profile, rng):
+    false_triggers = 0
+    overshoots = []
+    for trial in range(TRIALS):
+        times, loads, threshold_time = emulatedTrace(speed, rng)
+        index = loadFilter.fromProfile(profile).feed(times, loads, THRESHOLD)
+        if index is None:
+            continue
+        if times[index] < threshold_time - 1.0 / SAMPLE_RATE:
+            false_triggers += 1
+        else:
+            overshoots.append((times[index] - threshold_time) * speed)
+    mean_overshoot = np.mean(overshoots) if overshoots else float('nan')
+    return false_triggers / TRIALS, mean_overshoot
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(1)
+    print("%-8s %-20s %14s %14s" % ('mm/s', 'filter', 'false trigger', 'overshoot mm'))
+    for speed in SPEEDS:
+        for name, profile in PROFILES.items():
+            false_rate, overshoot = run(speed, profile, rng)
+            print("%-8s %-20s %13.1f%% %14.3f" % (speed, name, false_rate * 100, overshoot))
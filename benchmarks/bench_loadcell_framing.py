@@ -0,0 +1,109 @@
+"""
+Latency of the load cells controller commands with and without the new line framing.
+
+A fake Arduino runs on the master side of a pseudo terminal, framing the commands
+like bernie.ino does: with Serial.setTimeout(20), the older firmware (readBytes) takes
+a command only after 20 ms without new characters; the newer one (readBytesUntil)
+takes it as soon as the new line arrives. The robot talks to the slave side as to
+a real serial port. HX711 conversion time is not emulated, so only the framing
+delay is measured.
+
+Linux/macOS only. Run from the repository root:
+    python benchmarks/bench_loadcell_framing.py
+"""
+
+import os
+import sys
+import time
+import select
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tty
+import emulator
+import bernielib as bl
+
+
+SERIAL_TIMEOUT = 0.02   # Serial.setTimeout(20) in bernie.ino
+
+
+class fakeArduino(threading.Thread):
+    def __init__(self, fd, newline_framing):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.newline_framing = newline_framing
+        self.running = True
+
+    def reply(self, command):
+        command = command.decode().strip()
+        if command == 'version':
+            if self.newline_framing:
+                return "Bernie's load cells controller, protocol 2\r\n"
+            return "Bernie's load cells controller\r\n"
+        if command in ('RR', 'RL'):
+            return '0.00\r\n'
+        if command == 'T':
+            return 'ok/n\r\n'
+        return ''
+
+    def run(self):
+        buffer = b''
+        while self.running:
+            readable, _, _ = select.select([self.fd], [], [], SERIAL_TIMEOUT)
+            if readable:
+                buffer += os.read(self.fd, 1024)
+                if not (self.newline_framing and b'\n' in buffer):
+                    # Waiting for more characters until the serial timeout
+                    continue
+            if not buffer:
+                continue
+            if self.newline_framing and b'\n' in buffer:
+                command, buffer = buffer.split(b'\n', 1)
+            else:
+                command, buffer = buffer, b''
+            message = self.reply(command)
+            if message:
+                os.write(self.fd, message.encode())
+
+
+def measure(newline_framing, host_eol, count):
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    arduino = fakeArduino(master, newline_framing)
+    arduino.start()
+    vr = emulator.virtualRobot(time_scale=0)
+    cartesian_port_name, _ = vr.register(prefix='bench_framing')
+    ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=os.ttyname(slave))
+    try:
+        if host_eol is None:
+            # Version handshake decides
+            ber._getLoadCellEol()
+        else:
+            ber.loadcell_eol = host_eol
+        before = time.perf_counter()
+        for i in range(count):
+            ber.readRightLoad()
+        elapsed = time.perf_counter() - before
+        eol = ber.loadcell_eol
+    finally:
+        ber.close()
+        vr.unregister()
+        arduino.running = False
+        arduino.join()
+        os.close(master)
+        os.close(slave)
+    return elapsed / count, eol
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    count = 100
+    print("%-16s %-12s %12s" % ('firmware', 'host eol', 'ms/command'))
+    for firmware, newline_framing, host_eol in [('readBytes', False, None),
+                                                ('readBytesUntil', True, ''),
+                                                ('readBytesUntil', True, None)]:
+        latency, eol = measure(newline_framing, host_eol, count)
+        print("%-16s %-12s %12.2f" % (firmware, repr(eol), latency * 1000))
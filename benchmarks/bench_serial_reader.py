@@ -0,0 +1,120 @@
+"""
+Micro-benchmark of the serial reply reading.
+
+Compares the old byte-at-a-time reader (with re.search over the whole message and
+re.split based status parsing) with the buffered reader from serialcomm.py.
+No hardware needed; replies are served by a fake port.
+
+Run from the repository root:
+    python benchmarks/bench_serial_reader.py
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from serialcomm import readAvailable
+from serialcomm import matchBuffer
+from serialcomm import parseStatusReply
+
+
+OK_REPLY = b'ok\n'
+STATUS_REPLY = b'ok\n<Idle|MPos:12.3400,56.7800,90.1200,3.4500|WPos:12.3400,56.7800,90.1200|F:3000.0,100.0>\n'
+# USB full speed serial adapters deliver data in packets of this size
+PACKET_SIZE = 64
+
+
+class fakePort():
+    """
+    Serves the prepared reply once per written request. At most one USB packet becomes
+    available per poll, like a real port that is being read faster than the data arrives.
+    """
+    def __init__(self, reply):
+        self.reply = reply
+        self.data = b''
+        self.available = 0
+        self.position = 0
+
+    def write(self, expression):
+        self.data = self.reply
+        self.available = 0
+        self.position = 0
+
+    def _arrive(self):
+        if self.available == 0:
+            self.available = min(PACKET_SIZE, len(self.data) - self.position)
+
+    @property
+    def in_waiting(self):
+        self._arrive()
+        return self.available
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        self._arrive()
+        size = min(size, self.available)
+        chunk = self.data[self.position:self.position+size]
+        self.position += size
+        self.available -= size
+        return chunk
+
+
+def legacyReadUntilMatch(port, pattern):
+    message = ''
+    while True:
+        chunk = ''
+        while port.inWaiting():
+            chunk += port.read(1).decode("utf-8")
+        message += chunk
+        if re.search(pattern=pattern, string=message):
+            return message
+
+
+def legacyParseStatus(msg):
+    msg = re.split(pattern='\\|', string=msg)[1]
+    msg = re.split(pattern='\\:', string=msg)[-1]
+    x = float(re.split(pattern=',', string=msg)[0])
+    y = float(re.split(pattern=',', string=msg)[1])
+    z = float(re.split(pattern=',', string=msg)[2])
+    a = float(re.split(pattern=',', string=msg)[3])
+    return x, y, z, a
+
+
+def bufferedReadUntilMatch(port, pattern):
+    reply = matchBuffer(pattern)
+    while True:
+        if reply.feed(readAvailable(port).decode("utf-8")):
+            return reply.message
+
+
+def run(reader, parser, reply, count, pattern):
+    port = fakePort(reply)
+    before = time.perf_counter()
+    for i in range(count):
+        port.write(b'?\r')
+        msg = reader(port, pattern)
+        if parser is not None:
+            parser(msg)
+    elapsed = time.perf_counter() - before
+    return len(reply) * count / elapsed, count / elapsed
+
+
+if __name__ == '__main__':
+    count = 20000
+    cases = [
+        ('ok', OK_REPLY, None, None),
+        ('status', STATUS_REPLY, legacyParseStatus, parseStatusReply),
+    ]
+    print("%-8s %-10s %14s %14s" % ('reply', 'reader', 'bytes/s', 'replies/s'))
+    for name, reply, legacy_parser, parser in cases:
+        # Pattern is the end of the reply
+        pattern = '>\n' if parser is not None else 'ok\n'
+        for reader_name, reader, parse in [('legacy', legacyReadUntilMatch, legacy_parser),
+                                           ('buffered', bufferedReadUntilMatch, parser)]:
+            bytes_rate, replies_rate = run(reader, parse, reply, count, pattern)
+            print("%-8s %-10s %14.0f %14.0f" % (name, reader_name, bytes_rate, replies_rate))
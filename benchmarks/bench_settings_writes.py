@@ -0,0 +1,59 @@
+"""
+Settings file writes during one purification on the emulated robot (see
+profile_emulated_purify.py), with every setting change written at once (SAVE_INTERVAL 0,
+as before the write-back) and with the write-back.
+
+Run from the repository root:
+    python benchmarks/bench_settings_writes.py
+    python benchmarks/bench_settings_writes.py --time-scale 0.01
+"""
+
+import os
+import sys
+import logging
+import argparse
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import general
+import profile_emulated_purify
+
+
+def countWrites(samplesheet, time_scale, save_interval):
+    """
+    Returns (wall time, {settings file: writes}) of one purification.
+    """
+    # Shared settings objects belong to the previous working directory
+    general.data.evict()
+    samplesheet_path = profile_emulated_purify.prepareWorkingDir(samplesheet)
+    writes = collections.Counter()
+    save = general.data.save
+    def countingSave(obj):
+        writes[obj.name] += 1
+        save(obj)
+    general.data.save = countingSave
+    general.SAVE_INTERVAL = save_interval
+    try:
+        elapsed, skipped, vr = profile_emulated_purify.run(samplesheet_path, time_scale, False)
+        general.checkpoint()
+    finally:
+        general.data.save = save
+    return elapsed, writes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samplesheet', default=os.path.join(profile_emulated_purify.REPO_PATH, 
+                                                              'factory_default', 'samplesheet.csv'))
+    parser.add_argument('--time-scale', type=float, default=0)
+    args = parser.parse_args()
+    
+    logging.disable(logging.WARNING)
+    samplesheet = os.path.abspath(args.samplesheet)
+    default_interval = general.SAVE_INTERVAL
+    for name, interval in [('every change', 0), ('write-back %s s' % default_interval, default_interval)]:
+        elapsed, writes = countWrites(samplesheet, args.time_scale, interval)
+        print("%-20s %6s writes, %.1f s" % (name, sum(writes.values()), elapsed))
+        for settings_name, count in writes.most_common(5):
+            print("    %-24s %6s" % (settings_name, count))
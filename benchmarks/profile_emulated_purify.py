@@ -0,0 +1,132 @@
+"""
+Runs the purification protocol end to end on the emulated robot (emulator.py),
+and reports the wall time, the number of commands sent to each controller and,
+optionally, the cProfile statistics.
+
+Moves, load cell readings and the waits of the protocol (incubation, drying, pipetting
+delays) all take their time multiplied by --time-scale; the skipped time is reported.
+
+Run from the repository root:
+    python benchmarks/profile_emulated_purify.py
+    python benchmarks/profile_emulated_purify.py --time-scale 1 --profile
+    python benchmarks/profile_emulated_purify.py --time-scale 0.1 --trace trace.json
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import cProfile
+import pstats
+import tempfile
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_PATH)
+
+import emulator
+import bernielib as bl
+
+
+class virtualClock():
+    """
+    Replaces the time module of the protocol and the robot: waits are shortened by
+    time_scale and the clock jumps over the skipped part. Short polling sleeps are kept.
+    """
+    def __init__(self, time_scale):
+        self.time_scale = time_scale
+        self.skipped = 0
+
+    def time(self):
+        return time.time() + self.skipped
+
+    def sleep(self, seconds):
+        if seconds <= bl.POLL_INTERVAL:
+            time.sleep(seconds)
+            return
+        time.sleep(seconds * self.time_scale)
+        self.skipped += seconds * (1 - self.time_scale)
+
+
+def prepareWorkingDir(samplesheet_path):
+    """
+    Robot settings are read and written relative to the working directory; a temporary
+    one keeps the repository clean. Returns the path of the samplesheet copy.
+    """
+    working_dir = tempfile.mkdtemp(prefix='bernie_emulated_')
+    factory_default_path = os.path.join(working_dir, 'factory_default')
+    shutil.copytree(os.path.join(REPO_PATH, 'factory_default'), factory_default_path)
+    # Samplesheets name tube types like "5mL", and the robot runs on case insensitive
+    # Windows file system, where this finds "5ml.json".
+    for name in os.listdir(factory_default_path):
+        if name.endswith('ml.json'):
+            shutil.copy(os.path.join(factory_default_path, name),
+                        os.path.join(factory_default_path, name.replace('ml.json', 'mL.json')))
+    for name in os.listdir(REPO_PATH):
+        if name.startswith('mixing_pattern_') and name.endswith('.csv'):
+            shutil.copy(os.path.join(REPO_PATH, name), working_dir)
+    # Samplesheets are saved by Excel on Windows; re-encoding to the local default.
+    with open(samplesheet_path, encoding='cp1252') as f:
+        samplesheet = f.read()
+    samplesheet_copy = os.path.join(working_dir, 'samplesheet.csv')
+    with open(samplesheet_copy, 'w') as f:
+        f.write(samplesheet)
+    os.chdir(working_dir)
+    return samplesheet_copy
+
+
+def run(samplesheet_path, time_scale, background_reading, trace_path=None):
+    # Imported only here, as it starts a log file in the current working directory
+    import purify
+    s = purify.settings(samplesheet_path)
+    vr = emulator.virtualRobot(time_scale=time_scale)
+    cartesian_port_name, loadcell_port_name = vr.register()
+    clock = virtualClock(time_scale)
+    purify.time = clock
+    bl.time = clock
+    ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name,
+                   tips_type=s.tip_rack_type, background_reading=background_reading)
+    before = time.time()
+    try:
+        ber.home()
+        p = purify.protocol(ber, s)
+        p.purify(trace_path=trace_path)
+        ber.powerStepperOff()
+    finally:
+        elapsed = time.time() - before
+        ber.close()
+        vr.unregister()
+        purify.time = time
+        bl.time = time
+    return elapsed, clock.skipped, vr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samplesheet', default=os.path.join(REPO_PATH, 'factory_default', 'samplesheet.csv'))
+    parser.add_argument('--time-scale', type=float, default=0,
+                        help='1 for real time moves and load cell readings, 0 for instant ones')
+    parser.add_argument('--background-reading', action='store_true')
+    parser.add_argument('--profile', action='store_true', help='print cProfile statistics')
+    parser.add_argument('--trace', help='save the timing of every command to this .json or .csv file')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    trace_path = os.path.abspath(args.trace) if args.trace else None
+    samplesheet_path = prepareWorkingDir(os.path.abspath(args.samplesheet))
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    elapsed, skipped, vr = run(samplesheet_path, args.time_scale, args.background_reading, trace_path)
+    if profiler is not None:
+        profiler.disable()
+
+    print("Wall time: %.1f s (waits skipped: %.0f s)" % (elapsed, skipped))
+    for controller, counts in vr.commandCounts().items():
+        print("%s: %s commands" % (controller, sum(counts.values())))
+        for opcode, count in counts.most_common():
+            print("    %-8s %8s" % (opcode, count))
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
@@ -2,7 +2,10 @@ import serial
 import time
 import re
 import logging
+import os
 import threading
+import contextlib
+import math
 
 # libraries for curve fitting. Used for pipette calibration and for beads volumes.
 import pandas as pd
@@ -16,13 +19,29 @@ from samples import createSamplesToPurifyList
 from samples import createPurifiedSamplesList
 from general import data
 from general import listSerialPorts
+from general import listSerialPortsInfo
+from general import checkpoint
+from general import preloadFactoryDefaults
+from serialcomm import readAvailable
+from serialcomm import parseStatusReply
+from serialcomm import matchBuffer
+from serialcomm import portListener
+from serialcomm import logUnsolicited
+from serialcomm import lineBuffer
+from serialcomm import AXIS_WORD_RE
+from serialcomm import openPort
+from tracer import commandTracer
+from loadcellstream import loadRingBuffer
+from loadcellstream import LOAD_BUFFER_SIZE
+from forcecurve import forceCurve
+from loadfilter import loadFilter
+from loadfilter import FILTER_DEFAULTS
 
 
 # TODO: Figure out how to make smoothieware send a signal for physically finishing the job
 # TODO: Create settings for which COM port associates with which part of electronics
 # (which one is for smoothieboard, which one is for the load cells)
 # TODO: Tip end correction
-# TODO: z_safe to settings.
 # TODO: Create function that would pick  up a  tip if it is not yet picked.
 # TODO: Deciding dump tip fate in this library (introduce settings for that as well).
 
@@ -40,11 +59,71 @@ Sergii Pochekailov
 BAUDRATE = 115200
 TIMEOUT = 5   # seconds
 END_OF_LINE = "\r"
+# How long to wait between the reads of the port, when there is no background listener
+# and nothing arrived yet.
+POLL_INTERVAL = 0.001   # seconds
+
+# Streaming of G-code to the smoothieboard
+STREAMING_WINDOW = 8            # Default number of commands sent without waiting for "ok"
+STREAMING_ACK_TIMEOUT = 60      # seconds; "ok" is delayed while the planner queue is full
+STREAMING_SYNC_TIMEOUT = 120    # seconds; M400 at the sync barrier waits for all queued moves
+# Commands that are never streamed; sent only after all the streamed ones are acknowledged.
+STREAMING_PASSTHROUGH = ('?',)
+
+# Positions reported by the controller and the remembered ones may differ that much, mm
+POSITION_TOLERANCE = 0.01
+# Time to wait for the reply to RB, to find out whether the firmware supports it, when its
+# version does not tell; RB is given up after that many requests without the reply.
+LOADCELL_COMBINED_READ_CHECK_TIMEOUT = 0.5    # seconds
+LOADCELL_COMBINED_READ_CHECKS = 3
+# Time to wait for the reply to "S on"; older firmware ignores the command
+LOADCELL_STREAM_CHECK_TIMEOUT = 0.5     # seconds
+# Time to wait for the next streamed reading
+LOADCELL_STREAM_READING_TIMEOUT = 1     # seconds
+
+# Port search: time for a controller to reply to "version". Arduino restarts when its port
+# is opened, and prints the welcome message about 2 seconds later.
+PORT_PROBE_TIMEOUT = 3          # seconds
+PORT_PROBE_EXTRA_TIME = 1       # seconds; for opening and closing the ports
+# End of the smoothieboard reply to the '?' status request
+STATUS_REPLY_END = '>\r?\n'
+# Smoothieboard stops the motion at once and drops all the queued moves on ctrl-X;
+# it then replies with an alarm, and does not move until unlocked with $X.
+HALT_CHARACTER = '\x18'
+HALT_REPLY_END = 'ALARM[^\n]*\n'
+HALT_TIMEOUT = 1    # seconds
+# Continuous probing: extra time to wait for the load threshold, above the move duration
+PROBE_EXTRA_TIME = 2    # seconds
+# Probing near the expected contact: the approach starts that much above the expected Z,
+# and contact is expected no further than that much below it.
+PROBE_MARGIN = 1.5      # mm
+# Step of the approach inside the expected window; the last one is then bisected.
+PROBE_COARSE_STEP = 0.5     # mm
+# Refined probe: the extra reading past the threshold, for the fit, is taken no further than 
+# that share of the step, and where the load is expected to reach that many thresholds.
+REFINE_EXTRA_STEP_SHARE = 0.5
+REFINE_FORCE_CEILING = 1.5
+# Continuous stair finding: the pipette slides along the surface at most that far, 
+# and the edge is passed when the load drops to that share of the load on the surface.
+STAIR_SWEEP_DISTANCE = 15    # mm
+STAIR_RELEASE_SHARE = 0.3
+# Load the pipette slides with; pressed with the full probe threshold, it would drag on the surface.
+STAIR_SLIDE_PRELOAD = 100    # approx. grams
+# Tip search: the pipette nose is tapered, so the further it lands off the tip, the higher it 
+# presses on the rim. Offset from the tip per mm of the contact above the proper pickup height.
+TIP_SEARCH_OFFSET_PER_DZ = 0.5     # mm per mm
+# Tip search: the sign the left/right imbalance is taken with, when nothing is learned yet
+TIP_SEARCH_DEFAULT_LOAD_SIGN = 1
 
 # Welcome messages
 LOADCELL_WELCOME = "Bernie's load cells controller"
 LOADCELL_WELCOME_ALT1 = "Arnie's mobile gripper tool"
 SMOOTHIE_STATUS_REPLY = "Build version: "
+# Load cells controller firmware reports its command protocol version, like
+# "Bernie's load cells controller, protocol 2"; older firmware does not.
+LOADCELL_PROTOCOL_RE = re.compile(r'protocol (\d+)')
+# End of the reply to "version"; the welcome message lines printed after restart are skipped.
+LOADCELL_VERSION_REPLY_END = r'(controller|protocol \d+)\r\n'
 
 expected_response_dict = {
     'loadcell': LOADCELL_WELCOME,
@@ -57,12 +136,65 @@ class robot(data):
     Handles all robot operations
     """
     
-    def __init__ (self, cartesian_port_name=None, loadcell_port_name=None, tips_type='old'):
-        
+    def __init__ (self, cartesian_port_name=None, loadcell_port_name=None, tips_type='old',
+                  background_reading=False):
+        """
+        Inputs
+            cartesian_port_name, loadcell_port_name
+                Serial ports of the smoothieboard and the load cells controller.
+                If any of them is not provided, the ports are found automatically.
+            tips_type
+                'old' or 'new' tips rack.
+            background_reading
+                If True, each port is read by a separate thread, which collects the replies
+                into a queue. Messages arriving between the commands are logged instead of
+                being discarded.
+        """
         
         super().__init__(name='robot')
+        # Robot settings read without the robot object, like getBeadsVolumeCoef(), come from here
+        self.share(data)
         
         self.recent_message = ''
+        # Background readers of the ports; {port: portListener}
+        self.listeners = {}
+        # Locks making a command and its reply one transaction per port; {port: RLock}
+        self.port_locks = {}
+        self._port_locks_lock = threading.Lock()
+        # Whether the load cells controller replies to RB with both readings; None if not known yet
+        self.loadcell_combined_read = None
+        self._combined_read_checks = 0
+        # End of line for the load cells controller commands; None until its version is known
+        self.loadcell_eol = None
+        self.loadcell_sample_counter = None
+        # Readings streamed by the load cells controller; None when not streaming.
+        # See startLoadCellStreaming()
+        self.load_stream = None
+        # Tare started by startTare() and not yet used by a probe
+        self._tare_thread = None
+        # Records timing of every command when set; see startTracing()
+        self.tracer = None
+        # Load readings of the last refined probe, and the folder to save all of them into;
+        # see recordForceCurves()
+        self.last_force_curve = None
+        self.force_curve_dir = None
+        self._force_curve_number = 0
+        # G-code streaming state. 0 window means every command waits for its "ok".
+        self.streaming_window = 0
+        self.commands_in_flight = 0
+        self._cartesian_unsynced = False
+        self._steppers_to_power_off = []
+        self._cartesian_lines = lineBuffer()
+        self._cartesian_pending_lines = []
+        # Streamed commands waiting for their "ok": [(expression, send time, bytes sent)]
+        self._streamed_commands = []
+        # Position of the robot as commanded by the issued moves. None if not known
+        # (at the start and after homing); it is then read from the controller.
+        self.position = {'X': None, 'Y': None, 'Z': None, 'A': None}
+        # Every that many moves the remembered position is checked with the controller.
+        # None to never check.
+        self.position_verify_interval = None
+        self._moves_since_verify = 0
         
         # Initializing racks for the robot
         self.samples_rack = rack('samples')
@@ -84,28 +216,51 @@ class robot(data):
             pass
             
         if (cartesian_port_name is None) or (loadcell_port_name is None):
-            robot_port_map = self._mapPortsWithRetries()
+            # Trying the ports found last time first; they only need a quick check.
+            robot_port_map = self._getCachedPortMap()
+            if robot_port_map is not None:
+                try:
+                    self._openPorts(robot_port_map)
+                except (OSError, serial.SerialException) as e:
+                    # Like a port kept busy by another program, or a device gone since the listing
+                    logging.info("Could not open the saved robot ports (%s); searching for them.", e)
+                    self.close()
+                    self.forgetPortMap()
+                    robot_port_map = None
+            if robot_port_map is not None:
+                if not self._portsIdentityConfirmed():
+                    logging.info("Robot ports changed since the last time; searching for them.")
+                    self.close()
+                    robot_port_map = None
+            if robot_port_map is None:
+                robot_port_map = self._mapPortsWithRetries()
+                self._openPorts(robot_port_map)
+                # Waiting for ports to open
+                time.sleep(1)
+                self._savePortMap(robot_port_map)
         else:
             robot_port_map = {
                 'loadcell': loadcell_port_name,
                 'cartesian': cartesian_port_name,
             }
-        
-        self.cartesian_port = serial.Serial(robot_port_map['cartesian'], BAUDRATE, timeout=TIMEOUT)
-        self.loadcell_port = serial.Serial(robot_port_map['loadcell'], BAUDRATE, timeout=TIMEOUT)
-        
-        # Waiting for ports to open
-        time.sleep(1)
+            self._openPorts(robot_port_map)
+            # Waiting for ports to open
+            time.sleep(1)
         
         self.cartesian_port.flushInput()
         self.loadcell_port.flushInput()
         
+        if background_reading:
+            self.startListeners()
+        
         # Starting with tip not attached
         self.tip_attached = 0 # 0 - not attached, 1 - attached
         # Tuple that let robot remember where did it picked up its last tip
         self.last_tip_coord = None
         # Pressure sensors zeroed near tips
         self.load_cells_zeroed_near_tips = False
+        # (x, y, left load, right load, dz) of the last tip pickup that hit the rim; see lookForTip
+        self.last_tip_miss = None
         # Whether to calculate wall touch Z relative to the liquid level
         self.touch_above_liquid = False
         # Low liquid volume offset - general robot setting (init is in the function already.
@@ -113,6 +268,9 @@ class robot(data):
         
     
     def close(self):
+        checkpoint()
+        self.stopListeners()
+        self.load_stream = None
         try:
             self.cartesian_port.close()
         except:
@@ -123,51 +281,176 @@ class robot(data):
             pass
     
     
-    def _getRobotIdMessage(self, port_name, port_dict):
+    def startListeners(self):
+        """
+        Starts background threads reading the cartesian and the load cell ports.
+        """
+        for port, port_name in [(self.cartesian_port, 'cartesian'), (self.loadcell_port, 'loadcell')]:
+            if port in self.listeners:
+                continue
+            listener = portListener(port, name=port_name)
+            listener.start()
+            self.listeners[port] = listener
+    
+    
+    def stopListeners(self):
+        """
+        Stops background port readers; the ports are read directly after that.
+        """
+        try:
+            listeners = self.listeners
+        except AttributeError:
+            return
+        for listener in listeners.values():
+            listener.stop()
+        self.listeners = {}
+    
+    
+    def _getRobotIdMessage(self, port_name, port_dict, timeout=PORT_PROBE_TIMEOUT):
         """Obtain messages that help identify the robot"""
         # Temporary opeining the port
-        port = serial.Serial(port_name, 115200, timeout=5)
-        
-        port.reset_output_buffer()
-        port.reset_input_buffer()
-        port.flushInput()
-    
-        message = self._writeAndWait(port=port, expression='version', eol='\n', confirm_message='\r\n')
-        
-        port.close()
+        try:
+            port = openPort(port_name, BAUDRATE, timeout=timeout)
+        except (OSError, serial.SerialException):
+            # Port is busy or not available
+            return port_dict
+        try:
+            port.reset_output_buffer()
+            port.reset_input_buffer()
+            message = self._writeAndWait(port=port, expression='version', eol='\n', 
+                                         confirm_message='\r\n', timeout=timeout)
+        except (OSError, serial.SerialException, UnicodeDecodeError):
+            # Not a robot controller
+            message = None
+        finally:
+            port.close()
         
         port_dict[port_name] = message
         return port_dict
-
-    def _portCheck(self, port_name, ports_list):
-        try:
-            port = serial.Serial(port_name, 115200, timeout=5)
-            port.close()
-            ports_list.append(port_name)
-        except (OSError, serial.SerialException):
-            pass       
-        
-    def _mapPorts(self):
-        # Listing ports
-        ports_list = [] # Ports that opens
-        ports = ['COM%s' % (i + 1) for i in range(256)] # All possible port names
-        for port_name in ports:
-            x = threading.Thread(target=self._portCheck, args=(port_name, ports_list,))
-            x.start()
-            x.join()        
+    
+    
+    def _mapPorts(self, timeout=PORT_PROBE_TIMEOUT):
+        """
+        Finds the cartesian and the load cell ports by asking every USB serial device 
+        for its version. All the ports are asked at the same time, so the search takes
+        no longer than the timeout.
+        """
+        # Listing ports; robot controllers are USB devices.
+        ports_list = [port.device for port in listSerialPortsInfo(usb_only=True)]
+        if not ports_list:
+            ports_list = [port.device for port in listSerialPortsInfo()]
         
         # Obtaining port id message from each port
         port_id_msg_dict = {}
+        threads = []
         for port_name in ports_list:
-            x = threading.Thread(target=self._getRobotIdMessage, args=(port_name, port_id_msg_dict,))
+            x = threading.Thread(target=self._getRobotIdMessage, 
+                                 args=(port_name, port_id_msg_dict, timeout), daemon=True)
             x.start()
-            x.join()
+            threads.append(x)
+        # Not waiting for the ports that hang on opening or closing
+        deadline = time.time() + timeout + PORT_PROBE_EXTRA_TIME
+        for x in threads:
+            x.join(max(deadline - time.time(), 0))
         
         # Creating a dictionary consisting of the robot device and port name
-        robot_ports_dict = self.portRecognizer(port_id_msg_dict, expected_response_dict)
+        robot_ports_dict = self.portRecognizer(dict(port_id_msg_dict), expected_response_dict)
         return robot_ports_dict
         
     
+    def _openPorts(self, robot_port_map):
+        self.cartesian_port = openPort(robot_port_map['cartesian'], BAUDRATE, timeout=TIMEOUT)
+        self.loadcell_port = openPort(robot_port_map['loadcell'], BAUDRATE, timeout=TIMEOUT)
+    
+    
+    def _portsIdentityConfirmed(self):
+        """
+        Checks that the opened ports are the cartesian and the load cell controllers.
+        Both are asked for their version at the same time.
+        """
+        messages = {}
+        def ask(role, port):
+            try:
+                messages[role] = self._writeAndWait(port=port, expression='version', eol='\n', 
+                                                    confirm_message='\r\n', timeout=PORT_PROBE_TIMEOUT)
+            except (OSError, serial.SerialException, UnicodeDecodeError):
+                messages[role] = None
+        threads = [threading.Thread(target=ask, args=('cartesian', self.cartesian_port)),
+                   threading.Thread(target=ask, args=('loadcell', self.loadcell_port))]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+        if self.portRecognizer(messages, expected_response_dict) != {
+                    'cartesian': 'cartesian', 'loadcell': 'loadcell'}:
+            return False
+        self._setLoadCellProtocol(messages['loadcell'])
+        return True
+    
+    
+    def _getCachedPortMap(self):
+        """
+        Returns the port map saved at the last successful port search, with the port 
+        names updated from the current USB device list. The devices are recognized by their
+        USB serial number and VID/PID, as the port names may change between connections.
+        Returns None if there is no saved map, or some device is not connected.
+        """
+        if not self._settingPresent('port_map'):
+            return
+        saved_map = self.data['port_map']
+        ports_info = listSerialPortsInfo()
+        robot_port_map = {}
+        for role in ['cartesian', 'loadcell']:
+            try:
+                identity = saved_map[role]
+            except (KeyError, TypeError):
+                return
+            for port_info in ports_info:
+                if (port_info.vid, port_info.pid) != (identity['vid'], identity['pid']):
+                    continue
+                if identity['serial_number']:
+                    found = port_info.serial_number == identity['serial_number']
+                else:
+                    # Some Arduino clones have no serial number
+                    found = port_info.device == identity['device']
+                if found:
+                    robot_port_map[role] = port_info.device
+                    break
+            else:
+                return
+        return robot_port_map
+    
+    
+    def _savePortMap(self, robot_port_map):
+        """
+        Remembers USB identity of the found ports, for a quick start next time.
+        """
+        ports_info = {port_info.device: port_info for port_info in listSerialPortsInfo()}
+        saved_map = {}
+        for role, port_name in robot_port_map.items():
+            port_info = ports_info.get(port_name)
+            if port_info is None or port_info.vid is None:
+                # Not a USB device; can't be recognized later
+                return
+            saved_map[role] = {
+                'device': port_name,
+                'serial_number': port_info.serial_number,
+                'vid': port_info.vid,
+                'pid': port_info.pid,
+            }
+        self._setSetting('port_map', saved_map)
+    
+    
+    def forgetPortMap(self):
+        """
+        Removes the saved ports; they will be searched for at the next start.
+        """
+        with self.settings_lock:
+            if self._settingPresent('port_map'):
+                del self.data['port_map']
+                self.save()
+    
+    
     def _mapPortsWithRetries(self, retry_number=5):
         for i in range(retry_number):
             ports_dict = self._mapPorts()
@@ -203,19 +486,8 @@ class robot(data):
     
     
     def _readAll(self, port, delay=1):
-        #time.sleep(delay)
-        something_read = False
-        message = ''
-        #time_passed = 0
-        #before_timestamp = time.time()
-        #current_timestamp = time.time()
-        while port.inWaiting():
-            message += port.read(1).decode("utf-8")
-            something_read = True
-            #current_timestamp = time.time()
-            #time_passed = current_timestamp - before_timestamp
-            #print("reading... Obtained message: %s" % message)
-        
+        # Reading everything that is waiting in the port at once, instead of byte by byte.
+        message = readAvailable(port).decode("utf-8")
         if message:
             # Logging only if the message has something.
             logging.debug("Message received from the robot: %s", message)
@@ -223,31 +495,49 @@ class robot(data):
     
     
     def _readUntilMatch(self, port, pattern, timeout=5):
-        message = ''
+        reply = matchBuffer(pattern)
+        listener = self.listeners.get(port)
         before_timestamp = time.time()
         time_passed = 0
         while True:
-            message += self._readAll(port)
-            #print("reading... Obtained message: %s" % message)
+            if listener is not None:
+                # Blocking on the queue of received lines, until the timeout
+                line = listener.readLine(timeout=max(timeout - time_passed, 0))
+                new_text = line or ''
+            else:
+                new_text = self._readAll(port)
+            # Only the newly arrived part is checked for the pattern
+            matched = reply.feed(new_text)
             current_timestamp = time.time()
             time_passed = current_timestamp - before_timestamp
-            if re.search(pattern=pattern, string=message):
-                self.recent_message = message
+            if matched:
+                self.recent_message = reply.message
                 logging.debug("Confirmed full message from the robot: %s", self.recent_message)
                 return self.recent_message
             if time_passed > timeout:
                 # Timeout triggered, return None
                 # Higher level function should repeat the request and try to read again
                 logging.warning("Timeout for _readUntilMatch function.")
-                logging.warning("Message returned from the robot: %s", message)
+                logging.warning("Message returned from the robot: %s", reply.message)
                 logging.warning("Waited %s seconds", time_passed)
                 return
+            if not new_text and listener is None:
+                # Nothing arrived yet; not loading the CPU while waiting
+                time.sleep(POLL_INTERVAL)
     
     
-    def _write(self, port, expression, eol):
+    def _write(self, port, expression, eol, reset_input=True):
+        listener = self.listeners.get(port)
         # Cleaning the port from the previous possible communications
         port.reset_output_buffer()
-        port.reset_input_buffer()
+        if not reset_input:
+            # Replies to the previous commands are still expected
+            pass
+        elif listener is None:
+            port.reset_input_buffer()
+        else:
+            # The listener keeps whatever arrived between the commands; logging it
+            logUnsolicited(listener.name, listener.drain())
         expression = expression.strip()
         expression = expression + eol
         expr_enc = expression.encode()
@@ -256,17 +546,106 @@ class robot(data):
     
         
     def writeLoadCell(self, expression):
-        self._write(port=self.loadcell_port, expression=expression, eol='')
+        self._write(port=self.loadcell_port, expression=expression, eol=self._getLoadCellEol())
+    
+    
+    def _getLoadCellEol(self):
+        """
+        Returns the end of line for the load cells controller commands. Firmware with 
+        protocol 2 executes the command as soon as the new line arrives; the older one 
+        only takes commands without it, after its 20 ms serial timeout.
+        The controller is asked for its version the first time.
+        """
+        if self.loadcell_eol is not None:
+            return self.loadcell_eol
+        with self._portLock(self.loadcell_port):
+            if self.loadcell_eol is None:
+                # Older firmware also replies to "version" followed by the new line
+                message = self._writeAndWait(port=self.loadcell_port, expression='version', eol='\n', 
+                                             confirm_message=LOADCELL_VERSION_REPLY_END, 
+                                             timeout=PORT_PROBE_TIMEOUT)
+                self._setLoadCellProtocol(message)
+                if self.loadcell_eol is None:
+                    logging.warning("Load cells controller did not reply to version request.")
+                    self.loadcell_eol = ''
+        return self.loadcell_eol
+    
+    
+    def _setLoadCellProtocol(self, version_message):
+        """
+        Chooses the load cells controller end of line from its reply to "version", and whether
+        to read both load cells with RB: the firmware has both since protocol 2.
+        """
+        if not version_message or LOADCELL_WELCOME not in version_message:
+            # Not a reply to "version"
+            return
+        match = LOADCELL_PROTOCOL_RE.search(version_message)
+        if match is not None and int(match.group(1)) >= 2:
+            self.loadcell_eol = '\n'
+            self.loadcell_combined_read = True
+        else:
+            self.loadcell_eol = ''
+            self.loadcell_combined_read = False
     
         
-    def _writeAndWait(self, port, expression, eol, confirm_message):
-        self._write(port, expression, eol)
-        message = self._readUntilMatch(port, confirm_message)
+    def _portLock(self, port):
+        """
+        Returns the lock of the port. Holding it, a thread can send a command and read its
+        reply without another thread talking to the same controller in between.
+        """
+        with self._port_locks_lock:
+            try:
+                return self.port_locks[port]
+            except KeyError:
+                lock = threading.RLock()
+                self.port_locks[port] = lock
+                return lock
+    
+    
+    def _writeAndWait(self, port, expression, eol, confirm_message, timeout=TIMEOUT):
+        with self._portLock(port):
+            send_time = time.time()
+            self._write(port, expression, eol)
+            message = self._readUntilMatch(port, confirm_message, timeout=timeout)
+            if self.tracer is not None:
+                self.tracer.record(self._portName(port), expression, send_time, time.time(), 
+                                   len((expression.strip() + eol).encode()), 
+                                   len(message.encode()) if message else 0, 
+                                   acknowledged=message is not None)
         return message
+    
+    
+    def _portName(self, port):
+        if port is getattr(self, 'cartesian_port', None):
+            return 'cartesian'
+        if port is getattr(self, 'loadcell_port', None):
+            return 'loadcell'
+        return str(getattr(port, 'port', port))
+    
+    
+    def startTracing(self, tracer=None):
+        """
+        Starts recording the timing of every command sent to the controllers.
+        Returns the tracer (tracer.commandTracer); dump it with its dump() method.
+        """
+        if tracer is None:
+            tracer = commandTracer()
+        self.tracer = tracer
+        return tracer
+    
+    
+    def stopTracing(self):
+        """
+        Stops recording the commands. Returns the tracer with the recorded commands.
+        """
+        tracer = self.tracer
+        self.tracer = None
+        return tracer
         
     
     def writeAndWaitLoadCell(self, expression):
-        return self._writeAndWait(port=self.loadcell_port, expression=expression, eol='', confirm_message='\r\n')
+        return self._writeAndWait(port=self.loadcell_port, expression=expression, 
+                                  eol=self._getLoadCellEol(), confirm_message='\r\n')
 
 
     def _getRackObjectByName(self, rack_name):
@@ -434,16 +813,23 @@ class robot(data):
         wrong_hit_threshold = self.tips_rack.getProperPickupdZ()
         final_pickup_dist = self.tips_rack.getTipPickupdZ()
         
+        self.last_tip_miss = None
         Z_start = self.getPosition(axis='Z')
         Z_calibrated = self.tips_rack.getZ()
         Z_wrong_hit_abs = Z_calibrated - wrong_hit_threshold
         if self.load_cells_zeroed_near_tips:
-            Z_soft = self.moveDownUntilPress(1, initial_force, z_max=Z_wrong_hit_abs, tare=False)
+            Z_soft = self.moveDownUntilPress(1, initial_force, z_max=Z_wrong_hit_abs, tare=False, 
+                                             continuous=True, refine=True, filter_profile='tip_pickup')
         else:
-            Z_soft = self.moveDownUntilPress(1, initial_force, z_max=Z_wrong_hit_abs)
+            Z_soft = self.moveDownUntilPress(1, initial_force, z_max=Z_wrong_hit_abs, continuous=True, 
+                                             refine=True, filter_profile='tip_pickup')
             self.load_cells_zeroed_near_tips = True
         if Z_soft < Z_wrong_hit_abs:
             # Robot hit something before the tip; that means it probably missed.
+            # How it presses on the rim tells where the tip is (see lookForTip)
+            left, right = self.readBothLoads()
+            self.last_tip_miss = (self.getPosition(axis='X'), self.getPosition(axis='Y'), 
+                                  left, right, Z_wrong_hit_abs - Z_soft)
             # Retracting and ejecting tip (just in case)
             self.move(z=Z_start)
             self.dumpTip()
@@ -451,7 +837,7 @@ class robot(data):
         else:
             # Robot correctly got to the tip, now pressing further so the tip is firmly attached
             self.moveAxisDelta('Z', final_pickup_dist)
-            self.moveDownUntilPress(1, final_force, tare=False)
+            self.moveDownUntilPress(1, final_force, tare=False, continuous=True)
             return True
 
 
@@ -460,7 +846,25 @@ class robot(data):
         tip_picked_up = self.tipPickupAttempt()
         return tip_picked_up
 
-    def lookForTip(self, min_radius=0.5, max_radius=3):
+    def lookForTip(self, min_radius=0.5, max_radius=3, guided=True):
+        """
+        Looks for the tip around the current position, after the pickup hit the tip rim.
+        
+        Inputs
+            min_radius, max_radius
+                The positions tried are on the circles from min_radius to max_radius, 
+                min_radius apart, 8 per circle.
+            guided
+                If True and the missed pickup recorded the loads (last_tip_miss), the positions 
+                are tried starting from the one closest to the tip position estimated from 
+                the loads, re-estimated after every miss (see _estimateTipOffset). 
+                Otherwise, the positions are tried in a spiral.
+        
+        Returns
+            True if the tip was picked up.
+        """
+        if guided and self.last_tip_miss is not None:
+            return self._guidedTipSearch(min_radius, max_radius)
         
         x_init = self.getPosition(axis='X')
         y_init = self.getPosition(axis='Y')
@@ -497,22 +901,118 @@ class robot(data):
         return False
     
     
+    def _guidedTipSearch(self, min_radius, max_radius):
+        """
+        lookForTip() trying the positions closest to the estimated tip position first.
+        """
+        x_init = self.getPosition(axis='X')
+        y_init = self.getPosition(axis='Y')
+        z_init = self.getPosition(axis='Z')
+        first_miss = self.last_tip_miss
+        candidates = []
+        radius = min_radius
+        while radius < max_radius:
+            for i in range(8):
+                angle = i * math.pi / 4
+                candidates.append((round(x_init + radius * math.cos(angle), 4), 
+                                   round(y_init + radius * math.sin(angle), 4)))
+            radius += min_radius
+        estimates = self._estimateTipPositions(self.last_tip_miss, min_radius, max_radius)
+        while candidates:
+            candidates.sort(key=lambda c: min(math.hypot(c[0] - x, c[1] - y) for x, y in estimates))
+            x, y = candidates.pop(0)
+            self.move(x=x, y=y, z=z_init)
+            if self.tipPickupAttempt():
+                self._learnTipLoadSign(first_miss, x, y)
+                return True
+            # Estimating again from this miss; keeping the previous estimate if it gave nothing
+            estimates = self._estimateTipPositions(self.last_tip_miss, min_radius, max_radius) or estimates
+        self.move(x=x_init, y=y_init, z=z_init)
+        return False
+    
+    
+    def _estimateTipPositions(self, miss, min_radius, max_radius):
+        """
+        Estimates the tip position from a pickup that hit the rim. 
+        The load cells are on the left and right of the pipette, so the imbalance of their 
+        loads tells the X side the rim pressed from; the tip is on the opposite side. 
+        The Y side is not known, so two positions mirrored along Y are returned.
+        The higher the contact, the further the tip (see TIP_SEARCH_OFFSET_PER_DZ).
+        
+        Inputs
+            miss
+                (x, y, left, right, dz), like last_tip_miss.
+        
+        Returns
+            List of (x, y) positions; empty if there is no load to estimate from.
+        """
+        if miss is None:
+            return []
+        x, y, left, right, dz = miss
+        total = left + right
+        if total <= 0:
+            return []
+        balance = min(max(self.getTipSearchLoadSign() * (right - left) / total, -1), 1)
+        distance = min(max(min_radius + dz * TIP_SEARCH_OFFSET_PER_DZ, min_radius), max_radius)
+        dx = -balance * distance
+        dy = math.sqrt(1 - balance**2) * distance
+        return [(x + dx, y + dy), (x + dx, y - dy)]
+    
+    
+    def _learnTipLoadSign(self, miss, x_found, y_found):
+        """
+        Flips the sign the load imbalance is taken with, if the tip was found on the X side 
+        opposite to the estimated one.
+        """
+        x, y, left, right, dz = miss
+        total = left + right
+        if total <= 0:
+            return
+        balance = self.getTipSearchLoadSign() * (right - left) / total
+        dx = x_found - x
+        # Only clear cases: the rim pressed mostly from one side, and the tip was found along X
+        if abs(balance) > 0.5 and abs(dx) > abs(y_found - y) and balance * dx > 0:
+            logging.info("Tip was found opposite to the load imbalance; flipping the imbalance sign.")
+            self.setTipSearchLoadSign(-self.getTipSearchLoadSign())
+    
+    
+    def setTipSearchLoadSign(self, sign):
+        """
+        Sets how the left/right load imbalance is related to X, for the tip search (lookForTip).
+        1 if the right load cell is the one pressed by a contact on the larger X side, -1 otherwise.
+        Learned by the search itself.
+        """
+        self._setSetting('tip_search_load_sign', sign)
+    
+    
+    def getTipSearchLoadSign(self):
+        if self._settingPresent('tip_search_load_sign'):
+            return self._getSetting('tip_search_load_sign')
+        return TIP_SEARCH_DEFAULT_LOAD_SIGN
+    
+    
     def pickUpTip(self, column, row, raise_z=0, dx=0, dy=0):
         # Getting a relative height to which it is safe to approach the tips (without hitting them)
         fine_approach_dz = self.tips_rack.getFineApproachdZ()
-        # Moving towards the tip
-        self.moveToWell(rack_name='tips', column=column, row=row, save_height=fine_approach_dz)
-        # Optional correction (mostly for debugging)
-        self.moveAxisDelta('X', dx)
-        self.moveAxisDelta('Y', dy)
+        # Moving towards the tip; zeroing the load cells on the way for the first pickup
+        x_well, y_well, z_well, a_well = self.moveToWell(rack_name='tips', column=column, row=row, 
+                                                         save_height=fine_approach_dz, 
+                                                         tare_on_the_way=not self.load_cells_zeroed_near_tips)
+        # Optional correction (mostly for debugging), and the offset learned by the tip search
+        offset_x, offset_y = self.tips_rack.getTipOffsetXY()
+        self.moveAxisDelta('X', dx + offset_x)
+        self.moveAxisDelta('Y', dy + offset_y)
         # Attempting to pickup at calibrated position
         tip_picked_up = self.tipPickupAttempt()
         if not tip_picked_up:
-            # If hitting a tip rim (calibration off), spiralling around the calibrated position to 
-            # find the tip
+            # If hitting a tip rim (calibration off), searching around the calibrated position
+            # for the tip.
             # This is to rescue the protocol. Must recalibrate next time.
             print("Tip calibration is off. Please recalibrate tip rack before running another protocol.")
-            self.lookForTip()
+            if self.lookForTip():
+                # Next tips are picked up with the found offset
+                self.tips_rack.setTipOffsetXY(self.getPosition(axis='X') - x_well - dx, 
+                                              self.getPosition(axis='Y') - y_well - dy)
         x, y, z, a = self.getPosition()
         # Moving up with the tip
         raise_dz_with_tip = self.tips_rack.getRaiseWithTipdZ()
@@ -640,8 +1140,8 @@ class robot(data):
         To enable recalculation, user must provide slope and intercept value of 
         a linear dependence "volume vs. plunger position"
         """
-        self._setSetting('volume_to_position_slope', slope)
-        self._setSetting('volume_to_position_intercept', intercept)
+        self._setSetting('volume_to_position_slope', slope, sync=True)
+        self._setSetting('volume_to_position_intercept', intercept, sync=True)
     
     
     def getPipetteVolumeConstants(self):
@@ -653,8 +1153,8 @@ class robot(data):
         return slope, intercept
         
     def setVolumeFromPlungerPositionConstants(self, slope, intercept):
-        self._setSetting('position_to_volume_slope', slope)
-        self._setSetting('position_to_volume_intercept', intercept)
+        self._setSetting('position_to_volume_slope', slope, sync=True)
+        self._setSetting('position_to_volume_intercept', intercept, sync=True)
         
     def getVolFromPlungerPosConst(self):
         slope = self._getSetting('position_to_volume_slope')
@@ -699,7 +1199,7 @@ class robot(data):
                 return self._getSetting('pipetting_delay')
     
 
-    def _probeTubeZBottom(self, sample, step=0.2, threshold=200, V_probe=None, Z_probe=None, in_place=False):
+    def _probeTubeZBottom(self, sample, step=0.6, threshold=200, V_probe=None, Z_probe=None, in_place=False):
         """
         Will attempt to touch tube bottom, to discover its Z coordinate.
         Will save that coordinate to the sample settings.
@@ -708,7 +1208,7 @@ class robot(data):
             sample
                 sample object
             step
-                mm step to approach the bottom
+                mm step to approach the bottom; the bottom is found between the steps
             threshold
                 sensor readings at which bottom is considered touched.
             V_probe
@@ -730,20 +1230,32 @@ class robot(data):
         if Z_probe is None:
             Z_probe = sample.calcAbsLiquidLevelFromVol(V_probe, added_length=self._calcExtraLength())
         
-        # Getting to the sample
+        # Getting to the sample; zeroing the load cells on the way
         if not in_place:
-            self.moveToSample(sample, z=Z_probe)
+            self.moveToSample(sample, z=Z_probe, tare_on_the_way=True)
 
         # Touching the sample bottom
-        Z_bottom = self.moveDownUntilPress(step=step, threshold=threshold)
+        Z_bottom = self._touchSampleBottom(sample, step=step, threshold=threshold)
         
+        return Z_bottom
+    
+    
+    def _touchSampleBottom(self, sample, step, threshold):
+        """
+        Lowers the tip until it touches the bottom of the sample, starting the fine search 
+        near the expected bottom if it is known. Records the bottom Z coordinate for the sample, 
+        and as the estimate for the other samples of the same type.
+        """
+        added_length = self._calcExtraLength()
+        z_bottom = self.moveDownUntilPress(step=step, threshold=threshold, continuous=True, refine=True, 
+                                           z_predicted=sample.predictZBottom(added_length=added_length), 
+                                           filter_profile='tube_bottom')
         # Recording Z coordinate of the bottom of the given tube
-        sample.setZBottom(Z_bottom)
-        
+        sample.setZBottom(z_bottom)
+        sample.shareZBottom(z_bottom, added_length=added_length)
         # Recording for the sample that the bottom was touched
         sample.setBottomTouched()
-        
-        return Z_bottom
+        return z_bottom
         
     
     def _getTubeZBottom(self, sample, in_place=False, force_probe=False):
@@ -797,8 +1309,9 @@ class robot(data):
                 Position of a plunger in microliters.
         """
         self.moveAxisDelta(axis, radius)
-        self.moveAxisDelta('Z', dZ)
-        self.movePipetteToVolume(plunger_volume_position)
+        # Lowering and uptaking at the same time
+        z = self.getPosition(axis='Z')
+        self.moveTo(z=z+dZ, a=self.calcPipettePositionFromVolume(plunger_volume_position))
         time.sleep(delay)
         self.moveAxisDelta('Z', -dZ)
         time.sleep(delay)
@@ -885,24 +1398,23 @@ class robot(data):
                 z_immers = sample.calcNormalPipettingZ(
                             v_uptake=volume, v_lag=lag_vol_down, added_length=self._calcExtraLength())
         
-        # Moving Z axis so the tip is touching the bottom of the tube
-        if not in_place:
-            self.moveToSample(sample, z=z_immers)
-        
         # Checking whether the tube bottom needs to be calibrated.
         # Will be calibrated either if it was never done before, or if there are explicit instructions to ignore_calibration
         # the previous calibration
-        if v_insert_override is None:
-            if sample_has_low_volume:
-                if (not tube_bottom_is_calibrated) or ignore_calibration:
-                    # Approaching the bottom of the tube
-                    z_sample_bottom = self.moveDownUntilPress(step=0.1, threshold=100)
-                    # Recording Z coordinate at which all liquid will be uptaken for the sample
-                    sample.setZBottom(z_sample_bottom)
-                    # Recording for the sample that the bottom was touched
-                    sample.setBottomTouched()
-                    # Moving a notch up so the tip hole is not blocked
-                    self.moveAxisDelta('Z', -liquid_uptake_low_volume_bottom_offset)
+        touch_bottom = (v_insert_override is None and sample_has_low_volume and 
+                        ((not tube_bottom_is_calibrated) or ignore_calibration))
+        
+        # Moving Z axis so the tip is touching the bottom of the tube
+        if not in_place:
+            # Load cells are zeroed on the way, if the bottom is going to be touched
+            self.moveToSample(sample, z=z_immers, tare_on_the_way=touch_bottom)
+        
+        if touch_bottom:
+            # Approaching the bottom of the tube; recording Z coordinate at which 
+            # all liquid will be uptaken for the sample
+            self._touchSampleBottom(sample, step=0.3, threshold=100)
+            # Moving a notch up so the tip hole is not blocked
+            self.moveAxisDelta('Z', -liquid_uptake_low_volume_bottom_offset)
         
         # Deciding whether to follow a low volume uptake or a normal uptake
         if sample_has_low_volume:
@@ -935,8 +1447,12 @@ class robot(data):
         x, y = sample.getCenterXY()
         tip_length_compensation = self._calcExtraLength()
         z_near_bottom = sample.getCloseToBottomZ(tip_length_compensation)
+        tube_bottom_is_calibrated = sample._settingPresent('tube_bottom_z')
+        not_ignoring_calibration = not ignore_calibration
+        touch_bottom = not (tube_bottom_is_calibrated and not_ignoring_calibration)
         self.move(z=z_safe)
-        self.moveToSample(sample=sample)
+        # Zeroing the load cells while travelling to the sample
+        self.moveToSample(sample=sample, tare_on_the_way=touch_bottom)
         
         # Setting the plunger
         volume = sample.getVolume()
@@ -949,13 +1465,12 @@ class robot(data):
         
         self.move(z=z_near_bottom)
         
-        
-        tube_bottom_is_calibrated = sample._settingPresent('tube_bottom_z')
-        not_ignoring_calibration = not ignore_calibration
-        if tube_bottom_is_calibrated and not_ignoring_calibration:
+        if not touch_bottom:
             z_lowest = sample.getZBottom()
         else:
-            z_lowest = self.moveDownUntilPress(step=0.1, threshold=100)
+            z_lowest = self.moveDownUntilPress(step=0.3, threshold=100, continuous=True, refine=True, 
+                                               z_predicted=sample.predictZBottom(tip_length_compensation), 
+                                               filter_profile='tube_bottom')
         
         liquid_uptake_low_volume_bottom_offset = self.getLiquidUptakeLowVolBottomOffset()
         z_start_uptake = z_lowest - liquid_uptake_low_volume_bottom_offset
@@ -1359,19 +1874,202 @@ class robot(data):
     
     
     def tareAll(self):
+        self.waitForTare()
+        self.syncCartesian()    # Zeroing with the robot stopped; see startTare() for zeroing on the way
         self.writeAndWaitLoadCell('T')
     
     
+    def startTare(self):
+        """
+        Starts zeroing the load cells in the background, and returns without waiting for it.
+        Waits only for the moves already sent (like lifting the head) to finish, as the head 
+        must not touch anything; the following X, Y moves run while the load cells are zeroed.
+        The load cells measure the vertical force on the pipette, which X, Y moves at a constant 
+        height hardly change, but Z acceleration does: Z moves wait for the tare to finish 
+        (see _holdTareForMove).
+        
+        The next probe (moveDownUntilPress with tare=True) uses this tare instead of zeroing 
+        the load cells again; it and all the load readings wait for the tare to finish.
+        Lifting Z or homing before that probe discards the tare, as the travel it was 
+        started for is over.
+        """
+        if self._tare_thread is not None:
+            return
+        self.syncCartesian()
+        self._tare_thread = threading.Thread(target=self.writeAndWaitLoadCell, args=('T',), 
+                                             name='tare', daemon=True)
+        self._tare_thread.start()
+    
+    
+    def waitForTare(self):
+        """
+        Waits for the tare started by startTare() to finish.
+        Returns True if there was one; it is not used by the next probe after that.
+        """
+        thread = self._tare_thread
+        if thread is None:
+            return False
+        thread.join()
+        self._tare_thread = None
+        return True
+    
+    
+    def _tareBeforeProbe(self):
+        """
+        Zeroes the load cells before a probe, unless it was done on the way with startTare().
+        """
+        if not self.waitForTare():
+            self.tareAll()
+    
+    
+    def _waitForTareDone(self):
+        # Readings taken during the tare would not be zeroed
+        thread = self._tare_thread
+        if thread is not None:
+            thread.join()
+    
+    
+    def _holdTareForMove(self, expression):
+        """
+        Called before sending a command to the smoothieboard while the tare started by 
+        startTare() is not used yet. Z moves wait for the tare to finish; a lift of Z or 
+        homing of Z discards it, so it is not used by an unrelated probe later.
+        """
+        expression = expression.strip().upper()
+        if expression.startswith('$H') or \
+           (expression.startswith('G28') and ('Z' in expression or len(expression.split()) == 1)):
+            self.waitForTare()
+            return
+        if not (expression.startswith('G0 ') or expression.startswith('G1 ')):
+            return
+        z = dict(AXIS_WORD_RE.findall(expression)).get('Z')
+        if z is None:
+            return
+        if (self.position['Z'] is None) or (float(z) < self.position['Z']):
+            self.waitForTare()
+        else:
+            self._waitForTareDone()
+    
+    
     def readRightLoad(self):
+        self._waitForTareDone()
+        self.syncCartesian()    # Reading must reflect the finished move
         return float(self.writeAndWaitLoadCell('RR').strip())
     
     
     def readLeftLoad(self):
+        self._waitForTareDone()
+        self.syncCartesian()
         return float(self.writeAndWaitLoadCell('RL').strip())
     
 
+    def readBothLoads(self):
+        """
+        Reads both load cells. Uses single RB request if the load cells controller firmware 
+        supports it; otherwise RL and RR requests.
+        
+        Returns
+            (left, right) loads
+        """
+        self._waitForTareDone()
+        self.syncCartesian()
+        if self.load_stream is not None:
+            # Next reading converted after the move finished
+            reading = self.load_stream.nextReading(timeout=LOADCELL_STREAM_READING_TIMEOUT)
+            if reading is not None:
+                timestamp, left, right = reading
+                return left, right
+            logging.warning("No streamed load cells readings; requesting them.")
+        # The version tells whether the firmware has RB
+        self._getLoadCellEol()
+        if self.loadcell_combined_read is not False:
+            loads = self._readCombinedLoads()
+            if loads is not None:
+                return loads
+        return self.readLeftLoad(), self.readRightLoad()
+    
+    
+    def _readCombinedLoads(self):
+        """
+        Sends the RB request. Returns (left, right), or None if the reply is not valid.
+        """
+        if self.loadcell_combined_read is None:
+            # Controller that did not tell its version; firmware without RB ignores it, so 
+            # not waiting long for the reply to find out.
+            timeout = LOADCELL_COMBINED_READ_CHECK_TIMEOUT
+        else:
+            timeout = TIMEOUT
+        message = self._writeAndWait(port=self.loadcell_port, expression='RB', eol=self._getLoadCellEol(), 
+                                     confirm_message='\r\n', timeout=timeout)
+        try:
+            left, right, counter = message.split()
+            loads = float(left), float(right)
+            self.loadcell_sample_counter = int(counter)
+        except (AttributeError, ValueError):
+            if self.loadcell_combined_read is None:
+                # A slow controller may just have missed the short timeout
+                self._combined_read_checks += 1
+                if self._combined_read_checks >= LOADCELL_COMBINED_READ_CHECKS:
+                    logging.info("Load cells controller does not support RB command; reading cells one by one.")
+                    self.loadcell_combined_read = False
+            else:
+                logging.warning("Invalid reply to RB command: %s", message)
+            return
+        self.loadcell_combined_read = True
+        return loads
+    
+
+    def startLoadCellStreaming(self, buffer_size=LOAD_BUFFER_SIZE):
+        """
+        Makes the load cells controller send both readings continuously, at the HX711 rate.
+        The load cell port is read in the background from then on (see startListeners()), 
+        and the readings are kept in a ring buffer; readBothLoads() and getCombinedLoad() 
+        take them from there.
+        
+        Inputs
+            buffer_size
+                Number of the latest readings kept.
+        
+        Returns
+            loadcellstream.loadRingBuffer with the readings; None if the firmware does not 
+            support streaming.
+        """
+        if self.load_stream is not None:
+            return self.load_stream
+        listener = self.listeners.get(self.loadcell_port)
+        if listener is None:
+            listener = portListener(self.loadcell_port, name='loadcell')
+            listener.start()
+            self.listeners[self.loadcell_port] = listener
+        stream = loadRingBuffer(buffer_size)
+        listener.line_handler = stream.feedLine
+        message = self._writeAndWait(port=self.loadcell_port, expression='S on', eol=self._getLoadCellEol(), 
+                                     confirm_message='Streaming on', timeout=LOADCELL_STREAM_CHECK_TIMEOUT)
+        if message is None:
+            logging.warning("Load cells controller does not support streaming.")
+            listener.line_handler = None
+            return
+        self.load_stream = stream
+        return stream
+    
+    
+    def stopLoadCellStreaming(self):
+        """
+        Stops the load cells readings stream; the readings are requested one by one after that.
+        """
+        if self.load_stream is None:
+            return
+        listener = self.listeners.get(self.loadcell_port)
+        self._writeAndWait(port=self.loadcell_port, expression='S off', eol=self._getLoadCellEol(), 
+                           confirm_message='Streaming off')
+        self.load_stream = None
+        if listener is not None:
+            listener.line_handler = None
+    
+    
     def getCombinedLoad(self):
-        return self.readRightLoad() + self.readLeftLoad()
+        left, right = self.readBothLoads()
+        return right + left
     
     
     def setTubeBottomLoadThreshold(self, z):
@@ -1466,7 +2164,261 @@ class robot(data):
 
     # TODO: smoothie must report about physically finishing the job, probably here.
     def writeAndWaitCartesian(self, expression):
-        return self._writeAndWait(port=self.cartesian_port, expression=expression, eol='\r', confirm_message='ok\n')
+        """
+        Sends a command to the smoothieboard and waits for its "ok".
+        In streaming mode (see startStreaming), the command is sent without waiting, 
+        'M400' becomes a sync barrier, and queries like '?' are answered after all streamed 
+        commands are acknowledged.
+        """
+        if self._tare_thread is not None:
+            self._holdTareForMove(expression)
+        if self.streaming_window:
+            expression = expression.strip()
+            if expression == 'M400':
+                return self.syncCartesian()
+            if expression not in STREAMING_PASSTHROUGH:
+                self._streamCartesian(expression)
+                self._trackPosition(expression)
+                return
+            self._collectCartesianAcks(0)
+        if expression.strip() == '?':
+            # The status line comes after the "ok"; waiting for all of it
+            confirm_message = STATUS_REPLY_END
+        else:
+            confirm_message = 'ok\n'
+        message = self._writeAndWait(port=self.cartesian_port, expression=expression, eol='\r', 
+                                     confirm_message=confirm_message)
+        self._trackPosition(expression, confirmed=message is not None)
+        return message
+    
+    
+    def _trackPosition(self, expression, confirmed=True):
+        """
+        Updates the remembered robot position according to the command sent to the smoothieboard.
+        """
+        expression = expression.strip().upper()
+        if expression.startswith('G0 ') or expression.startswith('G1 '):
+            for axis, value in AXIS_WORD_RE.findall(expression):
+                if confirmed:
+                    self.position[axis] = round(float(value), 4)
+                else:
+                    # Not known whether the move happened
+                    self.position[axis] = None
+            self._moves_since_verify += 1
+            if self.position_verify_interval and self._moves_since_verify >= self.position_verify_interval:
+                self.verifyPosition()
+        elif expression.startswith('G28'):
+            # Homing; the axes end up wherever the homing switches are
+            homed_axes = [word[0] for word in expression.split()[1:] if word[:1] in self.position]
+            for axis in (homed_axes or list(self.position)):
+                self.position[axis] = None
+        elif expression.startswith('$H') or expression.startswith('G9'):
+            # Homing all axes, or changing coordinate system (G90, G91, G92): tracking is lost
+            self.invalidatePosition()
+    
+    
+    def invalidatePosition(self):
+        """
+        Forgets the remembered position; the next getPosition() will read it from the controller.
+        """
+        for axis in self.position:
+            self.position[axis] = None
+    
+    
+    def resyncPosition(self):
+        """
+        Reads the position from the controller and replaces the remembered one.
+        Returns (x, y, z, a)
+        """
+        self.writeAndWaitCartesian('M400')
+        msg = self.writeAndWaitCartesian("?")
+        # msg will be in the form of:
+        # 'ok\n<Idle|MPos:0.0000,0.0000,1.0000,3.0000|WPos:0.0000,0.0000,1.0000|F:3000.0,100.0>\n'
+        # Only machine position (MPos) is of interest.
+        status = parseStatusReply(msg)
+        if status is None:
+            logging.error("Failed to read the robot position. Reply: %s", msg)
+            self.invalidatePosition()
+            return
+        state, x, y, z, a = status
+        self.position = {'X': x, 'Y': y, 'Z': z, 'A': a}
+        self._moves_since_verify = 0
+        return x, y, z, a
+    
+    
+    def verifyPosition(self, tolerance=POSITION_TOLERANCE):
+        """
+        Compares the remembered position with the one reported by the controller.
+        Logs a warning if they differ, and takes the controller position.
+        Returns True if the positions matched.
+        """
+        remembered = dict(self.position)
+        reported = self.resyncPosition()
+        if reported is None:
+            return False
+        matched = True
+        for axis, value in zip(['X', 'Y', 'Z', 'A'], reported):
+            if remembered[axis] is not None and abs(remembered[axis] - value) > tolerance:
+                logging.warning("Position drift on axis %s: expected %s, controller reports %s", 
+                                axis, remembered[axis], value)
+                matched = False
+        return matched
+    
+    
+    def setPositionVerification(self, every_n_moves=None):
+        """
+        Makes the robot compare its remembered position with the controller every n moves.
+        Provide None to turn it off.
+        """
+        self.position_verify_interval = every_n_moves
+        self._moves_since_verify = 0
+    
+    
+    def startStreaming(self, window=STREAMING_WINDOW):
+        """
+        Switches to the streaming mode. Up to "window" commands are sent to the smoothieboard
+        without waiting for each "ok", so the planner can blend the moves together.
+        M400 is only sent at the sync barriers: before position queries, load cell readings,
+        servo moves, and when streaming is stopped.
+        """
+        self.syncCartesian()
+        self.streaming_window = window
+    
+    
+    def stopStreaming(self):
+        """
+        Waits for all streamed commands to finish and returns to one command at a time.
+        """
+        self.syncCartesian()
+        self.streaming_window = 0
+    
+    
+    @contextlib.contextmanager
+    def streaming(self, window=STREAMING_WINDOW):
+        """
+        Streaming mode for a block of operations; the moves are finished at the end of the block.
+            with ber.streaming():
+                ber.move(x=10, y=10)
+                ber.move(z=50)
+        """
+        previous_window = self.streaming_window
+        self.startStreaming(window)
+        try:
+            yield self
+        finally:
+            self.syncCartesian()
+            self.streaming_window = previous_window
+    
+    
+    def syncCartesian(self):
+        """
+        Sync barrier. In streaming mode, waits for all the streamed commands to be 
+        acknowledged and physically finished (M400). Does nothing when the robot is not 
+        streaming, as every move already waits for its completion.
+        """
+        if not self.streaming_window or not self._cartesian_unsynced:
+            return
+        with self._portLock(self.cartesian_port):
+            return self._syncCartesian()
+    
+    
+    def _syncCartesian(self):
+        self._collectCartesianAcks(0)
+        logUnsolicited('cartesian', self._cartesian_pending_lines)
+        self._cartesian_pending_lines = []
+        message = self._writeAndWait(port=self.cartesian_port, expression='M400', eol='\r', 
+                                     confirm_message='ok\n', timeout=STREAMING_SYNC_TIMEOUT)
+        self._cartesian_unsynced = False
+        # Steppers that had to be powered off after the streamed moves
+        steppers_to_power_off = self._steppers_to_power_off
+        self._steppers_to_power_off = []
+        for axis in steppers_to_power_off:
+            self._writeAndWait(port=self.cartesian_port, expression='M18 '+axis+'0', eol='\r', 
+                               confirm_message='ok\n')
+        return message
+    
+    
+    def _streamCartesian(self, expression):
+        """
+        Sends the command without waiting for its "ok"; waits only if the window is full.
+        """
+        with self._portLock(self.cartesian_port):
+            self._collectCartesianAcks(self.streaming_window - 1)
+            self._write(port=self.cartesian_port, expression=expression, eol='\r', reset_input=False)
+            self._streamed_commands.append((expression, time.time(), len(expression.strip()) + 1))
+            self.commands_in_flight += 1
+            self._cartesian_unsynced = True
+    
+    
+    def _readCartesianLine(self, timeout):
+        """
+        Returns next line received from the smoothieboard, or None if nothing arrived in time.
+        """
+        listener = self.listeners.get(self.cartesian_port)
+        if listener is not None:
+            return listener.readLine(timeout=timeout)
+        before_timestamp = time.time()
+        while not self._cartesian_pending_lines:
+            self._cartesian_pending_lines += self._cartesian_lines.feed(
+                                                    self._readAll(self.cartesian_port).encode())
+            if self._cartesian_pending_lines:
+                break
+            if time.time() - before_timestamp > timeout:
+                return
+            time.sleep(POLL_INTERVAL)
+        return self._cartesian_pending_lines.pop(0)
+    
+    
+    def _collectCartesianAcks(self, max_in_flight):
+        """
+        Reads acknowledgements of the streamed commands until no more than max_in_flight
+        commands are waiting for them.
+        """
+        while self.commands_in_flight > max_in_flight:
+            line = self._readCartesianLine(timeout=STREAMING_ACK_TIMEOUT)
+            if line is None:
+                logging.warning("No acknowledgement for %s streamed commands.", self.commands_in_flight)
+                while self._streamed_commands:
+                    self._traceStreamedCommand('', acknowledged=False)
+                self.commands_in_flight = 0
+                return
+            if line.startswith('ok'):
+                self._traceStreamedCommand(line)
+                self.commands_in_flight -= 1
+            elif line.startswith('error'):
+                # Smoothieboard replies with an error instead of "ok" for rejected commands
+                logging.warning("Streamed command failed: %s", line.strip())
+                self._traceStreamedCommand(line)
+                self.commands_in_flight -= 1
+            else:
+                logUnsolicited('cartesian', [line])
+    
+    
+    def _traceStreamedCommand(self, reply, acknowledged=True):
+        """
+        Takes the oldest streamed command as the one acknowledged by the reply.
+        """
+        if not self._streamed_commands:
+            return
+        expression, send_time, bytes_sent = self._streamed_commands.pop(0)
+        if self.tracer is not None:
+            self.tracer.record('cartesian', expression, send_time, time.time(), bytes_sent, 
+                               len(reply.encode()), acknowledged=acknowledged)
+    
+    
+    def _finishMove(self, axis=None):
+        """
+        Waits for the move to be physically finished. For the pipette plunger (axis 'A'),
+        also powers the stepper off, so it does not overheat.
+        In streaming mode, both are postponed till the next sync barrier.
+        """
+        if self.streaming_window:
+            if axis == 'A' and 'A' not in self._steppers_to_power_off:
+                self._steppers_to_power_off.append('A')
+            return
+        self.writeAndWaitCartesian('M400')
+        if axis == 'A':
+            self.powerStepperOff('A')
 
     
     def home(self, part='all'):
@@ -1546,13 +2498,12 @@ class robot(data):
         full_cmd = 'G0 X' + str(x) + ' Y' + str(y) + ' F' + str(speed)
         try:
             self.writeAndWaitCartesian(full_cmd)
-            self.writeAndWaitCartesian('M400')
+            self._finishMove()
         except:
             print ("Movement failed. The following command was sent:")
             print (full_cmd)
             return
 
-    # TODO: this function must be able to move all axis simultaneously (x, y, z, a)
     def move(self, x=None, y=None, z=None, z_first=True, speed_xy=None, speed_z=None):
         """
         Move robot to a new position with given absolute coordinates.
@@ -1567,6 +2518,8 @@ class robot(data):
                     if True and z value provided, will move Z coordinate first, 
                     then X and Y. Otherwise, will start from X and Y and then Z.
                     Default is True.
+                    When the whole path is above the safe Z (see setSafeZ), all axes
+                    are moved simultaneously instead.
                 speed_xy
                     Speed at which to move X and Y coordinates.
                     If not provided, library default values from arnie.speed will be used.
@@ -1574,38 +2527,127 @@ class robot(data):
                     Speed at which to move Z coordinate.
                     If not provided, library default values from arnie.speed will be used.
         """
+        self.moveTo(x=x, y=y, z=z, z_first=z_first, speed_xy=speed_xy, speed_z=speed_z)
+    
+    
+    def moveTo(self, x=None, y=None, z=None, a=None, z_first=None, clear_z=None, 
+               speed_xy=None, speed_z=None, speed_a=None):
+        """
+        Moves any of X, Y, Z axes and the pipette plunger (A) to the given absolute coordinates,
+        with a single G-code command when it is safe to do so.
+        
+        X, Y and Z move together only if the whole path lies above clear_z (Z grows downwards),
+        or if only XY or only Z is moving. Otherwise the move is split in two:
+        when the robot goes up, Z moves first; when it goes down, X and Y move first.
+        The plunger moves together with the last part of the move, so it finishes 
+        when the robot arrives.
         
-        if speed_xy == None:
+            Inputs
+                x, y, z, a
+                    final coordinates, mm. Any of them may be omitted.
+                    Provide a only if the plunger is allowed to move during the travel.
+                z_first
+                    Forces the order of the split move: True - Z first, False - X and Y first.
+                    Default is None: order is chosen by the direction of Z travel.
+                clear_z
+                    Absolute Z above which nothing can be hit. Default is the safe Z setting.
+                    Provide deeper value when moving inside a tube, where the path is known to be clear.
+                speed_xy, speed_z, speed_a
+                    Speeds for the X and Y, for Z, and for the plunger. Default from settings.
+        """
+        if speed_xy is None:
             speed_xy = self.getSpeed('X')
-        if speed_z == None:
+        if speed_z is None:
             speed_z = self.getSpeed('Z')
+        if speed_a is None:
+            speed_a = self.getSpeed('A')
+        if clear_z is None:
+            clear_z = self.getSafeZ()
+        
+        xy_moves = (x is not None) or (y is not None)
+        if xy_moves and (z is not None):
+            z_current = None
+            if z <= clear_z:
+                z_current = self.getPosition(axis='Z')
+            if (z_current is not None) and (z_current <= clear_z):
+                # Whole path is above anything the pipette could hit
+                segments = [{'X': x, 'Y': y, 'Z': z}]
+            else:
+                if z_first is None:
+                    if z_current is None:
+                        z_current = self.getPosition(axis='Z')
+                    # Going up: leaving Z first. Going down: getting above the target first.
+                    z_first = z < z_current
+                if z_first:
+                    segments = [{'Z': z}, {'X': x, 'Y': y}]
+                else:
+                    segments = [{'X': x, 'Y': y}, {'Z': z}]
+        else:
+            segments = [{'X': x, 'Y': y, 'Z': z}]
+        segments[-1]['A'] = a
         
-        
-        # Each of the functions attempting to move an axis to the coordinate. 
-        # If something goes wrong, like coordinate not specified, command is ignored
-        # and the next one is attempted.
-        if z_first:
-            if z is not None:
-                self.moveAxis('Z', z, speed_z)
-            # If both X and Y should be moved, I need to call moveXY(), one which would move
-            # those axes simultaneously
-            if x is not None and y is not None:
-                self.moveXY(x=x, y=y, speed=speed_xy)
-            elif x is not None:
-                self.moveAxis('X', x, speed_xy)
-            elif y is not None:
-                self.moveAxis('Y', y, speed_xy)
+        for segment in segments:
+            self._moveSegment(segment, speed_xy, speed_z, speed_a)
+    
+    
+    def _moveSegment(self, coordinates, speed_xy, speed_z, speed_a):
+        """
+        Sends one G0 command for all the provided axes {'X': x, 'Y': y, 'Z': z, 'A': a}.
+        Axes with None value are not moved.
+        """
+        cmd = 'G0'
+        for axis in ['X', 'Y', 'Z', 'A']:
+            value = coordinates.get(axis)
+            if value is not None:
+                cmd += ' ' + axis + str(value)
+        if cmd == 'G0':
+            return
+        # Feed rate of the leading axes; the rest are coordinated to finish simultaneously.
+        if (coordinates.get('X') is not None) or (coordinates.get('Y') is not None):
+            speed = speed_xy
+        elif coordinates.get('Z') is not None:
+            speed = speed_z
         else:
-            # If both X and Y should be moved, I need to call moveXY(), one which would move
-            # those axes simultaneously
-            if x is not None and y is not None:
-                self.moveXY(x=x, y=y, speed=speed_xy)
-            elif x is not None:
-                self.moveAxis('X', x, speed_xy)
-            elif y is not None:
-                self.moveAxis('Y', y, speed_xy)
-            if z is not None:
-                self.moveAxis('Z', z, speed_z)
+            speed = speed_a
+        moves_xyz = any(coordinates.get(axis) is not None for axis in ['X', 'Y', 'Z'])
+        if moves_xyz and (coordinates.get('A') is not None):
+            speed = self._limitPlungerSpeed(coordinates, speed, speed_a)
+        self.writeAndWaitCartesian(cmd + ' F' + str(speed))
+        if coordinates.get('A') is not None:
+            self._finishMove('A')
+        else:
+            self._finishMove()
+    
+    
+    def _limitPlungerSpeed(self, coordinates, speed, speed_a):
+        """
+        Feed rate of a move of X, Y or Z together with the plunger, slowed down if needed so 
+        the plunger, which is coordinated to finish together with them, moves no faster than 
+        speed_a: the plunger speed is the rate the liquid is taken or dispensed at.
+        The feed rate applies to the X, Y, Z path.
+        """
+        axes = [axis for axis in ['X', 'Y', 'Z', 'A'] if coordinates.get(axis) is not None]
+        if None in [self.position[axis] for axis in axes]:
+            # Start point not known without asking the controller; never exceed speed_a
+            return min(speed, speed_a)
+        a_distance = abs(coordinates['A'] - self.position['A'])
+        if a_distance == 0:
+            return speed
+        path = math.sqrt(sum((coordinates[axis] - self.position[axis])**2 for axis in axes if axis != 'A'))
+        if path == 0:
+            # Only the plunger actually moves
+            return speed_a
+        return min(speed, round(speed_a * path / a_distance, 2))
+    
+    
+    def setSafeZ(self, z):
+        """
+        Absolute Z coordinate at which the robot can move to any X, Y without hitting anything.
+        """
+        self._setSetting('z_safe', z)
+    
+    def getSafeZ(self):
+        return self._getSetting('z_safe')
     
     
     def moveAxis(self, axis, dist, speed=None):
@@ -1613,9 +2655,7 @@ class robot(data):
         if speed is None:
             speed = self.getSpeed(axis)
         self.writeAndWaitCartesian('G0 '+axis+str(dist)+' F'+str(speed))
-        self.writeAndWaitCartesian('M400')
-        if axis == 'A':
-            self.powerStepperOff('A')
+        self._finishMove(axis)
     
 
     def moveAxisDelta(self, axis, dist, speed=None):
@@ -1625,9 +2665,7 @@ class robot(data):
         pos = self.getPosition(axis=axis)
         new_pos = pos + dist
         self.writeAndWaitCartesian('G0 '+axis+str(new_pos)+' F'+str(speed))
-        self.writeAndWaitCartesian('M400')
-        if axis == 'A':
-            self.powerStepperOff('A')
+        self._finishMove(axis)
     
     
     def powerSteppers(self):
@@ -1653,73 +2691,341 @@ class robot(data):
     def getPosition(self, axis=None):
         """
         Returns current robot position.
+        The position is remembered from the moves sent to the robot; the controller is only 
+        asked when it is not known (at the start, and after homing). 
+        Use resyncPosition() to read it from the controller.
         
         Inputs:
             axis=None
-                If specified as 'X', 'Y' or 'Z', will return the position only 
-                at this axis. Otherwise, will return a tuple of (X, Y, Z) positions.
+                If specified as 'X', 'Y', 'Z' or 'A', will return the position only 
+                at this axis. Otherwise, will return a tuple of (X, Y, Z, A) positions.
         """
-        self.writeAndWaitCartesian('M400')
-        msg = self.writeAndWaitCartesian("?")
-        # msg will be in the form of:
-        # 'ok\n<Idle|MPos:0.0000,0.0000,1.0000,3.0000|WPos:0.0000,0.0000,1.0000|F:3000.0,100.0>\n'
-        # Now breaking on "|". Interested to get MPos:0.0000,0.0000,1.0000,3.0000
-        msg = re.split(pattern='\|', string=msg)[1]
-        # Now removing "MPos:". msg is 0.0000,0.0000,1.0000,3.0000
-        msg = re.split(pattern='\:', string=msg)[-1]
-        # Now splitting the remaining string into the single float values:
-        x = float(re.split(pattern=',', string=msg)[0])
-        y = float(re.split(pattern=',', string=msg)[1])
-        z = float(re.split(pattern=',', string=msg)[2])
-        a = float(re.split(pattern=',', string=msg)[3])
-        
         try:
             axis=axis.upper()
         except:
             pass
-        if axis == 'X':
-            return x
-        elif axis == 'Y':
-            return y
-        elif axis == 'Z':
-            return z
-        elif axis == 'A':
-            return a
-        else:
-            return x, y, z, a
+        if axis in self.position:
+            if self.position[axis] is None:
+                self.resyncPosition()
+            return self.position[axis]
+        if None in self.position.values():
+            self.resyncPosition()
+        return self.position['X'], self.position['Y'], self.position['Z'], self.position['A']
 
         
-    def moveDownUntilPress(self, step, threshold, z_max=180, tare=True):
+    def moveDownUntilPress(self, step, threshold, z_max=180, tare=True, continuous=False, z_predicted=None,
+                           refine=False, filter_profile=None):
         """
         Moves Z axis down one small step at a time, until specified pressure threshold is reached.
         
         Inputs:
             step
                 Distance Z axis would travel in one step, mm.
+                In continuous mode, distance traveled between two load readings.
             threshold
                 Desired pressure detected by the load sensors. Approximately grams.
                 Specify 100-500 for soft touch, 2000-5000 for tip pickup
             z_max=180
                 maximum Z coordinate to lower. If reached, function exits
             tare=True
-                If True, will zero the sensors before lowering. This takes 1-2 seconds.
+                If True, will zero the sensors before lowering. This takes 1-2 seconds, unless 
+                startTare() was called on the way to the probe site.
                 User is responsible to tare sensors previously if they decided to provide False value
+            continuous=False
+                If True and the load readings are streamed (see startLoadCellStreaming), 
+                Z axis moves down in one slow move, which is halted as soon as the 
+                threshold is reached. Otherwise, the steps are used.
+            z_predicted=None
+                Z coordinate where the contact is expected. If provided, the robot quickly moves 
+                close to it and finds the contact with coarse steps and bisection. If nothing is 
+                touched near the expected Z, it falls back to the search down to z_max.
+            refine=False
+                If True, the loads are recorded at every step, and Z at which the threshold is 
+                reached is found between the steps, from the fitted load curve. The robot takes 
+                one step past the threshold for the fit, and returns to the found Z.
+                Allows several times larger steps with the same precision.
+            filter_profile=None
+                Name of the load filter settings (see setLoadFilterProfile), like 'tube_bottom'.
+                The readings are filtered before comparing them to the threshold.
+                None to compare the raw readings.
         
         Returns
             z coordinate at which threshold pressure is reached (i.e., coordinates at which robot 
             touched something with desired force).
         """
+        if z_predicted is not None:
+            return self._moveDownUntilPressPredicted(step, threshold, z_predicted, z_max=z_max, tare=tare, 
+                                                     continuous=continuous, refine=refine, 
+                                                     filter_profile=filter_profile)
+        if continuous and self.load_stream is not None:
+            return self._moveDownUntilPressContinuous(step, threshold, z_max=z_max, tare=tare, 
+                                                      filter_profile=filter_profile)
+        if refine:
+            return self._moveDownUntilPressRefined(step, threshold, z_max=z_max, tare=tare, 
+                                                   filter_profile=filter_profile)
+        load_filter = self._createLoadFilter(filter_profile)
         if tare:
-            self.tareAll()
+            self._tareBeforeProbe()
         z = self.getPosition(axis='Z')
         z_init = z
-        while ((self.getCombinedLoad()) < threshold) and (self.getPosition(axis='Z') < z_max):
+        while (not self._pressed(self.getCombinedLoad(), threshold, load_filter)) and \
+              (self.getPosition(axis='Z') < z_max):
             z += step
             self.moveAxis('Z', z)
         return self.getPosition(axis='Z')
+    
+    
+    def setLoadFilterProfile(self, probe_type, median=1, ema_alpha=1.0, rate_threshold=None):
+        """
+        Sets the filtering of the load readings for a kind of probe.
+        
+        Inputs
+            probe_type
+                'tube_bottom', 'tip_pickup', 'stair', or any other name passed to 
+                moveDownUntilPress as filter_profile.
+            median
+                Number of the last readings to take the median of; 1 for no median.
+            ema_alpha
+                Weight of the new reading in the exponential moving average; 1 for no averaging.
+            rate_threshold
+                Load growth per second, at which the probe is triggered even below the threshold.
+                None to trigger only by the threshold.
+        """
+        with self.settings_lock:
+            if self._settingPresent('load_filter_profiles'):
+                profiles = self._getSetting('load_filter_profiles')
+            else:
+                profiles = {}
+            profiles[probe_type] = {'median': median, 'ema_alpha': ema_alpha, 'rate_threshold': rate_threshold}
+            self._setSetting('load_filter_profiles', profiles)
+    
+    
+    def getLoadFilterProfile(self, probe_type):
+        """
+        Returns the load filter settings for the kind of probe; no filtering if not set.
+        """
+        profile = dict(FILTER_DEFAULTS)
+        if self._settingPresent('load_filter_profiles'):
+            profile.update(self._getSetting('load_filter_profiles').get(probe_type, {}))
+        return profile
+    
+    
+    def _createLoadFilter(self, filter_profile):
+        if filter_profile is None:
+            return
+        return loadFilter.fromProfile(self.getLoadFilterProfile(filter_profile))
+    
+    
+    def _pressed(self, load, threshold, load_filter=None):
+        """
+        Whether the load reading triggers the probe.
+        """
+        if load_filter is None:
+            return load >= threshold
+        return load_filter.feed([time.time()], [load], threshold) is not None
+    
+    
+    def _moveDownUntilPressPredicted(self, step, threshold, z_predicted, z_max=180, tare=True, 
+                                     continuous=False, refine=False, filter_profile=None):
+        """
+        moveDownUntilPress() starting near the expected contact. The robot moves at full speed
+        to PROBE_MARGIN above z_predicted, approaches with PROBE_COARSE_STEP steps, and
+        bisects the last step down to the step precision. With refine, the threshold Z is then
+        interpolated from the fitted curve of all the readings.
+        The load filter is used for the approach; the bisection compares the raw readings, as
+        they are taken at different heights.
+        """
+        if tare:
+            self._tareBeforeProbe()
+        curve = forceCurve() if refine else None
+        load_filter = self._createLoadFilter(filter_profile)
+        z_start = self.getPosition(axis='Z')
+        z_window_start = min(z_predicted - PROBE_MARGIN, z_max)
+        z_window_end = min(z_predicted + PROBE_MARGIN, z_max)
+        if z_window_start > z_start:
+            self.moveAxis('Z', z_window_start)
+        z_free = self.getPosition(axis='Z')
+        if self._pressed(self._readProbeLoad(z_free, curve), threshold, load_filter):
+            if z_free == z_start:
+                return z_start
+            logging.info("Touched above the expected Z %s; searching from the start.", z_predicted)
+            self.moveAxis('Z', z_start)
+            return self.moveDownUntilPress(step, threshold, z_max=z_max, tare=False, continuous=continuous, 
+                                           refine=refine, filter_profile=filter_profile)
+        if continuous and self.load_stream is not None:
+            return self._moveDownUntilPressContinuous(step, threshold, z_max=z_max, tare=False, 
+                                                      filter_profile=filter_profile)
+        
+        # Approaching with coarse steps
+        coarse_step = max(step, PROBE_COARSE_STEP)
+        z_touch = None
+        z = z_free
+        while z < z_window_end:
+            z = min(round(z + coarse_step, 4), z_window_end)
+            self.moveAxis('Z', z)
+            if self._pressed(self._readProbeLoad(z, curve), threshold, load_filter):
+                z_touch = z
+                break
+            z_free = z
+        if z_touch is None:
+            logging.info("Nothing touched near the expected Z %s; searching further down.", z_predicted)
+            return self.moveDownUntilPress(step, threshold, z_max=z_max, tare=False, refine=refine, 
+                                           filter_profile=filter_profile)
+        
+        # Bisecting the last step; contact is between z_free and z_touch
+        while z_touch - z_free > step:
+            z = round((z_free + z_touch) / 2, 4)
+            self.moveAxis('Z', z)
+            if self._readProbeLoad(z, curve) >= threshold:
+                z_touch = z
+            else:
+                z_free = z
+        if curve is not None:
+            self._keepForceCurve(curve)
+            z_fit = curve.thresholdZ(threshold)
+            if z_fit is not None and z_free <= z_fit <= z_touch:
+                z_touch = round(z_fit, 4)
+        if z != z_touch:
+            # Ending pressing with the threshold force, like the step by step search
+            self.moveAxis('Z', z_touch)
+        return z_touch
+    
+    
+    def _readProbeLoad(self, z, curve=None):
+        """
+        Returns the combined load; also records the readings into the curve if one is provided.
+        """
+        if curve is None:
+            return self.getCombinedLoad()
+        left, right = self.readBothLoads()
+        curve.add(z, left, right)
+        return left + right
+    
+    
+    def _moveDownUntilPressRefined(self, step, threshold, z_max=180, tare=True, filter_profile=None):
+        """
+        moveDownUntilPress() recording (Z, left, right) at every step; the threshold Z is 
+        interpolated from the fitted load curve (see forcecurve). One short extra step is 
+        taken past the threshold for the fit (see _refineExtraStep).
+        """
+        load_filter = self._createLoadFilter(filter_profile)
+        if tare:
+            self._tareBeforeProbe()
+        curve = forceCurve()
+        z = self.getPosition(axis='Z')
+        z_pressed = None
+        while True:
+            load = self._readProbeLoad(z, curve)
+            if z_pressed is not None:
+                # The extra reading is taken
+                break
+            if self._pressed(load, threshold, load_filter):
+                z_pressed = z
+                extra = self._refineExtraStep(curve, step, threshold)
+                if extra <= 0 or z + extra > z_max:
+                    break
+                z = round(z + extra, 4)
+            elif z >= z_max:
+                break
+            else:
+                z = round(z + step, 4)
+            self.moveAxis('Z', z)
+        self._keepForceCurve(curve)
+        if z_pressed is None:
+            return z
+        z_fit = curve.thresholdZ(threshold)
+        if z_fit is None:
+            # Not enough readings for the fit; taking the first step reaching the threshold
+            if z != z_pressed:
+                z = z_pressed
+                self.moveAxis('Z', z)
+            return z
+        z_fit = round(min(max(z_fit, curve.rows[0][0]), z), 4)
+        self.moveAxis('Z', z_fit)
+        return z_fit
+    
+    
+    def _refineExtraStep(self, curve, step, threshold):
+        """
+        Length of the step past the threshold of a refined probe: REFINE_EXTRA_STEP_SHARE of 
+        the step, shortened so the load, extrapolated from the last two readings, does not 
+        exceed REFINE_FORCE_CEILING times the threshold. 0 if it is exceeded already.
+        """
+        extra = step * REFINE_EXTRA_STEP_SHARE
+        if len(curve.rows) >= 2:
+            (z_0, left_0, right_0), (z_1, left_1, right_1) = curve.rows[-2:]
+            if z_1 > z_0:
+                slope = ((left_1 + right_1) - (left_0 + right_0)) / (z_1 - z_0)
+                if slope > 0:
+                    extra = min(extra, (threshold * REFINE_FORCE_CEILING - (left_1 + right_1)) / slope)
+        return round(max(extra, 0), 4)
+    
+    
+    def recordForceCurves(self, directory=None):
+        """
+        Saves the load readings of every refined probe (moveDownUntilPress with refine=True)
+        into the directory, one CSV file per probe. None to stop saving them.
+        The last probe readings are always kept in last_force_curve.
+        """
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.force_curve_dir = directory
+    
+    
+    def _keepForceCurve(self, curve):
+        self.last_force_curve = curve
+        if self.force_curve_dir is None:
+            return
+        self._force_curve_number += 1
+        file_name = 'probe_%s_%04d.csv' % (time.strftime('%Y%m%d_%H%M%S'), self._force_curve_number)
+        curve.save(os.path.join(self.force_curve_dir, file_name))
+    
+    
+    def _moveDownUntilPressContinuous(self, step, threshold, z_max=180, tare=True, filter_profile=None):
+        """
+        moveDownUntilPress() with one move towards z_max, watching the streamed load readings.
+        The speed is chosen so Z travels no more than step between two readings.
+        """
+        if tare:
+            self._tareBeforeProbe()
+        z = self.getPosition(axis='Z')
+        if (self.getCombinedLoad() >= threshold) or (z >= z_max):
+            return z
+        speed = min(step / self.load_stream.sampleInterval() * 60, self.getSpeedZ())
+        self.writeAndWaitCartesian('G1 Z%s F%s' % (z_max, round(speed, 2)))
+        reading = self.load_stream.waitForThreshold(threshold, 
+                                                    timeout=(z_max - z) / speed * 60 + PROBE_EXTRA_TIME, 
+                                                    load_filter=self._createLoadFilter(filter_profile))
+        if reading is None:
+            # Nothing touched on the way down
+            self._finishMove('Z')
+            return self.getPosition(axis='Z')
+        x, y, z, a = self.haltCartesian()
+        return z
+    
+    
+    def haltCartesian(self):
+        """
+        Stops the motion at once, dropping all the queued moves, and unlocks the smoothieboard.
+        The position is read from the controller afterwards.
+        
+        Returns
+            (x, y, z, a) position where the robot stopped
+        """
+        with self._portLock(self.cartesian_port):
+            if self.streaming_window:
+                # Moves sent already are dropped by the controller, but their "ok" are expected
+                self._collectCartesianAcks(0)
+            self._write(self.cartesian_port, HALT_CHARACTER, eol='')
+            message = self._readUntilMatch(self.cartesian_port, HALT_REPLY_END, timeout=HALT_TIMEOUT)
+            if message is None:
+                logging.warning("Smoothieboard did not report halting.")
+            self._writeAndWait(port=self.cartesian_port, expression='$X', eol='\r', confirm_message='ok\n')
+        self.invalidatePosition()
+        return self.resyncPosition()
         
     
-    def moveToWell(self, rack_name, column, row, save_height=20):
+    def moveToWell(self, rack_name, column, row, save_height=20, tare_on_the_way=False):
         """
         Moves the robot to the specified well in the rack.
         Inputs:
@@ -1732,6 +3038,9 @@ class robot(data):
                 Height at which robot will not hit anything. 
                 Specified relative to the rack top, which is obtained by the command rack.getZ()
                 For example, value 20 (default) means that the robot will stop 20 mm above the rack.
+            tare_on_the_way
+                If True, the load cells are zeroed during the travel, for the probe that follows 
+                (see startTare).
         """
         # Current Z position
         z = self.getPosition(axis='Z')
@@ -1743,6 +3052,8 @@ class robot(data):
         # Checking whether I need to raise Z axis before movement
         if z > z_safe:
             self.moveAxis(axis='Z', dist=z_safe)
+        if tare_on_the_way:
+            self.startTare()
         # Obtaining well coordinates
         x, y = r.calcWellXY(column=column, row=row)
         # Moving towards the well
@@ -1750,7 +3061,7 @@ class robot(data):
         return self.getPosition()
 
 
-    def moveToSample(self, sample, z=None, z_hop=10):
+    def moveToSample(self, sample, z=None, z_hop=10, tare_on_the_way=False):
         """
         Moves XYZ towards a specified sample.
         
@@ -1763,6 +3074,9 @@ class robot(data):
                 the value is taken from sample object as the top of the sample.
             z_hop
                 Level at which to raise Z above the sample safe Z.
+            tare_on_the_way
+                If True, the load cells are zeroed during the travel, for the probe that follows 
+                (see startTare).
         """
         x, y = sample.getCenterXY()
         if z is None:
@@ -1772,6 +3086,8 @@ class robot(data):
         z_safe = z - z_hop
         if z_current > z_safe:
             self.moveAxis(axis='Z', dist=z_safe)
+        if tare_on_the_way:
+            self.startTare()
         self.move(x, y, z, z_first=False)
 
 # ==============================================================================
@@ -1810,17 +3126,28 @@ class robot(data):
             #self.moveAxisDelta('Z', z_retract)
             self.moveAxisDelta(axis, step*direction)
             z_trigger = self.moveDownUntilPress(step=z_increment, 
-                            threshold=z_threshold, z_max=initial_z+depth)
+                            threshold=z_threshold, z_max=initial_z+depth, refine=True, 
+                            filter_profile='stair')
             #print (z_trigger, abs(initial_z - z_trigger), z_max_travel)           
         stair_coord = self.getPosition(axis=axis)
         return stair_coord
 
     
-    def scanForStairFine(self, axis, direction):
+    def scanForStairFine(self, axis, direction, continuous=False):
+        """
+        Finds the stair with the steps from stair_finding_step_list, each finer one starting 
+        one step back from where the previous one found it.
         
+        If continuous is True and the load readings are streamed (see startLoadCellStreaming),
+        the first pass is one slide along the surface instead (see _slideToStair).
+        """
         step_list, z_increment, z_retract, z_max_travel, z_threshold = self.getPositioningParameters()
         
         initial_z = self.moveDownUntilPress(step=z_increment, threshold=z_threshold)
+        if continuous and self.load_stream is not None:
+            coord = self._slideToStair(axis, direction, initial_z)
+            if coord is not None:
+                return coord
         self.moveAxisDelta('Z', z_retract)
         
         for step in step_list:
@@ -1834,8 +3161,67 @@ class robot(data):
         return coord
         
     
+    def _slideToStair(self, axis, direction, z_surface):
+        """
+        Finds the stair in one move: the pipette, pressed on the surface at z_surface, is lifted 
+        to STAIR_SLIDE_PRELOAD, slides along the axis until the streamed load drops, and is 
+        halted there. The stair is then refined once with the finest step of 
+        stair_finding_step_list, starting one coarse step back from where the load dropped.
+        
+        Returns
+            Stair coordinate, like scanForStair(); None if the load did not drop within 
+            STAIR_SWEEP_DISTANCE.
+        """
+        step_list, z_increment, z_retract, z_max_travel, z_threshold = self.getPositioningParameters()
+        fine_step = step_list[-1]
+        self._liftToPreload(z_surface, z_increment, z_retract)
+        release = self.getCombinedLoad() * STAIR_RELEASE_SHARE
+        start = self.getPosition(axis=axis)
+        target = start + STAIR_SWEEP_DISTANCE * direction
+        # The pipette slides no more than the finest step between two load readings
+        speed = min(fine_step / self.load_stream.sampleInterval() * 60, self.getSpeed(axis))
+        # Start of the slide in the time of the readings; the newest one is not older than one reading
+        start_time = self.load_stream.latest()[0]
+        self.writeAndWaitCartesian('G1 %s%s F%s' % (axis, target, round(speed, 2)))
+        reading = self.load_stream.waitForThreshold(release, 
+                                                    timeout=STAIR_SWEEP_DISTANCE / speed * 60 + PROBE_EXTRA_TIME, 
+                                                    load_filter=self._createLoadFilter('stair'), below=True)
+        if reading is None:
+            logging.warning("No stair found sliding %s mm along %s; scanning by steps.", 
+                            STAIR_SWEEP_DISTANCE, axis)
+            self._finishMove(axis)
+            self.resyncPosition()
+            return
+        self.haltCartesian()
+        # Where the load dropped; the pipette travelled on while the halt was sent
+        slid = min(max(reading[0] - start_time, 0) * speed / 60, STAIR_SWEEP_DISTANCE)
+        trigger_coord = start + slid * direction
+        # Lifting above the surface before moving back over it
+        self.moveAxis('Z', z_surface + z_retract)
+        self.moveAxis(axis, round(trigger_coord - step_list[0]*direction, 4))
+        return self.scanForStair(axis=axis, step=fine_step, direction=direction)
+    
+    
+    def _liftToPreload(self, z_surface, z_increment, z_retract):
+        """
+        Lifts the pipette pressed on the surface at z_surface by z_increment steps, until the 
+        load is not above STAIR_SLIDE_PRELOAD, but no higher than z_surface + z_retract.
+        Stays one step lower if the pipette almost leaves the surface.
+        """
+        z = z_surface
+        load = self.getCombinedLoad()
+        while (load > STAIR_SLIDE_PRELOAD) and (z - z_increment > z_surface + z_retract):
+            self.moveAxis('Z', round(z - z_increment, 4))
+            load = self.getCombinedLoad()
+            if load < STAIR_SLIDE_PRELOAD * STAIR_RELEASE_SHARE:
+                self.moveAxis('Z', z)
+                return z
+            z = round(z - z_increment, 4)
+        return z
+    
+    
     # TODO: remove this function
-    def findCenter(self, axis, distance, how='inner'):
+    def findCenter(self, axis, distance, how='inner', continuous=False):
         """
         Find an exact center of a hole. The pipette is expected to be approximately in
         the middle of the object.
@@ -1850,6 +3236,8 @@ class robot(data):
                 Values may be 'inner' or 'outer'. 'inner' is used in case if feature is a hole, such
                 as a tube hole in a rack. 'outer' is used when one need to measure a solid object,
                 such as a rack itself, or a capped tube.
+            continuous
+                If True, the edges are found sliding along the surface (see scanForStairFine).
                 
         """
         if how == 'inner':
@@ -1867,14 +3255,14 @@ class robot(data):
         edge_1_approx = approx_center - distance/2.0
         edge_2_approx = approx_center + distance/2.0
         self.moveAxis(axis, edge_1_approx)
-        edge_1 = self.scanForStairFine(axis, direction=direction)
+        edge_1 = self.scanForStairFine(axis, direction=direction, continuous=continuous)
         self.moveAxis(axis, edge_2_approx)
-        edge_2 = self.scanForStairFine(axis, direction=-direction)
+        edge_2 = self.scanForStairFine(axis, direction=-direction, continuous=continuous)
         center = (edge_1 + edge_2)/2.0
         return center
 
 
-    def _findCenterXY(self, x1, x2, y1, y2, how, lift_z):
+    def _findCenterXY(self, x1, x2, y1, y2, how, lift_z, continuous=False):
         """
         Using coordinates of the object edge, find a center of this object
         """
@@ -1894,16 +3282,16 @@ class robot(data):
         # Moving towards the rack
         self.moveAxis(axis='Z', dist=0) # Moving Z to 0 so I don't hit anything
         self.move(x1[0], x1[1], x1[2], z_first=False)
-        x_edge_1 = self.scanForStairFine('X', direction=direction)
+        x_edge_1 = self.scanForStairFine('X', direction=direction, continuous=continuous)
         self.moveAxisDelta('Z', lift_z)
         self.move(x2[0], x2[1], x2[2], z_first=False)
-        x_edge_2 = self.scanForStairFine('X', direction=-direction)
+        x_edge_2 = self.scanForStairFine('X', direction=-direction, continuous=continuous)
         self.moveAxisDelta('Z', lift_z)
         self.move(y1[0], y1[1], y1[2], z_first=False)
-        y_edge_1 = self.scanForStairFine('Y', direction=direction)
+        y_edge_1 = self.scanForStairFine('Y', direction=direction, continuous=continuous)
         self.moveAxisDelta('Z', lift_z)
         self.move(y2[0], y2[1], y2[2], z_first=False)
-        y_edge_2 = self.scanForStairFine('Y', direction=-direction)
+        y_edge_2 = self.scanForStairFine('Y', direction=-direction, continuous=continuous)
         
         x_center = (x_edge_1 + x_edge_2) / 2.0
         y_center = (y_edge_1 + y_edge_2) / 2.0
@@ -1911,9 +3299,11 @@ class robot(data):
         return x_center, y_center
         
         
-    def calibrateRack(self, rack):
+    def calibrateRack(self, rack, continuous=True):
         """
         Calibrates a selected rack. Possible rack values: 'samples', 'waste', 'tips', 'reagents'.
+        If continuous is True and the load readings are streamed (see startLoadCellStreaming),
+        the rack edges are found sliding along the surface (see scanForStairFine).
         """
         
         r = self._getRackObjectByName(rack_name=rack)
@@ -1923,7 +3313,7 @@ class robot(data):
         lift_z = r.getCalibrationLiftZ()
         
         # Finding object center
-        x_center, y_center = self._findCenterXY(x1, x2, y1, y2, how, lift_z)
+        x_center, y_center = self._findCenterXY(x1, x2, y1, y2, how, lift_z, continuous=continuous)
         
         # Depends on whether robot found a center of the rack, or a center of the well, 
         # the center of the rack is calculated and saved.
@@ -1931,6 +3321,9 @@ class robot(data):
             r.setCenterXY(x=x_center, y=y_center)
         elif how == 'well':
             r.calcCenterFromWellXY(x=x_center, y=y_center)
+        if isinstance(r, consumable):
+            # The tip offset learned with the old calibration does not apply anymore
+            r.setTipOffsetXY(0, 0)
         
         x_for_z_calibr, y_for_z_calibr = r.getZCalibrationXY(which='absolute')
         
@@ -1983,9 +3376,9 @@ class rack(data):
         Sets rack center; x and y.
         """
         if x is not None:
-            self._setSetting('center_x', x)
+            self._setSetting('center_x', x, sync=True)
         if y is not None:
-            self._setSetting('center_y', y)
+            self._setSetting('center_y', y, sync=True)
             
     def getCenterXY(self):
         return self._getSetting('center_x'), self._getSetting('center_y')
@@ -2023,7 +3416,7 @@ class rack(data):
         Sets the value at which pipette without a tip touches the top of the rack,
         detected by the load cells.
         """
-        self._setSetting('detected_z', z)
+        self._setSetting('detected_z', z, sync=True)
         
     def getZ(self, added_length=0):
         """
@@ -2287,6 +3680,8 @@ class consumable(rack):
     Handles rack of consumables (such as a rack of tips).
     """
     
+    journaled_settings = ('unused_consumable_list',)
+    
     def refill(self):
         """
         Marks all possible wells of the consumable as "full", or "ready to use".
@@ -2299,7 +3694,8 @@ class consumable(rack):
         for i in range(cols):
             for j in range(rows):
                 unused_consumable_list.append([i, j])
-        self._setSetting('unused_consumable_list', unused_consumable_list)
+        # Written at once, like the calibration: the new rack must not be forgotten
+        self._setSetting('unused_consumable_list', unused_consumable_list, sync=True)
 
     
     def _getReadyList(self):
@@ -2314,21 +3710,15 @@ class consumable(rack):
         Removes an item from the list of ready consumables.
         Happens, for instance, when the tip is picked up.
         """
-        unused_consumable_list = self._getReadyList()
-        try:
-            unused_consumable_list.remove([col, row])
-        except:
-            pass
-        self._setSetting('unused_consumable_list', unused_consumable_list)
+        # Journaled as the item alone, not the whole list
+        self._removeFromSetting('unused_consumable_list', [col, row])
         
     def add(self, col, row):
         """
         Adds a consumable to the list of ready consumables.
         Use when you command a robot to place a tip back into the rack
         """
-        unused_consumable_list = self._getReadyList()
-        unused_consumable_list.append([col, row])
-        self._setSetting('unused_consumable_list', unused_consumable_list)
+        self._addToSetting('unused_consumable_list', [col, row])
         
     def next(self, consume=True):
         """
@@ -2390,6 +3780,25 @@ class consumable(rack):
         return self._getSetting('tip_pickup_dz')
     
     
+    def setTipOffsetXY(self, x, y):
+        """
+        Sets the XY offset from the calibrated tip positions, at which the tips were found 
+        by the tip search (robot.lookForTip). Added to every tip pickup; reset by the 
+        rack calibration.
+        """
+        self._setSetting('tip_offset_xy', [round(x, 4), round(y, 4)], sync=True)
+    
+    def getTipOffsetXY(self):
+        """
+        Returns the XY offset from the calibrated tip positions, learned by the tip search; 
+        (0, 0) if none.
+        """
+        if self._settingPresent('tip_offset_xy'):
+            x, y = self._getSetting('tip_offset_xy')
+            return x, y
+        return 0, 0
+    
+    
     def setRaiseWithTipdZ(self, raise_with_tip_dz):
         self._setSetting('raise_with_tip_dz', raise_with_tip_dz)
         
@@ -2402,10 +3811,8 @@ def getBeadsVolumeCoef():
     Returns the coefficients for transforming the DNA size to beads volume.
     """
     
-    temp_robot_data_obj = data(name='robot')
-    coef_dict = temp_robot_data_obj._getSetting('DNAsize_to_Vbeads')
+    coef_dict = data.shared('robot')._getSetting('DNAsize_to_Vbeads')
     a = coef_dict['a']
     b = coef_dict['b']
     c = coef_dict['c']
-    del temp_robot_data_obj
     return a, b, c
\ No newline at end of file
@@ -51,6 +51,7 @@ if __name__ == '__main__':
     logging.info("Robot homing started")
     ber = bl.robot()
     ber.home()
+    ber.startLoadCellStreaming()
     logging.info("Robot homing finished")
     print("The pipette should now be in the top right corner. The working area should be on the back. ")
     homing_success = input("Press y and enter if this happened: ")
@@ -86,6 +87,7 @@ if __name__ == '__main__':
         del ber
         ber = bl.robot(tips_type='new')
         ber.home()
+        ber.startLoadCellStreaming()
         ber.calibrateRack(rack='tips')
         print("Mettler Toledo tips rack calibration finished.")
         
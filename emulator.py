@@ -0,0 +1,667 @@
+import re
+import math
+import time
+import random
+import threading
+import collections
+
+import serial
+
+# Local files
+from serialcomm import registerTransport
+from serialcomm import unregisterTransport
+
+
+"""
+In-process emulation of the robot controllers, for running and profiling the protocols
+without hardware.
+
+    vr = emulator.virtualRobot(time_scale=0)
+    cartesian_port_name, loadcell_port_name = vr.register()
+    ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+
+smoothieEmulator speaks the smoothieware dialect used by bernielib (G0/G1, G28.2, $H, M400,
+M17/M18, M280, M42/M43, '?', ctrl-X and $X); moves take time according to their feed rate.
+loadCellEmulator speaks the commands of firmware_arduino/bernie.ino (T, RR, RL, RB, S, version);
+the loads are produced by virtualDeck from the current position of the pipette.
+
+Part of BernieLib.
+"""
+
+
+# Smoothie acknowledges a command this long after receiving it, seconds
+SMOOTHIE_LATENCY = 0.001
+# Moves the smoothie planner keeps queued; "ok" for the next move waits for a free slot
+PLANNER_QUEUE_SIZE = 32
+# Homing feed rate, mm/min
+HOMING_FEED = 3000
+# Feed rate until the first F word, mm/min
+DEFAULT_FEED = 1000
+SMOOTHIE_VERSION = "Build version: emulator, Build date: -, MCU: LPC1769, System Clock: 100MHz"
+# Real time command stopping the motion
+SMOOTHIE_HALT = '\x18'
+
+# Arduino processes the command after no more characters arrive for Serial.setTimeout(20)
+LOADCELL_FRAME_TIMEOUT = 0.02
+# HX711 at its default 10 samples per second
+LOADCELL_SAMPLE_PERIOD = 0.1
+# HX711 tare() averages that many samples
+LOADCELL_TARE_SAMPLES = 10
+# Streamed readings produced at once after the port was not read for a long time;
+# the older ones are lost
+LOADCELL_STREAM_BACKLOG = 64
+LOADCELL_VERSION = "Bernie's load cells controller"
+
+# Default surface stiffness, load units (approx. grams) per mm of pressing
+DEFAULT_STIFFNESS = 2000
+
+GCODE_WORD_RE = re.compile(r'([A-Z])([-+]?[\d.]+)')
+AXES = ('X', 'Y', 'Z', 'A')
+
+
+class virtualDeck():
+    """
+    Surfaces the pipette can press on. Z axis points down, so a surface at z=150 is touched
+    when the pipette is lowered to Z coordinate 150; pressing further creates the load.
+    """
+
+    def __init__(self, floor_z=None, stiffness=DEFAULT_STIFFNESS):
+        """
+        Inputs
+            floor_z
+                Z coordinate of the surface covering the whole deck. None for no floor.
+            stiffness
+                Load per mm of pressing into the floor.
+        """
+        self.surfaces = []
+        if floor_z is not None:
+            self.addSurface(floor_z, stiffness=stiffness)
+
+
+    def addSurface(self, z, x_range=None, y_range=None, stiffness=DEFAULT_STIFFNESS, left_share=0.5):
+        """
+        Adds a horizontal surface.
+
+        Inputs
+            z
+                Z coordinate of the surface.
+            x_range, y_range
+                (min, max) area of the surface; None for unlimited.
+            stiffness
+                Load per mm of pressing into the surface.
+            left_share
+                Part of the load taken by the left load cell; the rest goes to the right one.
+                Values other than 0.5 emulate pressing off the pipette axis.
+        """
+        self.surfaces.append({'z': z, 'x_range': x_range, 'y_range': y_range,
+                              'stiffness': stiffness, 'left_share': left_share})
+
+
+    def loads(self, x, y, z):
+        """
+        Returns (left, right) loads at the pipette position.
+        """
+        left = 0
+        right = 0
+        for surface in self.surfaces:
+            if not _inRange(x, surface['x_range']) or not _inRange(y, surface['y_range']):
+                continue
+            depth = z - surface['z']
+            if depth <= 0:
+                continue
+            load = depth * surface['stiffness']
+            left += load * surface['left_share']
+            right += load * (1 - surface['left_share'])
+        return left, right
+
+
+def _inRange(value, value_range):
+    if value_range is None:
+        return True
+    return value_range[0] <= value <= value_range[1]
+
+
+class emulatedDevice():
+    """
+    Base of the emulated controllers. Receives bytes written to the port;
+    returns replies as the list of (time when the reply is sent, bytes).
+    """
+
+    def __init__(self, time_scale=1.0):
+        """
+        Inputs
+            time_scale
+                Multiplier for all the emulated delays; 0 to make everything instant.
+        """
+        self.time_scale = time_scale
+        self.command_counts = collections.Counter()
+        self.lock = threading.RLock()
+
+
+    def delay(self, seconds):
+        return seconds * self.time_scale
+
+
+    def countCommand(self, command):
+        words = command.split()
+        opcode = words[0] if words else ''
+        self.command_counts[opcode] += 1
+
+
+    def receive(self, data, now):
+        raise NotImplementedError
+
+
+    def streamUntil(self, now):
+        """
+        Returns the messages the device sends by itself up to now, as (time, bytes).
+        """
+        return []
+
+
+    def nextStreamTime(self):
+        """
+        Time of the next message sent by the device itself; None if there will be none.
+        """
+        return
+
+
+class smoothieEmulator(emulatedDevice):
+    """
+    Smoothieboard with the X, Y, Z and pipette (A) axes.
+    Motion is planned as straight segments executed one after another at their feed rates.
+    """
+
+    def __init__(self, time_scale=1.0, home_position=None, latency=SMOOTHIE_LATENCY,
+                 planner_queue_size=PLANNER_QUEUE_SIZE):
+        super().__init__(time_scale)
+        if home_position is None:
+            home_position = {axis: 0.0 for axis in AXES}
+        self.home_position = dict(home_position)
+        self.latency = latency
+        self.planner_queue_size = planner_queue_size
+        self.feed = DEFAULT_FEED
+        self.relative = False
+        # Position at the end of the last finished segment
+        self.settled_position = dict(self.home_position)
+        # Planned moves: [(start time, end time, start position, end position)]
+        self.segments = []
+        self.servo_angles = {}
+        self.rack_power = False
+        self.fan = False
+        self.steppers_enabled = set(AXES)
+        # After ctrl-X, moves are refused until $X
+        self.halted = False
+        self._input = ''
+
+
+    def receive(self, data, now):
+        replies = []
+        with self.lock:
+            text = data.decode('utf-8', 'replace')
+            if SMOOTHIE_HALT in text:
+                # Executed on arrival, not queued like the lines
+                text = text.replace(SMOOTHIE_HALT, '')
+                replies += self.halt(now)
+            self._input += text
+            lines = re.split('[\r\n]', self._input)
+            self._input = lines.pop()
+            for line in lines:
+                replies += self.execute(line.strip(), now)
+        return replies
+
+
+    def motionEnd(self):
+        if self.segments:
+            return self.segments[-1][1]
+        return 0
+
+
+    def _prune(self, now):
+        while self.segments and self.segments[0][1] <= now:
+            self.settled_position = self.segments.pop(0)[3]
+
+
+    def targetPosition(self):
+        """
+        Position at the end of all the planned moves.
+        """
+        if self.segments:
+            return dict(self.segments[-1][3])
+        return dict(self.settled_position)
+
+
+    def positionAt(self, now):
+        """
+        Position of the axes at the given time, interpolated along the current segment.
+        """
+        with self.lock:
+            position = self.settled_position
+            for start_time, end_time, start, end in self.segments:
+                if end_time <= now:
+                    position = end
+                    continue
+                if start_time >= now:
+                    break
+                fraction = (now - start_time) / (end_time - start_time)
+                return {axis: start[axis] + (end[axis] - start[axis]) * fraction for axis in AXES}
+            return dict(position)
+
+
+    def _plan(self, target, feed, now):
+        """
+        Adds a straight move to the planner. Returns the time the move is accepted into the queue.
+        """
+        self._prune(now)
+        start = self.targetPosition()
+        distance = math.sqrt(sum((target[axis] - start[axis]) ** 2 for axis in AXES))
+        accepted = now
+        if len(self.segments) >= self.planner_queue_size:
+            # Planner queue is full; the move is accepted when the oldest ones finish
+            accepted = self.segments[-self.planner_queue_size][1]
+        if distance == 0:
+            return accepted
+        start_time = max(accepted, self.motionEnd())
+        end_time = start_time + self.delay(distance / (feed / 60.0))
+        if end_time <= start_time:
+            # Instant move
+            self.settled_position = dict(target)
+            self.segments = []
+            return accepted
+        self.segments.append((start_time, end_time, start, dict(target)))
+        return accepted
+
+
+    def halt(self, now):
+        """
+        Stops the axes where they are at the moment and drops the planned moves.
+        """
+        self.settled_position = self.positionAt(now)
+        self.segments = []
+        self._input = ''
+        self.halted = True
+        return [(now + self.delay(self.latency), b'ALARM: Abort during cycle\r\n')]
+
+
+    def _ok(self, at_time):
+        return [(at_time + self.delay(self.latency), b'ok\n')]
+
+
+    def _status(self, now):
+        position = self.positionAt(now)
+        state = 'Run' if self.segments and self.motionEnd() > now else 'Idle'
+        if self.halted:
+            state = 'Alarm'
+        coords = ','.join('%.4f' % position[axis] for axis in AXES)
+        work_coords = ','.join('%.4f' % position[axis] for axis in AXES[:3])
+        message = 'ok\n<%s|MPos:%s|WPos:%s|F:%.1f,100.0>\n' % (state, coords, work_coords, self.feed)
+        return [(now + self.delay(self.latency), message.encode())]
+
+
+    def execute(self, command, now):
+        """
+        Executes one line of G-code. Returns the replies.
+        """
+        self.countCommand(command)
+        if command == '':
+            return self._ok(now)
+        if command == '?':
+            return self._status(now)
+        if command == 'version':
+            return [(now + self.delay(self.latency), (SMOOTHIE_VERSION + '\r\nok\n').encode())]
+        if command == '$X':
+            self.halted = False
+            return [(now + self.delay(self.latency), b'[Caution: Unlocked]\r\nok\n')]
+        if self.halted:
+            return [(now + self.delay(self.latency), b'!!\r\n')]
+        upper = command.upper()
+        words = upper.split()
+        opcode = words[0]
+        params = {letter: float(value) for letter, value in GCODE_WORD_RE.findall(' '.join(words[1:]))}
+        if opcode in ('G0', 'G1'):
+            if 'F' in params:
+                self.feed = params['F']
+            target = self.targetPosition()
+            for axis in AXES:
+                if axis in params:
+                    target[axis] = target[axis] + params[axis] if self.relative else params[axis]
+            return self._ok(self._plan(target, self.feed, now))
+        if opcode == 'G90':
+            self.relative = False
+        elif opcode == 'G91':
+            self.relative = True
+        elif opcode in ('G28', 'G28.2', '$H'):
+            homed = [axis for axis in AXES if axis in upper[len(opcode):]] or list(AXES)
+            if opcode == '$H':
+                homed = list(AXES)
+            target = self.targetPosition()
+            for axis in homed:
+                target[axis] = self.home_position[axis]
+            accepted = self._plan(target, HOMING_FEED, now)
+            if opcode == '$H':
+                # Homing blocks until finished
+                return self._ok(max(accepted, self.motionEnd()))
+            return self._ok(accepted)
+        elif opcode == 'M400':
+            self._prune(now)
+            return self._ok(max(now, self.motionEnd()))
+        elif opcode in ('M280', 'M280.1'):
+            self.servo_angles[opcode] = params.get('S')
+        elif opcode == 'M42':
+            self.rack_power = True
+        elif opcode == 'M43':
+            self.rack_power = False
+        elif opcode == 'M106':
+            self.fan = True
+        elif opcode == 'M107':
+            self.fan = False
+        elif opcode == 'M17':
+            self.steppers_enabled = set(AXES)
+        elif opcode == 'M18':
+            for axis in AXES:
+                if axis in params:
+                    self.steppers_enabled.discard(axis)
+        return self._ok(now)
+
+
+class loadCellEmulator(emulatedDevice):
+    """
+    Arduino with two HX711 load cells (firmware_arduino/bernie.ino). The loads are taken
+    from the deck at the current pipette position.
+    """
+
+    def __init__(self, smoothie, deck, time_scale=1.0, noise=0,
+                 frame_timeout=LOADCELL_FRAME_TIMEOUT, sample_period=LOADCELL_SAMPLE_PERIOD,
+                 combined_read=True, protocol=2, streaming=True):
+        """
+        Inputs
+            smoothie
+                smoothieEmulator, source of the pipette position.
+            deck
+                virtualDeck, source of the loads.
+            noise
+                Standard deviation of the reading noise.
+            combined_read
+                Whether the firmware has RB command; False emulates older firmware.
+            protocol
+                Command protocol version; from 2, commands ending with new line are executed
+                without waiting for the serial timeout.
+            streaming
+                Whether the firmware has S command for streaming the readings.
+        """
+        super().__init__(time_scale)
+        self.smoothie = smoothie
+        self.deck = deck
+        self.noise = noise
+        self.frame_timeout = frame_timeout
+        self.sample_period = sample_period
+        self.offset_left = 0
+        self.offset_right = 0
+        self.combined_read = combined_read
+        self.protocol = protocol
+        self.streaming = streaming
+        self.sample_counter = 0
+        # Commands are only processed one after another
+        self.busy_until = 0
+        # Time of the next streamed reading; None when not streaming
+        self.next_stream_time = None
+
+
+    def rawLoads(self, now):
+        position = self.smoothie.positionAt(now)
+        left, right = self.deck.loads(position['X'], position['Y'], position['Z'])
+        if self.noise:
+            left += random.gauss(0, self.noise)
+            right += random.gauss(0, self.noise)
+        return left, right
+
+
+    def receive(self, data, now):
+        # The firmware reads everything arrived within its serial timeout as one command,
+        # or, since protocol 2, up to the new line.
+        terminated = self.protocol >= 2 and data.endswith(b'\n')
+        command = data.decode('utf-8', 'replace').strip()
+        with self.lock:
+            return self.execute(command, now, terminated)
+
+
+    def _streamPeriod(self):
+        # Instant emulation still streams at a finite rate
+        return max(self.delay(self.sample_period), 0.001)
+
+
+    def streamUntil(self, now):
+        with self.lock:
+            if self.next_stream_time is None:
+                return []
+            period = self._streamPeriod()
+            backlog_start = now - period * LOADCELL_STREAM_BACKLOG
+            if self.next_stream_time < backlog_start:
+                self.next_stream_time += math.ceil((backlog_start - self.next_stream_time) / period) * period
+            messages = []
+            while self.next_stream_time <= now:
+                at_time = self.next_stream_time
+                left, right = self.rawLoads(at_time)
+                self.sample_counter += 1
+                message = 'D %.2f %.2f %d\r\n' % (left - self.offset_left, right - self.offset_right,
+                                                   self.sample_counter)
+                messages.append((at_time, message.encode()))
+                self.next_stream_time += period
+            return messages
+
+
+    def nextStreamTime(self):
+        return self.next_stream_time
+
+
+    def _reply(self, start, duration, message):
+        self.busy_until = start + self.delay(duration)
+        return [(self.busy_until, (message + '\r\n').encode())]
+
+
+    def execute(self, command, now, terminated=False):
+        self.countCommand(command)
+        start = max(now, self.busy_until)
+        if not terminated:
+            start += self.delay(self.frame_timeout)
+        if command in ('T', 'T L', 'T R'):
+            left, right = self.rawLoads(start)
+            if command in ('T', 'T L'):
+                self.offset_left = left
+            if command in ('T', 'T R'):
+                self.offset_right = right
+            return self._reply(start, self.sample_period * LOADCELL_TARE_SAMPLES, 'ok/n')
+        if command == 'RL':
+            left, right = self.rawLoads(start)
+            return self._reply(start, self.sample_period, '%.2f' % (left - self.offset_left))
+        if command == 'RR':
+            left, right = self.rawLoads(start)
+            return self._reply(start, self.sample_period, '%.2f' % (right - self.offset_right))
+        if command == 'RB' and self.combined_read:
+            left, right = self.rawLoads(start)
+            self.sample_counter += 1
+            # Both HX711 convert at the same time
+            return self._reply(start, self.sample_period, '%.2f %.2f %d' % (
+                left - self.offset_left, right - self.offset_right, self.sample_counter))
+        if command in ('S on', 'S off') and self.streaming:
+            if command == 'S on':
+                self.next_stream_time = start + self._streamPeriod()
+                return self._reply(start, 0, 'Streaming on')
+            self.next_stream_time = None
+            return self._reply(start, 0, 'Streaming off')
+        if command == 'version':
+            if self.protocol >= 2:
+                return self._reply(start, 0, '%s, protocol %s' % (LOADCELL_VERSION, self.protocol))
+            return self._reply(start, 0, LOADCELL_VERSION)
+        # Unknown commands are ignored by the firmware
+        return []
+
+
+class emulatedPort():
+    """
+    Serial port connected to an emulated device; has the part of serial.Serial interface
+    used by bernielib.
+    """
+
+    def __init__(self, device, timeout=None):
+        self.device = device
+        self.timeout = timeout
+        self.is_open = True
+        self.bytes_written = 0
+        self.bytes_read = 0
+        # Received bytes ready to be read
+        self._buffer = bytearray()
+        # Replies not yet "arrived": [(time, bytes)]
+        self._scheduled = collections.deque()
+        self._condition = threading.Condition()
+
+
+    def _checkOpen(self):
+        if not self.is_open:
+            raise serial.SerialException("Attempting to use a port that is not open")
+
+
+    def _deliver(self, now):
+        arrived = []
+        while self._scheduled and self._scheduled[0][0] <= now:
+            arrived.append(self._scheduled.popleft())
+        arrived += self.device.streamUntil(now)
+        # Replies and streamed messages in the order they were sent
+        arrived.sort(key=lambda item: item[0])
+        for at_time, message in arrived:
+            self._buffer += message
+
+
+    def write(self, data):
+        self._checkOpen()
+        data = bytes(data)
+        self.bytes_written += len(data)
+        replies = self.device.receive(data, time.time())
+        with self._condition:
+            for at_time, reply in replies:
+                # The bytes arrive in the order they were sent
+                if self._scheduled:
+                    at_time = max(at_time, self._scheduled[-1][0])
+                self._scheduled.append((at_time, reply))
+            self._condition.notify_all()
+        return len(data)
+
+
+    @property
+    def in_waiting(self):
+        self._checkOpen()
+        with self._condition:
+            self._deliver(time.time())
+            return len(self._buffer)
+
+
+    def inWaiting(self):
+        return self.in_waiting
+
+
+    def read(self, size=1):
+        """
+        Returns up to size bytes, waiting for them no longer than the port timeout.
+        """
+        self._checkOpen()
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._condition:
+            while True:
+                now = time.time()
+                self._deliver(now)
+                if len(self._buffer) >= size or not self.is_open:
+                    break
+                waits = []
+                if deadline is not None:
+                    if now >= deadline:
+                        break
+                    waits.append(deadline - now)
+                if self._scheduled:
+                    waits.append(self._scheduled[0][0] - now)
+                stream_time = self.device.nextStreamTime()
+                if stream_time is not None:
+                    waits.append(stream_time - now)
+                self._condition.wait(min(waits) if waits else None)
+            self._checkOpen()
+            chunk = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._deliver(time.time())
+            self._buffer.clear()
+
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+
+    def reset_output_buffer(self):
+        pass
+
+
+    def close(self):
+        with self._condition:
+            self.is_open = False
+            self._condition.notify_all()
+
+
+class virtualRobot():
+    """
+    Smoothieboard and load cells controller emulators working on the same virtual deck.
+    """
+
+    def __init__(self, deck=None, time_scale=1.0, loadcell_noise=0):
+        """
+        Inputs
+            deck
+                virtualDeck; by default, a floor at Z=175 under the whole deck.
+            time_scale
+                1 for the real time moves and load cell readings; 0 for instant ones.
+        """
+        if deck is None:
+            deck = virtualDeck(floor_z=175)
+        self.deck = deck
+        self.smoothie = smoothieEmulator(time_scale=time_scale)
+        self.loadcells = loadCellEmulator(self.smoothie, self.deck, time_scale=time_scale,
+                                          noise=loadcell_noise)
+        self.ports = []
+        self.port_names = []
+
+
+    def _portFactory(self, device):
+        def factory(baudrate=None, timeout=None):
+            port = emulatedPort(device, timeout=timeout)
+            self.ports.append(port)
+            return port
+        return factory
+
+
+    def register(self, prefix='emulator'):
+        """
+        Makes the emulated controllers available to serialcomm.openPort().
+        Returns (cartesian port name, load cell port name) to pass to bernielib.robot().
+        """
+        cartesian_port_name = prefix + ':cartesian'
+        loadcell_port_name = prefix + ':loadcell'
+        registerTransport(cartesian_port_name, self._portFactory(self.smoothie))
+        registerTransport(loadcell_port_name, self._portFactory(self.loadcells))
+        self.port_names = [cartesian_port_name, loadcell_port_name]
+        return cartesian_port_name, loadcell_port_name
+
+
+    def unregister(self):
+        for port_name in self.port_names:
+            unregisterTransport(port_name)
+        self.port_names = []
+
+
+    def commandCounts(self):
+        """
+        Returns {'cartesian': Counter of G-code opcodes, 'loadcell': Counter of commands}
+        """
+        return {'cartesian': collections.Counter(self.smoothie.command_counts),
+                'loadcell': collections.Counter(self.loadcells.command_counts)}
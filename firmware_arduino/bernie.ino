@@ -3,6 +3,9 @@
 #include "HX711.h"
 
 #define INPUT_SIZE 30 // Max expected command size
+// Commands may end with a new line, so they are executed without waiting for the serial timeout.
+// Reported in reply to "version"; host sends new line only to firmware with protocol 2 or higher.
+#define PROTOCOL_VERSION 2
 
 #define DOUTR 3
 #define CLKR 2
@@ -17,6 +20,11 @@ float calibr_factor_r = 1000;
 float calibr_factor_l = -1000;
 
 int pos;
+// Number of readings sent with RB command; lets host tell a fresh reading from a repeated one
+unsigned long sample_counter = 0;
+// When true, both readings are sent as "D left right counter" lines every time
+// the load cells have a new conversion ready
+bool streaming = false;
 // pin 9 to base of Transistor
 int powerControl = 9;
 int servoPin = 8;
@@ -45,6 +53,8 @@ void setup() {
   Serial.println("Tare right load cell: T R");
   Serial.println("Get left load cell reading: RL");
   Serial.println("Get right load cell reading: RR");
+  Serial.println("Get both load cells readings: RB");
+  Serial.println("Stream both load cells readings: S on; stop: S off");
 
   pinMode(powerControl, OUTPUT);
   servo1.attach(servoPin);
@@ -58,17 +68,46 @@ void setup() {
   sensor_r.tare();
 }
 
+void streamReadings() {
+  // Not blocking on the conversion, so the commands are still served
+  if (sensor_l.is_ready() && sensor_r.is_ready())
+  {
+    float left = sensor_l.get_units();
+    float right = sensor_r.get_units();
+    sample_counter++;
+    Serial.print("D ");
+    Serial.print(left);
+    Serial.print(" ");
+    Serial.print(right);
+    Serial.print(" ");
+    Serial.println(sample_counter);
+  }
+}
+
 void loop() {
 //  input_string = Serial.readString();
 //  pos = input_string.toInt(); //transforming string to int
 //  Serial.println(input_string);
 
+  if (streaming)
+  {
+    streamReadings();
+  }
+  if (Serial.available() == 0)
+  {
+    return;
+  }
 
   // Get next command from Serial (add 1 for final 0)
   char input[INPUT_SIZE + 1];
-  byte size = Serial.readBytes(input, INPUT_SIZE);
+  // Reading until the end of line; commands without it are taken after the serial timeout
+  byte size = Serial.readBytesUntil('\n', input, INPUT_SIZE);
   // Add the final 0 to end the C string
   input[size] = 0;
+  if ((size > 0) && (input[size-1] == '\r'))
+  {
+    input[size-1] = 0;
+  }
 
   char* command = strtok(input, " ");
 
@@ -114,13 +153,35 @@ void loop() {
       // Serial.println(sensor_l.get_units()*-1.0);
       Serial.println(sensor_r.get_units());
     }
-    else if (strcmp(command, "version")==0)
+    else if (strcmp(command, "RB")==0)
     {
-      Serial.println("Bernie's load cells controller");
+      // Both readings in one reply: "left right counter"
+      float left = sensor_l.get_units();
+      float right = sensor_r.get_units();
+      sample_counter++;
+      Serial.print(left);
+      Serial.print(" ");
+      Serial.print(right);
+      Serial.print(" ");
+      Serial.println(sample_counter);
     }
-    else if (strcmp(command, "version\n")==0)
+    else if (strcmp(command, "S")==0)
+    {
+      command = strtok(NULL, " ");
+      streaming = (command != 0) && (strcmp(command, "on")==0);
+      if (streaming)
+      {
+        Serial.println("Streaming on");
+      }
+      else
+      {
+        Serial.println("Streaming off");
+      }
+    }
+    else if (strcmp(command, "version")==0)
     {
-      Serial.println("Bernie's load cells controller");
+      Serial.print("Bernie's load cells controller, protocol ");
+      Serial.println(PROTOCOL_VERSION);
     }
     else
     {
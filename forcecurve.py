@@ -0,0 +1,122 @@
+import numpy as np
+
+
+"""
+Load readings recorded along a Z probe, and the contact point found from them.
+
+The load stays at its baseline until the tip touches the surface, and grows linearly
+with the pressing depth after that:
+    load = baseline + slope * max(0, z - z_contact)
+Fitting this to all the probe readings gives the contact point between the steps.
+
+Part of BernieLib.
+"""
+
+
+# Columns of the saved curves
+CURVE_FIELDS = ('z', 'left', 'right')
+# Contact points tried in one pass of the fit
+FIT_CANDIDATES = 200
+
+
+def fitContact(z, load, candidates=FIT_CANDIDATES):
+    """
+    Fits the baseline and the linear ramp to the loads measured at Z coordinates.
+
+    Inputs
+        z, load
+            Sequences of the same length.
+        candidates
+            Number of contact points tried per pass; the second pass refines around the best one.
+
+    Returns
+        (z_contact, baseline, slope); None if there are not enough readings on the ramp
+        (at least two are needed to tell its slope) or the load does not grow.
+    """
+    z = np.asarray(z, dtype=float)
+    load = np.asarray(load, dtype=float)
+    if len(z) < 3:
+        return
+    grid = np.linspace(z.min(), z.max(), candidates)
+    fit = _fitHinges(z, load, grid)
+    if fit is None:
+        return
+    spacing = grid[1] - grid[0]
+    fine_grid = np.linspace(fit[0] - spacing, fit[0] + spacing, candidates)
+    fit = _fitHinges(z, load, fine_grid) or fit
+    z_contact, baseline, slope = fit
+    if np.count_nonzero(z > z_contact) < 2:
+        return
+    return fit
+
+
+def _fitHinges(z, load, contacts):
+    """
+    Least squares baseline and slope for every candidate contact point at once.
+    Returns the best (z_contact, baseline, slope), or None.
+    """
+    # Pressing depth of every reading for every candidate: (candidates, readings)
+    depth = np.maximum(0, z[np.newaxis, :] - contacts[:, np.newaxis])
+    n = len(z)
+    sum_depth = depth.sum(axis=1)
+    sum_depth2 = (depth ** 2).sum(axis=1)
+    sum_load = load.sum()
+    sum_depth_load = depth @ load
+    det = n * sum_depth2 - sum_depth ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sum_depth_load - sum_depth * sum_load) / det
+        baseline = (sum_load - slope * sum_depth) / n
+        residual = ((baseline[:, np.newaxis] + slope[:, np.newaxis] * depth - load) ** 2).sum(axis=1)
+    residual[~((det > 1e-12) & (slope > 0))] = np.inf
+    best = int(np.argmin(residual))
+    if not np.isfinite(residual[best]):
+        return
+    return float(contacts[best]), float(baseline[best]), float(slope[best])
+
+
+class forceCurve():
+    """
+    (Z, left, right) readings of one probe.
+    """
+
+    def __init__(self):
+        self.rows = []
+
+
+    def add(self, z, left, right):
+        self.rows.append((z, left, right))
+
+
+    def asArray(self):
+        return np.array(self.rows, dtype=float).reshape(-1, len(CURVE_FIELDS))
+
+
+    def fit(self):
+        """
+        Returns (z_contact, baseline, slope) for the combined load; None if it can't be fitted.
+        """
+        curve = self.asArray()
+        return fitContact(curve[:, 0], curve[:, 1] + curve[:, 2])
+
+
+    def thresholdZ(self, threshold):
+        """
+        Returns Z coordinate at which the fitted combined load reaches the threshold;
+        None if the curve can't be fitted.
+        """
+        fit = self.fit()
+        if fit is None:
+            return
+        z_contact, baseline, slope = fit
+        return z_contact + max(threshold - baseline, 0) / slope
+
+
+    def save(self, path):
+        """
+        Saves the readings as CSV, with the fitted contact in the header comment.
+        """
+        fit = self.fit()
+        header = ','.join(CURVE_FIELDS)
+        if fit is not None:
+            header = 'contact z %.4f, baseline %.2f, slope %.2f\n' % fit + header
+        np.savetxt(path, self.asArray(), delimiter=',', header=header, fmt='%.4f')
@@ -1,51 +1,503 @@
 import serial
+from serial.tools import list_ports
 import sys
 import json
 import os
+import copy
+import atexit
+import sqlite3
 import logging
+import threading
+import contextlib
+
+
+# Settings changes are kept in memory, and written to the files at most once per that time,
+# at checkpoint() and at exit. 0 to write every change at once.
+SAVE_INTERVAL = 5    # seconds
+
+# Objects with settings changed since they were last written
+_unsaved = set()
+# Guards _unsaved and the settings being changed or written; the writes happen in a timer thread
+_unsaved_lock = threading.RLock()
+_save_timer = None
+
+# Changes of the run state settings (see data.journaled_settings) are also appended here at once,
+# one JSON record per line, and replayed when the settings are loaded: the new value 
+# {"obj": name, "key": setting, "v": value}, or for a list the item added or removed, 
+# {"obj": name, "key": setting, "add": item} ("remove": item). The journal is compacted 
+# at every checkpoint(), and when it gets that long: the records of the objects just written 
+# are dropped. Resolved once, so changing the working directory does not split the journal.
+JOURNAL_PATH = os.path.abspath('settings_journal.jsonl')
+JOURNAL_MAX_RECORDS = 1000
+
+_journal_file = None
+_journal_records = 0
+# Names of the objects whose journal records are in their settings in memory; written by the 
+# next checkpoint(), so the records can be dropped then.
+_journal_applied = set()
+
+# Database of sqliteStorage()
+SQLITE_PATH = 'bernie_settings.db'
+
+# Objects shared by (class, name); see data.shared()
+_registry = {}
+
+FACTORY_DEFAULT_DIR = './factory_default/'
+# Parsed factory default files: {path: (modification time, settings)}
+_factory_defaults = {}
+
+
+def listSerialPortsInfo(usb_only=False):
+    """
+    Lists serial ports present in the system, with their USB metadata.
+    
+        :param usb_only:
+            If True, only USB devices are listed (both robot controllers are USB devices).
+        :returns:
+            A list of serial.tools.list_ports ListPortInfo objects, with device, 
+            serial_number, vid and pid attributes; sorted by the device name.
+    """
+    ports = list_ports.comports()
+    if usb_only:
+        ports = [port for port in ports if port.vid is not None]
+    return sorted(ports, key=lambda port: port.device)
 
 
 def listSerialPorts():
     """ 
     Lists serial port names
 
-        :raises EnvironmentError:
-            On unsupported or unknown platforms
         :returns:
-            A list of the serial ports available on the system
-    """
-    if sys.platform.startswith('win'):
-        ports = ['COM%s' % (i + 1) for i in range(256)]
-    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        # this excludes your current terminal "/dev/tty"
-        ports = glob.glob('/dev/tty[A-Za-z]*')
-    elif sys.platform.startswith('darwin'):
-        ports = glob.glob('/dev/tty.*')
-    else:
-        raise EnvironmentError('Unsupported platform')
-
+            A list of the serial ports available on the system, which are not 
+            kept open by another program.
+    """
     result = []
-    for port in ports:
+    for port_info in listSerialPortsInfo():
         try:
-            s = serial.Serial(port)
+            s = serial.Serial(port_info.device)
             s.close()
-            result.append(port)
+            result.append(port_info.device)
         except (OSError, serial.SerialException):
             pass
     return result
 
 
+def readFactoryDefault(path):
+    """
+    Returns the settings from the factory default file; {} if there is no such file.
+    Every file is parsed once, and again only after it is modified. The settings returned 
+    are a copy, free to be changed.
+    """
+    # The same relative path is another file after changing the working directory
+    path = os.path.abspath(path)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _factory_defaults.get(path)
+    if cached is None or cached[0] != mtime:
+        f = open(path, 'r')
+        cached = (mtime, json.loads(f.read()))
+        f.close()
+        _factory_defaults[path] = cached
+    return copy.deepcopy(cached[1])
+
+
+def preloadFactoryDefaults(directory=FACTORY_DEFAULT_DIR):
+    """
+    Parses all the factory default files at once, so creating the objects does not read them.
+    """
+    for file_name in os.listdir(directory):
+        if file_name.endswith('.json'):
+            readFactoryDefault(os.path.join(directory, file_name))
+
+
+def checkpoint():
+    """
+    Writes the settings of all the objects changed since they were last written.
+    Called every SAVE_INTERVAL seconds after a change, and at exit.
+    """
+    global _save_timer
+    with _unsaved_lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+            _save_timer = None
+        saved = list(_unsaved)
+        with _storage.transaction():
+            for obj in saved:
+                obj.save()
+        
+        def rolledBack():
+            # Written again at the next checkpoint
+            _unsaved.update(saved)
+        # Inside an outer transaction the objects are not stored until it commits; the journal
+        # must stay till then
+        _storage.afterCommit(_compactJournal, on_rollback=rolledBack)
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Settings written inside are written in one transaction of the storage (for sqliteStorage;
+    the files of jsonFileStorage are written one by one):
+    
+        with general.transaction():
+            general.checkpoint()
+    """
+    with _unsaved_lock:
+        with _storage.transaction():
+            yield
+
+
+def setStorage(storage):
+    """
+    Selects where the settings are kept: jsonFileStorage() (default) or sqliteStorage().
+    The changes not written yet go to the old storage first. Objects created before keep 
+    their settings, and write them to the new storage from then on.
+    """
+    global _storage
+    with _unsaved_lock:
+        checkpoint()
+        _storage = storage
+
+
+def _appendJournal(record):
+    global _journal_file, _journal_records
+    with _unsaved_lock:
+        if _journal_file is None:
+            _journal_file = open(JOURNAL_PATH, 'a')
+        _journal_file.write(json.dumps(record) + '\n')
+        _journal_file.flush()
+        os.fsync(_journal_file.fileno())
+        _journal_records += 1
+        _journal_applied.add(record['obj'])
+
+
+def _readJournalRecords():
+    """
+    Returns all the records in the journal, oldest first.
+    """
+    records = []
+    try:
+        f = open(JOURNAL_PATH, 'r')
+    except FileNotFoundError:
+        return records
+    for line in f:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # The record being written when the program crashed
+            continue
+    f.close()
+    return records
+
+
+JOURNAL_CHANGES = ('v', 'add', 'remove')
+
+
+def _readJournal(name):
+    """
+    Returns the journaled changes of the object's settings: [(key, change, value)], oldest 
+    first, where change is 'v' for the new value, 'add' or 'remove' for a list item.
+    Changes before the object was purged are left out.
+    """
+    changes = []
+    for record in _readJournalRecords():
+        if record.get('obj') != name:
+            continue
+        if record.get('purge'):
+            changes = []
+            continue
+        for change in JOURNAL_CHANGES:
+            if change in record:
+                changes.append((record['key'], change, record[change]))
+    return changes
+
+
+def _compactJournal():
+    """
+    Drops the journal records of the objects that have their changes written already
+    (see _journal_applied); the records of the objects not loaded yet are kept.
+    """
+    global _journal_file, _journal_records
+    with _unsaved_lock:
+        if _journal_file is not None:
+            _journal_file.close()
+            _journal_file = None
+        _journal_records = 0
+        kept = [record for record in _readJournalRecords() if record.get('obj') not in _journal_applied]
+        _journal_applied.clear()
+        if not kept:
+            try:
+                os.remove(JOURNAL_PATH)
+            except FileNotFoundError:
+                pass
+            return
+        # Replacing the journal at once, like the settings files
+        f = open(JOURNAL_PATH+'.tmp', 'w')
+        for record in kept:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(JOURNAL_PATH+'.tmp', JOURNAL_PATH)
+
+
+def _scheduleCheckpoint():
+    global _save_timer
+    with _unsaved_lock:
+        if _save_timer is not None:
+            return
+        _save_timer = threading.Timer(SAVE_INTERVAL, checkpoint)
+        _save_timer.daemon = True
+        _save_timer.start()
+
+
+atexit.register(checkpoint)
+
+
+class jsonFileStorage():
+    """
+    Settings of every object in its own <name>.json file in the working directory.
+    """
+    
+    def load(self, name, path=None):
+        """
+        Returns the settings dictionary of the object; None if nothing is saved.
+        """
+        if path is None:
+            path = name+'.json'
+        try:
+            f = open(path, 'r')
+        except FileNotFoundError:
+            return
+        settings = json.loads(f.read())
+        f.close()
+        return settings
+    
+    
+    def save(self, name, settings):
+        # Writing a new file and replacing the old one with it, so a crash never leaves
+        # a half-written file
+        path = name+'.json'
+        f = open(path+'.tmp', 'w')
+        f.write(json.dumps(settings))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(path+'.tmp', path)
+    
+    
+    def remove(self, name):
+        try:
+            os.remove(name+'.json')
+        except FileNotFoundError:
+            pass
+    
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        yield
+    
+    
+    def afterCommit(self, callback, on_rollback=None):
+        # Files are written at once
+        callback()
+
+
+class sqliteStorage():
+    """
+    Settings of all the objects in one SQLite database: one row per (object, setting), 
+    with the value as JSON. The database is in WAL mode, so a crash never leaves it 
+    half-written, and other processes can read it while a run writes.
+    
+    The whole database is read with one query at the first load; objects take their settings 
+    from there when they are loaded for the first time, and from the database afterwards. 
+    Objects not in the database yet are read from their <name>.json files, if there are any,
+    so the settings of the file storage are kept when switching. The names of the objects 
+    written once are kept in the objects table, so a file is never read again for them, 
+    even after they are removed.
+    """
+    
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        # Transactions are started explicitly; the timer thread of checkpoint() writes too
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS settings ('
+                                'object TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                                'PRIMARY KEY (object, key))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS objects (name TEXT PRIMARY KEY)')
+        # Databases written before the objects table
+        self.connection.execute('INSERT OR IGNORE INTO objects SELECT DISTINCT object FROM settings')
+        self._preloaded = None
+        self._known = None
+        self._transaction_depth = 0
+        # [(callback, on_rollback)] waiting for the outermost transaction to end
+        self._after_commit = []
+    
+    
+    def _preload(self):
+        self._preloaded = {}
+        for name, key, value in self.connection.execute('SELECT object, key, value FROM settings'):
+            self._preloaded.setdefault(name, {})[key] = json.loads(value)
+        self._known = set(name for (name,) in self.connection.execute('SELECT name FROM objects'))
+    
+    
+    def load(self, name, path=None):
+        """
+        Returns the settings dictionary of the object; None if nothing is saved.
+        """
+        if path is not None:
+            return jsonFileStorage().load(name, path)
+        if self._preloaded is None:
+            self._preload()
+        if name in self._preloaded:
+            return self._preloaded.pop(name)
+        rows = self.connection.execute('SELECT key, value FROM settings WHERE object = ?', (name,)).fetchall()
+        if rows:
+            return {key: json.loads(value) for key, value in rows}
+        if name in self._known:
+            # Removed; the file it was once imported from is out of date
+            return
+        return jsonFileStorage().load(name)
+    
+    
+    def save(self, name, settings):
+        if self._preloaded is not None:
+            self._preloaded.pop(name, None)
+        with self.transaction():
+            self._addKnown(name)
+            self.connection.execute('DELETE FROM settings WHERE object = ?', (name,))
+            self.connection.executemany('INSERT INTO settings VALUES (?, ?, ?)', 
+                                        [(name, key, json.dumps(value)) for key, value in settings.items()])
+    
+    
+    def remove(self, name):
+        if self._preloaded is not None:
+            self._preloaded.pop(name, None)
+        with self.transaction():
+            self._addKnown(name)
+            self.connection.execute('DELETE FROM settings WHERE object = ?', (name,))
+    
+    
+    def _addKnown(self, name):
+        self.connection.execute('INSERT OR IGNORE INTO objects VALUES (?)', (name,))
+        if self._known is not None:
+            self._known.add(name)
+    
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Everything written inside is committed at once at the end; nested ones join the outer one.
+        """
+        outermost = self._transaction_depth == 0
+        if outermost:
+            self.connection.execute('BEGIN IMMEDIATE')
+        self._transaction_depth += 1
+        try:
+            yield
+        except:
+            self._transaction_depth -= 1
+            if outermost:
+                self.connection.execute('ROLLBACK')
+                callbacks, self._after_commit = self._after_commit, []
+                for callback, on_rollback in callbacks:
+                    if on_rollback is not None:
+                        on_rollback()
+            raise
+        self._transaction_depth -= 1
+        if outermost:
+            self.connection.execute('COMMIT')
+            callbacks, self._after_commit = self._after_commit, []
+            for callback, on_rollback in callbacks:
+                callback()
+    
+    
+    def afterCommit(self, callback, on_rollback=None):
+        """
+        Calls callback once everything written so far is committed: at once outside of 
+        a transaction, at the end of the outermost one otherwise. If that one is rolled 
+        back, on_rollback is called instead.
+        """
+        if self._transaction_depth == 0:
+            callback()
+        else:
+            self._after_commit.append((callback, on_rollback))
+    
+    
+    def close(self):
+        self.connection.close()
+
+
+# Where the settings are kept; see setStorage()
+_storage = jsonFileStorage()
+
+
 class data():
     """
     Handles data input and output
     """
     
+    # Settings changing during a run, like the sample volumes; journaled (see JOURNAL_PATH), 
+    # so the run state survives a crash.
+    journaled_settings = ()
+    # Held while the settings are written, including by the checkpoint timer thread. Settings
+    # changed in place, like a list taken with _getSetting, must be changed holding it too.
+    settings_lock = _unsaved_lock
+    
     def __init__(self, name):
         self.name = name
-        self.factory_default_path = './factory_default/' + self.name + '.json'
+        self.factory_default_path = FACTORY_DEFAULT_DIR + self.name + '.json'
         self.loadData()
     
     
+    @classmethod
+    def shared(cls, name, *args, **kwargs):
+        """
+        Returns the object of this class with the name, created at the first call with the
+        arguments given. All the callers get the same object, so the settings are loaded
+        once, and every change is seen by all of them.
+        """
+        with _unsaved_lock:
+            obj = _registry.get((cls, name))
+            if obj is None:
+                obj = cls(name, *args, **kwargs)
+                _registry[(cls, name)] = obj
+            return obj
+    
+    
+    def share(self, cls=None):
+        """
+        Makes this object the one cls.shared() returns for its name (cls is the object's class
+        by default); like the robot, whose settings are read elsewhere as data.shared('robot').
+        """
+        with _unsaved_lock:
+            _registry[(cls or type(self), self.name)] = self
+    
+    
+    @classmethod
+    def evict(cls, name=None):
+        """
+        Forgets the shared object of this class with the name, or all the shared objects of 
+        this class and its subclasses if name is None; shared() creates them anew afterwards.
+        Their unsaved changes are written first.
+        """
+        with _unsaved_lock:
+            for key in list(_registry):
+                obj_class, obj_name = key
+                if name is None:
+                    evicted = issubclass(obj_class, cls)
+                else:
+                    evicted = obj_class is cls and obj_name == name
+                if not evicted:
+                    continue
+                obj = _registry.pop(key)
+                if obj in _unsaved:
+                    obj.save()
+    
+    
     def _getSetting(self, name):
         try:
             value = self.data[name]
@@ -73,38 +525,103 @@ class data():
         return present
 
     
-    def _setSetting(self, name, value):
-        self.data[name] = value
-        self.save()
+    def _setSetting(self, name, value, sync=False):
+        """
+        Changes the setting in memory; the settings file is written later (see SAVE_INTERVAL).
+        If sync is True, the file is written at once; used for calibration results.
+        """
+        with _unsaved_lock:
+            self.data[name] = value
+            self._settingChanged(name, 'v', value, sync=sync)
+    
+    
+    def _addToSetting(self, name, item):
+        """
+        Appends the item to the list setting, like _setSetting() with the longer list; 
+        only the item is journaled.
+        """
+        with _unsaved_lock:
+            self._getSetting(name).append(item)
+            self._settingChanged(name, 'add', item)
+    
+    
+    def _removeFromSetting(self, name, item):
+        """
+        Removes the item from the list setting, if it is there, like _setSetting() with 
+        the shorter list; only the item is journaled.
+        """
+        with _unsaved_lock:
+            value = self._getSetting(name)
+            if item not in value:
+                return
+            value.remove(item)
+            self._settingChanged(name, 'remove', item)
+    
+    
+    def _settingChanged(self, name, change, value, sync=False):
+        """
+        Journals the change (see _readJournal) and writes the settings, now or later.
+        """
+        with _unsaved_lock:
+            if name in self.journaled_settings:
+                _appendJournal({'obj': self.name, 'key': name, change: value})
+            if sync or SAVE_INTERVAL <= 0:
+                self.save()
+            else:
+                _unsaved.add(self)
+                _scheduleCheckpoint()
+            if _journal_records >= JOURNAL_MAX_RECORDS:
+                checkpoint()
         
         
     def save(self):
-        f = open(self.name+'.json', 'w')
-        f.write(json.dumps(self.data))
-        f.close()
+        with _unsaved_lock:
+            _unsaved.discard(self)
+            _storage.save(self.name, self.data)
         
 
     def loadData(self, path=None):
-        if path is None:
-            path=self.name+'.json'
-        try:
-            f = open(path, 'r')
-            self.data = json.loads(f.read())
-            f.close()
-        except FileNotFoundError:
+        """
+        Loads the settings from the storage (see setStorage), or from the JSON file at path.
+        """
+        with _unsaved_lock:
+            if path is None:
+                # Changes not written yet by any object with the same settings are read too
+                for obj in [obj for obj in _unsaved if obj.name == self.name]:
+                    obj.save()
+            loaded = _storage.load(self.name, path)
+        if loaded is None:
             self.data = self.loadFactoryDefault()
             # Copying factory defaults into the local settings
             self.save()
+        else:
+            self.data = loaded
+        if path is None:
+            self._replayJournal()
+    
+    
+    def _replayJournal(self):
+        """
+        Applies the journaled changes written after the settings file, like before a crash.
+        """
+        records = _readJournal(self.name)
+        for key, change, value in records:
+            if change == 'v':
+                self.data[key] = value
+            elif change == 'add':
+                self.data.setdefault(key, []).append(value)
+            elif value in self.data.get(key, []):
+                self.data[key].remove(value)
+        if records:
+            # Kept in the journal till the settings file has them
+            with _unsaved_lock:
+                _journal_applied.add(self.name)
+                _unsaved.add(self)
+                _scheduleCheckpoint()
     
     
     def loadFactoryDefault(self):
-        try:
-            f = open(self.factory_default_path, 'r')
-            factory_default_data = json.loads(f.read())
-            f.close()
-        except FileNotFoundError:
-            factory_default_data = {}
-        return factory_default_data
+        return readFactoryDefault(self.factory_default_path)
     
     
     def purge(self):
@@ -112,8 +629,10 @@ class data():
         Attention! Do not run unless you know what you are doing.
         Removes all data for the object, both on hard drive and memory.
         """
-        try:
-            os.remove(self.name+'.json')
-        except:
-            pass
-        self.data = {}
\ No newline at end of file
+        with _unsaved_lock:
+            _unsaved.discard(self)
+            _storage.remove(self.name)
+            self.data = {}
+            if self.journaled_settings:
+                # The journaled changes from before are not replayed anymore
+                _appendJournal({'obj': self.name, 'purge': True})
\ No newline at end of file
@@ -0,0 +1,161 @@
+import re
+import time
+import threading
+
+import numpy as np
+
+
+"""
+Load cells readings streamed by the load cells controller ("S on" command).
+
+Part of BernieLib.
+"""
+
+
+# Number of readings kept; at 80 samples per second, almost a minute
+LOAD_BUFFER_SIZE = 4096
+
+# Streamed reading line: "D left right counter"
+STREAM_LINE_RE = re.compile(r'^D ([-+\d.]+) ([-+\d.]+) (\d+)\s*$')
+# HX711 at its default 10 samples per second; used until the readings arrive
+DEFAULT_SAMPLE_INTERVAL = 0.1   # seconds
+
+
+class loadRingBuffer():
+    """
+    Fixed size buffer of the latest (timestamp, left, right) readings.
+    Readings are added by the port reading thread and waited for by the robot.
+    """
+
+    def __init__(self, size=LOAD_BUFFER_SIZE):
+        self.size = size
+        self.data = np.zeros((size, 3))
+        # Number of readings added since the start; the newest one is at (count - 1) % size
+        self.count = 0
+        self.last_counter = None
+        self.condition = threading.Condition()
+
+
+    def append(self, timestamp, left, right):
+        with self.condition:
+            self.data[self.count % self.size] = (timestamp, left, right)
+            self.count += 1
+            self.condition.notify_all()
+
+
+    def feedLine(self, line):
+        """
+        Adds the reading if the line is a streamed one.
+        Returns True if the line was a reading, False for any other message.
+        """
+        match = STREAM_LINE_RE.match(line)
+        if match is None:
+            return False
+        left, right, counter = match.groups()
+        self.last_counter = int(counter)
+        self.append(time.time(), float(left), float(right))
+        return True
+
+
+    def _rows(self, start, stop):
+        """
+        Returns readings with numbers from start to stop (not including), oldest first.
+        Must be called with the condition acquired.
+        """
+        start = max(start, stop - self.size, 0)
+        indices = np.arange(start, stop) % self.size
+        return self.data[indices]
+
+
+    def latest(self):
+        """
+        Returns the newest reading as (timestamp, left, right); None if nothing arrived yet.
+        """
+        with self.condition:
+            if self.count == 0:
+                return
+            return tuple(self.data[(self.count - 1) % self.size])
+
+
+    def window(self, seconds, now=None):
+        """
+        Returns readings from the last seconds as an array of (timestamp, left, right) rows.
+        """
+        if now is None:
+            now = time.time()
+        with self.condition:
+            rows = self._rows(0, self.count)
+        return rows[rows[:, 0] >= now - seconds]
+
+
+    def windowMean(self, seconds, now=None):
+        """
+        Returns (left, right) mean loads over the last seconds; None if there were no readings.
+        """
+        rows = self.window(seconds, now=now)
+        if len(rows) == 0:
+            return
+        left, right = rows[:, 1:].mean(axis=0)
+        return left, right
+
+
+    def sampleInterval(self, readings=16):
+        """
+        Returns the median time between the last readings, seconds.
+        """
+        with self.condition:
+            rows = self._rows(self.count - readings, self.count)
+        if len(rows) < 2:
+            return DEFAULT_SAMPLE_INTERVAL
+        return float(np.median(np.diff(rows[:, 0])))
+
+
+    def nextReading(self, timeout):
+        """
+        Waits for a reading newer than the moment of the call.
+        Returns (timestamp, left, right), or None if nothing arrived before the timeout.
+        """
+        with self.condition:
+            start = self.count
+            if not self.condition.wait_for(lambda: self.count > start, timeout=timeout):
+                return
+            return tuple(self.data[start % self.size])
+
+
+    def waitForThreshold(self, threshold, timeout, load_filter=None, below=False):
+        """
+        Waits for the combined (left + right) load to reach the threshold. Only the readings
+        that arrive after the call are checked.
+
+        Inputs
+            load_filter
+                loadfilter.loadFilter the readings pass before the comparison; None to compare
+                the readings as they are.
+            below
+                If True, waits for the load to drop to the threshold or below instead, like when
+                the pipette slides off an edge. The filter gets the negated loads then.
+
+        Returns (timestamp, left, right) of the first reading reaching the threshold,
+        or None if none did before the timeout.
+        """
+        deadline = time.time() + timeout
+        sign = -1 if below else 1
+        with self.condition:
+            checked = self.count
+            while True:
+                # Readings that were overwritten while waiting are lost
+                rows = self._rows(checked, self.count)
+                if len(rows):
+                    loads = sign * (rows[:, 1] + rows[:, 2])
+                    if load_filter is None:
+                        triggered = np.flatnonzero(loads >= sign * threshold)
+                        index = triggered[0] if len(triggered) else None
+                    else:
+                        index = load_filter.feed(rows[:, 0], loads, sign * threshold)
+                    if index is not None:
+                        return tuple(rows[index])
+                checked = self.count
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self.condition.wait(remaining)
@@ -0,0 +1,123 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import lfilter
+
+
+"""
+Filtering of the load readings, so the probes are not triggered by the noise of the load
+cells and the vibration of the moving robot.
+
+Readings pass a median of the last N ones, then an exponential moving average. A probe is
+triggered when the filtered load reaches the threshold, or, optionally, when it grows faster
+than the rate threshold.
+
+    load_filter = loadFilter(median=3, ema_alpha=0.5)
+    index = load_filter.feed(timestamps, loads, threshold)
+
+Part of BernieLib.
+"""
+
+
+# Without any settings, the filter passes the readings as they are
+FILTER_DEFAULTS = {
+    'median': 1,                # Readings in the median window
+    'ema_alpha': 1.0,           # Weight of the new reading in the moving average; 1 for none
+    'rate_threshold': None,     # Load growth per second triggering the probe; None for none
+}
+
+
+class loadFilter():
+    """
+    Median, moving average and rate of change over a sequence of load readings. Readings are
+    fed in chunks (one, or all that arrived since the last time); each chunk is processed
+    as a whole.
+    """
+
+    def __init__(self, median=1, ema_alpha=1.0, rate_threshold=None):
+        self.median = max(int(median), 1)
+        self.ema_alpha = ema_alpha
+        self.rate_threshold = rate_threshold
+        self.reset()
+
+
+    @classmethod
+    def fromProfile(cls, profile):
+        """
+        Creates the filter from the settings dictionary; missing settings take FILTER_DEFAULTS.
+        """
+        settings = dict(FILTER_DEFAULTS)
+        settings.update(profile or {})
+        return cls(**settings)
+
+
+    def reset(self):
+        # Last readings needed for the median window
+        self._tail = np.zeros(0)
+        # Moving average state; None before the first reading
+        self._ema = None
+        self._last_time = None
+        self.last_value = None
+
+
+    def filter(self, loads):
+        """
+        Returns the filtered loads for the new readings.
+        """
+        loads = np.asarray(loads, dtype=float)
+        if len(loads) == 0:
+            return loads
+        if self.median > 1:
+            history = np.concatenate([self._tail, loads])
+            self._tail = history[-(self.median - 1):]
+            # The first readings are the median of what there is so far
+            padded = np.concatenate([np.full(self.median - 1 - (len(history) - len(loads)), history[0]),
+                                     history])
+            medians = np.median(sliding_window_view(padded, self.median), axis=1)
+        else:
+            medians = loads
+        if self.ema_alpha < 1:
+            if self._ema is None:
+                self._ema = medians[0]
+            alpha = self.ema_alpha
+            # y[i] = alpha * x[i] + (1 - alpha) * y[i-1]
+            filtered, state = lfilter([alpha], [1, alpha - 1], medians, zi=[(1 - alpha) * self._ema])
+            self._ema = filtered[-1]
+        else:
+            filtered = medians
+        return filtered
+
+
+    def feed(self, times, loads, threshold):
+        """
+        Processes the new readings.
+
+        Inputs
+            times
+                Timestamps of the readings, seconds.
+            loads
+                Combined loads.
+            threshold
+                Filtered load triggering the probe.
+
+        Returns
+            Index of the first reading triggering the probe; None if none did.
+        """
+        times = np.asarray(times, dtype=float)
+        filtered = self.filter(loads)
+        if len(filtered) == 0:
+            return
+        triggered = filtered >= threshold
+        if self.rate_threshold is not None:
+            previous_values = np.concatenate([[filtered[0] if self.last_value is None else self.last_value],
+                                              filtered[:-1]])
+            previous_times = np.concatenate([[times[0] if self._last_time is None else self._last_time],
+                                             times[:-1]])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rates = (filtered - previous_values) / (times - previous_times)
+            triggered |= np.nan_to_num(rates, nan=0, posinf=0, neginf=0) >= self.rate_threshold
+        self.last_value = filtered[-1]
+        self._last_time = times[-1]
+        indices = np.flatnonzero(triggered)
+        if len(indices) == 0:
+            return
+        return int(indices[0])
@@ -626,9 +626,11 @@ class protocol():
     def washingBeadsFromWallDuringElution(self, sample, dx, dz, v, delay):
         z_top = sample.getSampleTopAbsZ(added_length=self.robot._calcExtraLength())
         z_curr = z_top + dz
-        self.robot.move(z=z_curr)
-        self.robot.moveAxisDelta('X', dx)
-        self.robot.movePipetteToVolume(v)
+        x_curr = self.robot.getPosition(axis='X') + dx
+        a = self.robot.calcPipettePositionFromVolume(v)
+        # Moving along the wall and releasing liquid in one move. The path inside the tube is 
+        # clear down to z_curr; if the tip is deeper than that, Z is lifted before X moves.
+        self.robot.moveTo(x=x_curr, z=z_curr, a=a, clear_z=z_curr)
         time.sleep(delay)
     
     def elutionMix(self, sample, volume=None, how='low'):
@@ -643,8 +645,6 @@ class protocol():
         time.sleep(self.settings.pipetting_delay)
         
         # Washing steps, releasing liquid while moving along the wall
-        # TODO: Replace those by establishing a "move" command which simultaneously 
-        # moves X, Z and A coordinates.
         if how == 'low':
             dispense_vol = volume / 4.0
             dispense_delay = self.settings.pipetting_delay / 4.0
@@ -752,25 +752,42 @@ class protocol():
 
     def purify_once(self):
         self.absorbDnaOntoBeads()   # First stage
+        bl.checkpoint()
         
         # Checking if this is a two-stage cutoff
         if self.settings.cutoffs == 2:
             self.transferSamplesToSecondStage()
             self.absorbDnaOntoBeads()   # Second stage
+            bl.checkpoint()
         
         self.removeSupernatant(pipette_speed=self.settings.beads_pipetting_speed)
         self.ethanolWash()
+        bl.checkpoint()
         self.elution()
+        bl.checkpoint()
     
-    def purify(self):
+    def purify(self, trace_path=None):
+        """
+        Runs the whole purification.
+        If trace_path is provided, timing of every command sent to the robot is saved there
+        at the end (CSV if the path ends with .csv, JSON with per-command statistics otherwise).
+        """
         logging.info("This is the %s-stage magnetic beads purification." % self.settings.cutoffs)
         logging.info("I will repeat this purification %s times." % self.settings.cleanups)
         
-        if self.settings.cleanups == 2:
-            self._reinitializeTubesForFirstCleanup()
+        if trace_path is not None:
+            tracer = self.robot.startTracing()
+        try:
+            if self.settings.cleanups == 2:
+                self._reinitializeTubesForFirstCleanup()
+                self.purify_once()
+                self._reinitializeTubesForSecondCleanup()
             self.purify_once()
-            self._reinitializeTubesForSecondCleanup()
-        self.purify_once()
+        finally:
+            if trace_path is not None:
+                self.robot.stopTracing()
+                tracer.dump(trace_path)
+                logging.info("Command timing saved to %s" % trace_path)
         logging.info("%s-stage purification finished." % self.settings.cutoffs)
         
         
@@ -831,6 +848,7 @@ if __name__ == '__main__':
     logging.info("/nThis is the script for purifying DNA mixture by removing any DNA molecules shorter then a certain size.")
     logging.info("I will start from running a few sanity checks")
 
+    bl.preloadFactoryDefaults()
     settings_file_path = getSettingsPathFromArg()
     s = settings(settings_file_path)
     
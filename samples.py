@@ -174,6 +174,26 @@ class sample_type(data):
     def getLowVolTipBottomGap(self):
         return self._getSetting('low_volume_tip_and_bottom_gap')
     
+    def setBottomDepthEstimate(self, d):
+        """
+        Sets the distance from the sample top to the Z coordinate at which the robot touched
+        the bottom, as measured with one of the samples of this type.
+        The bottom of the other samples of the type is then searched for near that depth.
+        """
+        self._setSetting('bottom_depth_estimate', d)
+    
+    def getBottomDepthEstimate(self):
+        """
+        Returns the measured bottom depth; or the sample depth if nothing was measured yet.
+        None if neither is known.
+        """
+        # Samples made by createSample share one object of the type, so the measurements 
+        # done with the other samples are seen.
+        if self._settingPresent('bottom_depth_estimate'):
+            return self._getSetting('bottom_depth_estimate')
+        if self._settingPresent('depth'):
+            return self.getDepth()
+    
     
     
 class sample(data):
@@ -187,6 +207,8 @@ class sample(data):
             Sample can be only in one rack at a time, the rack object is stored in self.rack
     """
     
+    journaled_settings = ('volume', 'robot_touched_sample_bottom', 'tube_bottom_z')
+    
     def __init__(self, sname, stype, volume=None):
         super().__init__(name=sname)
         
@@ -322,6 +344,33 @@ class sample(data):
         """
         return self._getSetting('tube_bottom_z')
     
+    def predictZBottom(self, added_length=0):
+        """
+        Returns expected absolute Z coordinate of the bottom of the tube: the one measured for 
+        this sample, or the one estimated from the other samples of the same type.
+        None if there is no estimate.
+        """
+        if self._settingPresent('tube_bottom_z'):
+            return self.getZBottom()
+        depth = self.stype.getBottomDepthEstimate()
+        if depth is None:
+            return
+        try:
+            return self.getSampleTopAbsZ(added_length=added_length) + depth
+        except (AttributeError, KeyError, TypeError):
+            # Sample is not in a rack, or the rack is not calibrated
+            return
+    
+    def shareZBottom(self, z, added_length=0):
+        """
+        Records the measured tube bottom coordinate as the bottom depth estimate of the sample type.
+        """
+        try:
+            depth = z - self.getSampleTopAbsZ(added_length=added_length)
+        except (AttributeError, KeyError, TypeError):
+            return
+        self.stype.setBottomDepthEstimate(depth)
+    
     def setCloseToBottomVol(self, v):
         """
         Set the volume at which robot will perform "low volume" operations; such as 
@@ -369,13 +418,15 @@ def createSample(type_name, sample_name, rack, pos_col, pos_row, volume, purge=T
         print("You can't use this sample_name, because it interferes with the internal settings.")
         print("Please chose different sample_name.")
         return
-    stype = sample_type(type_name)
-    s = sample(sample_name, stype)
+    # One object per type and per sample, shared by everything using them
+    stype = sample_type.shared(type_name)
+    s = sample.shared(sample_name, stype)
+    s.stype = stype
     if purge:
         # If dealing with a new sample, program purges all settings that may have been left
         # from the old sample.
         s.purge()
-        s = sample(sample_name, stype)
+        s.loadData()
     s.place(rack, pos_col, pos_row)
     s.setVolume(volume)
     return s
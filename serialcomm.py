@@ -0,0 +1,229 @@
+import re
+import queue
+import logging
+import threading
+
+import serial
+
+
+"""
+Buffered input handling for the serial ports of the robot.
+
+Part of BernieLib.
+"""
+
+
+# Reply of the smoothieboard to the '?' status request. Looks like this:
+# '<Idle|MPos:0.0000,0.0000,1.0000,3.0000|WPos:0.0000,0.0000,1.0000|F:3000.0,100.0>'
+STATUS_REPLY_RE = re.compile(
+    r'<(\w+)\|MPos:([-+\d.]+),([-+\d.]+),([-+\d.]+),([-+\d.]+)')
+
+# Axis words of a G-code command, like 'X10.5' or 'A-1'
+AXIS_WORD_RE = re.compile(r'([XYZA])([-+]?[\d.]+)')
+
+# Messages the controllers may send on their own, without being asked.
+# Those are logged as warnings when they arrive between the commands.
+UNSOLICITED_WARNING_MARKERS = ('ALARM', '!!', 'error', 'Error', 'HALT')
+
+# Ports that are not real serial devices, like the emulator; {port name: factory}
+_transports = {}
+
+# Compiled terminator patterns, so every reply does not recompile the same expression.
+_compiled_patterns = {}
+
+
+def compilePattern(pattern):
+    """
+    Returns compiled regular expression for the pattern, compiling it only once per pattern.
+    """
+    try:
+        return _compiled_patterns[pattern]
+    except KeyError:
+        compiled = re.compile(pattern)
+        _compiled_patterns[pattern] = compiled
+        return compiled
+
+
+def registerTransport(port_name, factory):
+    """
+    Makes openPort() return factory(baudrate=..., timeout=...) instead of a serial port
+    for the given port name. The returned object must behave like serial.Serial.
+    """
+    _transports[port_name] = factory
+
+
+def unregisterTransport(port_name):
+    _transports.pop(port_name, None)
+
+
+def openPort(port_name, baudrate, timeout):
+    """
+    Opens the port by its name; a serial port unless a transport with this name is registered.
+    """
+    factory = _transports.get(port_name)
+    if factory is not None:
+        return factory(baudrate=baudrate, timeout=timeout)
+    return serial.Serial(port_name, baudrate, timeout=timeout)
+
+
+def readAvailable(port):
+    """
+    Reads everything that is currently waiting in the port input buffer, in one call.
+    Returns bytes; empty if nothing is waiting.
+    """
+    waiting = port.in_waiting
+    if not waiting:
+        return b''
+    return port.read(waiting)
+
+
+def parseStatusReply(message):
+    """
+    Parses smoothieboard reply to the '?' request.
+
+    Returns
+        (state, x, y, z, a), where state is the string like 'Idle' or 'Run'
+        and coordinates are floats. None if the message has no status reply in it.
+    """
+    if message is None:
+        return
+    match = STATUS_REPLY_RE.search(message)
+    if match is None:
+        return
+    state, x, y, z, a = match.groups()
+    return state, float(x), float(y), float(z), float(a)
+
+
+class lineBuffer():
+    """
+    Collects raw bytes coming from the port and splits them into complete lines.
+    The incomplete tail is kept until the rest of it arrives.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.buffer = bytearray()
+        # Position up to which the buffer is known to have no end of line
+        self._scanned = 0
+
+    def feed(self, chunk):
+        """
+        Adds new bytes to the buffer.
+        Returns a list of complete lines (with their end of line characters) found so far.
+        """
+        self.buffer += chunk
+        lines = []
+        start = 0
+        # Only the newly added part needs to be searched for the end of line.
+        end = self.buffer.find(b'\n', self._scanned)
+        while end >= 0:
+            lines.append(self.buffer[start:end+1].decode(self.encoding))
+            start = end + 1
+            end = self.buffer.find(b'\n', start)
+        if start:
+            del self.buffer[:start]
+        self._scanned = len(self.buffer)
+        return lines
+
+    def pending(self):
+        """
+        Returns the incomplete line collected so far.
+        """
+        return self.buffer.decode(self.encoding)
+
+
+class matchBuffer():
+    """
+    Accumulates a reply and checks whether the terminator pattern arrived.
+    The pattern is only searched in the newly arrived text and the incomplete line before it
+    (plus a small overlap with the previous text), so a terminator split between two reads 
+    is still found.
+    """
+
+    def __init__(self, pattern):
+        self.regex = compilePattern(pattern)
+        # Literal terminators may span lines; they are found within their length back
+        self.overlap = len(pattern)
+        self.message = ''
+
+    def feed(self, text):
+        """
+        Adds new text to the reply. Returns True if the terminator was found.
+        """
+        if not text:
+            return False
+        # Regular expression terminators, like 'ALARM[^\n]*\n', match more than the pattern
+        # length; they do not span lines, so searching from the last line start is enough
+        line_start = self.message.rfind('\n') + 1
+        start = max(0, min(line_start, len(self.message) - self.overlap))
+        self.message += text
+        return self.regex.search(self.message, start) is not None
+
+
+class portListener(threading.Thread):
+    """
+    Reads a serial port in the background and puts every complete line into a queue.
+    
+    The thread blocks on the port read (up to the port timeout) when nothing arrives,
+    so it does not load the CPU while waiting.
+    """
+
+    def __init__(self, port, name=None):
+        super().__init__(name=name, daemon=True)
+        self.port = port
+        self.lines = queue.Queue()
+        self.buffer = lineBuffer()
+        # Called with every received line; lines it returns True for are not queued
+        self.line_handler = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                # Reading everything that is waiting; or waiting for at least one byte
+                chunk = self.port.read(self.port.in_waiting or 1)
+                lines = self.buffer.feed(chunk)
+            except Exception as e:
+                if not self._stop_event.is_set():
+                    logging.error("Listener for the port %s stopped: %s", self.name, e)
+                return
+            for line in lines:
+                handler = self.line_handler
+                if handler is not None and handler(line):
+                    continue
+                self.lines.put(line)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def readLine(self, timeout):
+        """
+        Returns the next received line, waiting up to timeout seconds for it.
+        Returns None if nothing arrived.
+        """
+        try:
+            return self.lines.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+    def drain(self):
+        """
+        Returns all the lines received so far and not yet read.
+        """
+        lines = []
+        while True:
+            try:
+                lines.append(self.lines.get_nowait())
+            except queue.Empty:
+                return lines
+
+
+def logUnsolicited(port_name, lines):
+    """
+    Logs the lines that arrived from the controller without being requested.
+    """
+    for line in lines:
+        if any(marker in line for marker in UNSOLICITED_WARNING_MARKERS):
+            logging.warning("Unsolicited message from %s: %s", port_name, line.strip())
+        else:
+            logging.info("Unsolicited message from %s: %s", port_name, line.strip())
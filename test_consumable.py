@@ -16,13 +16,13 @@ def removeOldTestFile():
         
 class bernielib_test_case(unittest.TestCase):
 
-    @patch('bernielib.consumable._setSetting')
-    @patch('bernielib.consumable._getReadyList')
-    def test_consume(self, mock__getReadyList, mock_setSetting):
+    @patch('bernielib.consumable._settingChanged')
+    def test_consume(self, mock_settingChanged):
         tips_rack = bl.consumable('tips')
-        tips_rack._getReadyList.return_value = [[0,0], [0,1], [0,2]]
+        tips_rack.data['unused_consumable_list'] = [[0,0], [0,1], [0,2]]
         tips_rack.consume(col=0,row=0)
-        tips_rack._setSetting.assert_called_with('unused_consumable_list', [[0,1], [0,2]])
+        self.assertEqual(tips_rack.data['unused_consumable_list'], [[0,1], [0,2]])
+        tips_rack._settingChanged.assert_called_with('unused_consumable_list', 'remove', [0,0])
         
     
     
@@ -0,0 +1,92 @@
+import unittest
+import mock
+
+import time
+import asyncio
+import logging
+import threading
+
+import bernielib as bl
+import asyncrobot
+
+
+from mock import patch
+
+class asyncrobot_test_case(unittest.TestCase):
+
+    @patch('time.sleep')
+    @patch('serial.Serial')
+    def setUp(self, mock_serial, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        self.ber = bl.robot(cartesian_port_name='COM18', loadcell_port_name='COM7')
+        self.ar = asyncrobot.asyncRobot(self.ber)
+
+    def tearDown(self):
+        self.ar.close()
+        try:
+            self.ber.close()
+        except:
+            pass
+        logging.disable(logging.NOTSET)
+
+
+    def test_both_controllers_work_at_the_same_time(self):
+        def slow(result):
+            def operation(*args, **kwargs):
+                time.sleep(0.2)
+                return result
+            return operation
+
+        async def scenario():
+            return await asyncio.gather(self.ar.moveToSample('sample'), self.ar.tareAll())
+
+        with patch.object(self.ber, 'moveToSample', side_effect=slow('moved')), \
+             patch.object(self.ber, 'tareAll', side_effect=slow('tared')):
+            before = time.time()
+            result = asyncio.run(scenario())
+            elapsed = time.time() - before
+        self.assertEqual(result, ['moved', 'tared'])
+        self.assertLess(elapsed, 0.35)
+
+
+    def test_same_controller_operations_keep_order(self):
+        calls = []
+
+        async def scenario():
+            await asyncio.gather(self.ar.moveTo(x=1), self.ar.moveTo(x=2), self.ar.moveTo(x=3))
+
+        with patch.object(self.ber, 'moveTo', side_effect=lambda **kwargs: calls.append(kwargs['x'])):
+            asyncio.run(scenario())
+        self.assertEqual(calls, [1, 2, 3])
+
+
+    def test__writeAndWait_one_transaction_per_port(self):
+        events = []
+
+        def write(port, expression, eol):
+            events.append(('write', expression))
+            time.sleep(0.05)
+
+        def read(port, pattern, timeout):
+            events.append(('read', threading.current_thread().name))
+            return 'ok'
+
+        # Load cells controller version is known already
+        self.ber.loadcell_eol = ''
+        with patch.object(self.ber, '_write', side_effect=write), \
+             patch.object(self.ber, '_readUntilMatch', side_effect=read):
+            threads = [threading.Thread(target=self.ber.writeAndWaitLoadCell, args=(cmd,),
+                                        name=cmd) for cmd in ['T', 'RR']]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # Every command is immediately followed by reading its own reply
+        self.assertEqual(len(events), 4)
+        for i in [0, 2]:
+            self.assertEqual(events[i][0], 'write')
+            self.assertEqual(events[i+1], ('read', events[i][1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import unittest
 import mock
 
 import time
+import math
 import logging
 
 import bernielib as bl
@@ -9,6 +10,38 @@ import bernielib as bl
 
 from mock import patch
 
+class scriptedPort():
+    """
+    Port replying to every written command from the script: {command: reply}.
+    Commands not in the script get no reply.
+    """
+    def __init__(self, script):
+        self.script = script
+        self.written = []
+        self.raw_written = []
+        self.buffer = b''
+    
+    def write(self, data):
+        command = data.decode().strip()
+        self.written.append(command)
+        self.raw_written.append(data)
+        self.buffer += self.script.get(command, '').encode()
+    
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+    
+    def read(self, size=1):
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+    
+    def reset_input_buffer(self):
+        self.buffer = b''
+    
+    def reset_output_buffer(self):
+        pass
+
+
 class bernielib_test_case(unittest.TestCase):
     
     @patch('time.sleep')
@@ -92,6 +125,44 @@ class bernielib_test_case(unittest.TestCase):
     """        
 
     
+    def test_lookForTip_guided_by_loads(self):
+        position = {'X': 10, 'Y': 20, 'Z': 50}
+        attempts = []
+        
+        def move(x=None, y=None, z=None, **kwargs):
+            for axis, value in (('X', x), ('Y', y), ('Z', z)):
+                if value is not None:
+                    position[axis] = value
+        
+        def tipPickupAttempt():
+            attempts.append((position['X'], position['Y']))
+            px, py = position['X'] - tip[0], position['Y'] - tip[1]
+            offset = math.hypot(px, py)
+            if offset < 0.3:
+                return True
+            # The rim presses the pipette on the side away from the tip
+            self.ber.last_tip_miss = (position['X'], position['Y'], 50 - 50 * px / offset, 
+                                      50 + 50 * px / offset, (offset - 0.5) / bl.TIP_SEARCH_OFFSET_PER_DZ)
+            return False
+        
+        with patch.object(self.ber, 'move', side_effect=move), \
+             patch.object(self.ber, 'getPosition', side_effect=lambda axis: position[axis]), \
+             patch.object(self.ber, 'tipPickupAttempt', side_effect=tipPickupAttempt), \
+             patch.object(self.ber, 'getTipSearchLoadSign', return_value=1):
+            # Tip off along X: the imbalance points to it
+            tip = (9, 20)
+            self.assertFalse(self.ber.tipPickupAttempt())
+            self.assertTrue(self.ber.lookForTip())
+            self.assertEqual(attempts[1:], [(9, 20)])
+            # Tip off along Y: the loads are balanced, and the side is found by the second try
+            position.update({'X': 10, 'Y': 20})
+            tip = (10, 19)
+            del attempts[:]
+            self.assertFalse(self.ber.tipPickupAttempt())
+            self.assertTrue(self.ber.lookForTip())
+            self.assertEqual(attempts[1:], [(10, 21), (10, 19)])
+    
+    
     @patch('purify.bl.robot.writeAndWaitCartesian')
     @patch('purify.bl.robot.getPosition', return_value=100)
     def test_moveAxisDelta(self, mock_getPosition, mock_writeAndWaitCartesian):        
@@ -131,6 +202,220 @@ class bernielib_test_case(unittest.TestCase):
         self.assertTrue(waited_before_timeout >= timeout)
         
 
+    def test__readUntilMatch_BackgroundListener(self):
+        port = self.ber.loadcell_port
+        listener = mock.MagicMock()
+        listener.readLine.side_effect = ['12.5\r', None, '\n']
+        self.ber.listeners[port] = listener
+        msg = self.ber._readUntilMatch(port=port, pattern='\r\n', timeout=0.5)
+        self.assertEqual(msg, '12.5\r\n')
+        # Port is not polled directly when the listener is running
+        self.assertFalse(port.read.called)
+
+
+    def test__write_BackgroundListener_KeepsUnsolicitedMessages(self):
+        port = self.ber.cartesian_port
+        listener = mock.MagicMock()
+        listener.name = 'cartesian'
+        listener.drain.return_value = ['ALARM: Hard limit\n']
+        self.ber.listeners[port] = listener
+        with patch('bernielib.logUnsolicited') as mock_log:
+            self.ber._write(port, 'M400', '\r')
+            mock_log.assert_called_with('cartesian', ['ALARM: Hard limit\n'])
+        self.assertFalse(port.reset_input_buffer.called)
+        port.write.assert_called_with(b'M400\r')
+
+
+    @patch('purify.bl.robot._writeAndWait')
+    @patch('purify.bl.robot._readCartesianLine', return_value='ok\n')
+    @patch('purify.bl.robot._write')
+    def test_streaming_sends_M400_only_at_barrier(self, mock_write, mock_readCartesianLine, 
+            mock_writeAndWait):
+        with self.ber.streaming(window=3):
+            for z in [10, 20, 30, 40]:
+                self.ber.moveAxis('Z', z, speed=1000)
+            self.ber.moveAxis('A', 5, speed=1000)
+            # Nothing waited for the motion to finish yet
+            self.assertFalse(self.ber._writeAndWait.called)
+            # Never more than 3 commands without acknowledgement
+            self.assertEqual(self.ber.commands_in_flight, 3)
+        
+        sent = [c[2]['expression'] for c in self.ber._write.mock_calls]
+        self.assertEqual(sent, ['G0 Z10 F1000', 'G0 Z20 F1000', 'G0 Z30 F1000', 'G0 Z40 F1000', 'G0 A5 F1000'])
+        self.assertEqual(self.ber._readCartesianLine.call_count, 5)
+        self.assertEqual(self.ber.commands_in_flight, 0)
+        # Barrier at the end of the block, then the plunger stepper is powered off
+        waited = [c[2]['expression'] for c in self.ber._writeAndWait.mock_calls]
+        self.assertEqual(waited, ['M400', 'M18 A0'])
+        self.assertEqual(self.ber.streaming_window, 0)
+    
+    
+    @patch('purify.bl.robot.writeAndWaitLoadCell')
+    @patch('purify.bl.robot._writeAndWait')
+    @patch('purify.bl.robot._readCartesianLine', return_value='ok\n')
+    @patch('purify.bl.robot._write')
+    def test_streaming_load_cell_read_is_a_barrier(self, mock_write, mock_readCartesianLine, 
+            mock_writeAndWait, mock_writeAndWaitLoadCell):
+        self.ber.startStreaming(window=4)
+        self.ber.moveXY(10, 20, speed=1000)
+        self.ber.tareAll()
+        waited = [c[2]['expression'] for c in self.ber._writeAndWait.mock_calls]
+        self.assertEqual(waited, ['M400'])
+        # Nothing new was sent since; no extra barrier needed
+        self.ber.tareAll()
+        self.assertEqual(self.ber._writeAndWait.call_count, 1)
+        self.ber.stopStreaming()
+
+
+    def test_getCombinedLoad_single_request(self):
+        port = scriptedPort({'version': "Bernie's load cells controller, protocol 2\r\n",
+                             'RB': '12.50 30.25 7\r\n'})
+        self.ber.loadcell_port = port
+        self.assertEqual(self.ber.getCombinedLoad(), 42.75)
+        self.assertEqual(self.ber.readBothLoads(), (12.5, 30.25))
+        self.assertEqual(port.written, ['version', 'RB', 'RB'])
+        # New line lets the firmware execute the command right away
+        self.assertEqual(port.raw_written[-1], b'RB\n')
+        self.assertEqual(self.ber.loadcell_sample_counter, 7)
+    
+    
+    def test_getCombinedLoad_old_firmware(self):
+        port = scriptedPort({'version': "Bernie's load cells controller\r\n",
+                             'RL': '12.50\r\n', 'RR': '30.25\r\n'})
+        self.ber.loadcell_port = port
+        self.assertEqual(self.ber.getCombinedLoad(), 42.75)
+        self.assertEqual(self.ber.getCombinedLoad(), 42.75)
+        # Firmware without the protocol version has no RB
+        self.assertEqual(port.written, ['version', 'RL', 'RR', 'RL', 'RR'])
+        self.assertFalse(self.ber.loadcell_combined_read)
+        # Older firmware does not expect the new line
+        self.assertEqual(port.raw_written[-1], b'RR')
+    
+    
+    @patch('bernielib.PORT_PROBE_TIMEOUT', 0.05)
+    @patch('bernielib.LOADCELL_COMBINED_READ_CHECK_TIMEOUT', 0.05)
+    def test_getCombinedLoad_unknown_firmware(self):
+        port = scriptedPort({'RL': '12.50\r\n', 'RR': '30.25\r\n'})
+        self.ber.loadcell_port = port
+        for i in range(bl.LOADCELL_COMBINED_READ_CHECKS + 1):
+            self.assertEqual(self.ber.getCombinedLoad(), 42.75)
+        # RB is not given up after one missed reply
+        self.assertEqual(port.written, ['version'] + ['RB', 'RL', 'RR'] * bl.LOADCELL_COMBINED_READ_CHECKS + 
+                                       ['RL', 'RR'])
+        self.assertFalse(self.ber.loadcell_combined_read)
+    
+    
+    def test_load_cell_version_reply_after_welcome_message(self):
+        port = scriptedPort({'version': "Arnie's mobile gripper tool\r\nRev. 2.0, 3/21/2020\r\n"
+                                        "Bernie's load cells controller, protocol 2\r\n"})
+        self.ber.loadcell_port = port
+        self.assertEqual(self.ber._getLoadCellEol(), '\n')
+
+
+    @patch('purify.bl.robot.writeAndWaitCartesian')
+    @patch('purify.bl.robot.getPosition', return_value=10)
+    def test_moveTo_single_command_above_safe_z(self, mock_getPosition, mock_writeAndWaitCartesian):
+        self.ber.setSafeZ(50)
+        self.ber.moveTo(x=1, y=2, z=20, speed_xy=5000)
+        sent = [c[1][0] for c in self.ber.writeAndWaitCartesian.mock_calls]
+        self.assertEqual(sent, ['G0 X1 Y2 Z20 F5000', 'M400'])
+        
+        
+    @patch('purify.bl.robot.writeAndWaitCartesian')
+    @patch('purify.bl.robot.getPosition', return_value=10)
+    def test_moveTo_going_down_moves_xy_first(self, mock_getPosition, mock_writeAndWaitCartesian):
+        self.ber.setSafeZ(50)
+        self.ber.moveTo(x=1, y=2, z=100, a=3, speed_xy=5000, speed_z=1000)
+        sent = [c[1][0] for c in self.ber.writeAndWaitCartesian.mock_calls]
+        # Plunger moves with the last part of the move, and its stepper is powered off after
+        self.assertEqual(sent, ['G0 X1 Y2 F5000', 'M400', 'G0 Z100 A3 F1000', 'M400', 'M18 A0', 'M400'])
+        
+        
+    @patch('purify.bl.robot.writeAndWaitCartesian')
+    def test_moveTo_keeps_plunger_speed(self, mock_writeAndWaitCartesian):
+        self.ber.position = {'X': 0, 'Y': 0, 'Z': 100, 'A': 0}
+        # Plunger moves 10 mm while X and Z travel 5 mm; at 100 mm/min for the plunger
+        self.ber.moveTo(x=3, z=104, a=10, clear_z=110, speed_xy=5000, speed_a=100)
+        sent = [c[1][0] for c in self.ber.writeAndWaitCartesian.mock_calls]
+        self.assertEqual(sent[0], 'G0 X3 Z104 A10 F50.0')
+        
+        
+    @patch('purify.bl.robot.writeAndWaitCartesian')
+    @patch('purify.bl.robot.getPosition', return_value=120)
+    def test_moveTo_going_up_moves_z_first(self, mock_getPosition, mock_writeAndWaitCartesian):
+        self.ber.setSafeZ(50)
+        self.ber.moveTo(x=1, y=2, z=30, speed_xy=5000, speed_z=1000)
+        sent = [c[1][0] for c in self.ber.writeAndWaitCartesian.mock_calls]
+        self.assertEqual(sent, ['G0 Z30 F1000', 'M400', 'G0 X1 Y2 F5000', 'M400'])
+        
+        
+    @patch('purify.bl.robot.writeAndWaitCartesian')
+    @patch('purify.bl.robot.getPosition', return_value=120)
+    def test_move_keeps_requested_order(self, mock_getPosition, mock_writeAndWaitCartesian):
+        self.ber.setSafeZ(50)
+        self.ber.move(x=1, y=2, z=130, z_first=True, speed_xy=5000, speed_z=1000)
+        sent = [c[1][0] for c in self.ber.writeAndWaitCartesian.mock_calls]
+        self.assertEqual(sent, ['G0 Z130 F1000', 'M400', 'G0 X1 Y2 F5000', 'M400'])
+        # Position is not needed if the target is below the safe height
+        self.assertFalse(self.ber.getPosition.called)
+
+
+    def fake_cartesian_reply(self, port, expression, eol, confirm_message, timeout=5):
+        if expression == '?':
+            return 'ok\n<Idle|MPos:1.0000,2.0000,3.0000,4.0000|WPos:1.0000,2.0000,3.0000|F:3000.0,100.0>\n'
+        return 'ok\n'
+    
+    
+    def sent_cartesian_commands(self):
+        return [c[2]['expression'] for c in self.ber._writeAndWait.mock_calls]
+    
+    
+    @patch('purify.bl.robot._writeAndWait')
+    def test_getPosition_remembered_after_moves(self, mock_writeAndWait):
+        mock_writeAndWait.side_effect = self.fake_cartesian_reply
+        # Not known at the start, so the controller is asked once
+        self.assertEqual(self.ber.getPosition(), (1.0, 2.0, 3.0, 4.0))
+        self.assertEqual(self.sent_cartesian_commands().count('?'), 1)
+        
+        self.ber.moveAxis('Z', 50, speed=1000)
+        self.ber.moveXY(10, 20, speed=1000)
+        self.ber.moveAxisDelta('Z', -5.5)
+        self.assertEqual(self.ber.getPosition(axis='Z'), 44.5)
+        self.assertEqual(self.ber.getPosition(), (10.0, 20.0, 44.5, 4.0))
+        self.assertEqual(self.sent_cartesian_commands().count('?'), 1)
+        self.assertIn('G0 Z44.5 F'+str(self.ber.getSpeedZ()), self.sent_cartesian_commands())
+    
+    
+    @patch('purify.bl.robot._writeAndWait')
+    def test_getPosition_after_homing(self, mock_writeAndWait):
+        mock_writeAndWait.side_effect = self.fake_cartesian_reply
+        self.ber.moveTo(z=30)
+        self.ber.moveTo(x=10, y=20, a=1)
+        self.ber.robotHome(axis='A')
+        self.assertEqual(self.ber.getPosition(axis='Z'), 30)
+        self.assertEqual(self.sent_cartesian_commands().count('?'), 0)
+        # Homed axis is read from the controller
+        self.assertEqual(self.ber.getPosition(axis='A'), 4.0)
+        self.assertEqual(self.sent_cartesian_commands().count('?'), 1)
+        self.ber.robotHome()
+        self.assertEqual(self.ber.getPosition(axis='X'), 1.0)
+        self.assertEqual(self.sent_cartesian_commands().count('?'), 2)
+    
+    
+    @patch('purify.bl.robot._writeAndWait')
+    def test_position_verification(self, mock_writeAndWait):
+        mock_writeAndWait.side_effect = self.fake_cartesian_reply
+        self.ber.setPositionVerification(every_n_moves=2)
+        self.ber.moveAxis('X', 1, speed=1000)
+        self.assertEqual(self.sent_cartesian_commands().count('?'), 0)
+        with patch('bernielib.logging.warning') as mock_warning:
+            # Controller reports X=1, Y=2; the second move drifted
+            self.ber.moveAxis('Y', 7, speed=1000)
+            self.assertEqual(self.sent_cartesian_commands().count('?'), 1)
+            self.assertTrue(mock_warning.called)
+        self.assertEqual(self.ber.getPosition(axis='Y'), 2.0)
+
+
     def test__getBeadsVolumeCoef(self):
         a, b, c = bl.getBeadsVolumeCoef()
         # Coefficients are not None
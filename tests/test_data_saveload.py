@@ -1,9 +1,12 @@
 import unittest
 import os
 import mock
+from mock import patch
 import json
 import shutil
 import logging
+import sqlite3
+import tempfile
 
 import general
 
@@ -66,6 +69,162 @@ class settings_test_case(unittest.TestCase):
         setting_value = self.dummy_obj._getSetting('this_one_setting')
         self.assertEqual(setting_value, 42)
     
+    def test__setSetting_written_at_checkpoint(self):
+        self.dummy_obj._setSetting('this_one_setting', 42)
+        with open(self.name+'.json') as f:
+            self.assertNotIn('this_one_setting', json.loads(f.read()))
+        # Another object of the same settings sees the change
+        self.assertEqual(general.data(self.name)._getSetting('this_one_setting'), 42)
+        self.dummy_obj._setSetting('this_one_setting', 43)
+        general.checkpoint()
+        with open(self.name+'.json') as f:
+            self.assertEqual(json.loads(f.read())['this_one_setting'], 43)
+    
+    def test__setSetting_sync(self):
+        self.dummy_obj._setSetting('this_one_setting', 42, sync=True)
+        with open(self.name+'.json') as f:
+            self.assertEqual(json.loads(f.read())['this_one_setting'], 42)
+    
+    def test_purge_does_not_write_other_objects(self):
+        self.dummy_obj._setSetting('this_one_setting', 42)
+        general.data('setting_file_creation_test').purge()
+        with open(self.name+'.json') as f:
+            self.assertNotIn('this_one_setting', json.loads(f.read()))
+        self.assertIn(self.dummy_obj, general._unsaved)
+        general._unsaved.discard(self.dummy_obj)
+    
+    def test_journal_replayed_after_crash(self):
+        class journaledData(general.data):
+            journaled_settings = ('volume',)
+        obj = journaledData(self.name)
+        obj._setSetting('volume', 120.0)
+        obj._setSetting('volume', 80.0)
+        # Crashing before the checkpoint, in the middle of writing the next record
+        general._unsaved.discard(obj)
+        general._journal_applied.clear()
+        with open(general.JOURNAL_PATH, 'a') as f:
+            f.write('{"obj": "%s", "key": "vol' % self.name)
+        self.assertEqual(journaledData(self.name)._getSetting('volume'), 80.0)
+        general.checkpoint()
+        self.assertFalse(os.path.exists(general.JOURNAL_PATH))
+        with open(self.name+'.json') as f:
+            self.assertEqual(json.loads(f.read())['volume'], 80.0)
+    
+    def test_journal_list_items(self):
+        class journaledData(general.data):
+            journaled_settings = ('ready',)
+        obj = journaledData(self.name)
+        obj._setSetting('ready', [[0, 0], [0, 1], [1, 0]], sync=True)
+        general.checkpoint()
+        obj._removeFromSetting('ready', [0, 0])
+        obj._removeFromSetting('ready', [5, 5])
+        obj._addToSetting('ready', [2, 2])
+        # Only the items are journaled
+        self.assertEqual(general._readJournal(self.name), [('ready', 'remove', [0, 0]), ('ready', 'add', [2, 2])])
+        # Crashing before the checkpoint
+        general._unsaved.discard(obj)
+        general._journal_applied.clear()
+        self.assertEqual(journaledData(self.name)._getSetting('ready'), [[0, 1], [1, 0], [2, 2]])
+        general.checkpoint()
+    
+    def test_journal_compaction_keeps_objects_not_loaded(self):
+        class journaledData(general.data):
+            journaled_settings = ('volume',)
+        # Left by a crashed run
+        with open(general.JOURNAL_PATH, 'w') as f:
+            f.write(json.dumps({'obj': 'journal_test_not_loaded', 'key': 'volume', 'v': 55}) + '\n')
+        obj = journaledData(self.name)
+        obj._setSetting('volume', 120.0)
+        general.checkpoint()
+        self.assertEqual(general._readJournal(self.name), [])
+        self.assertEqual(general._readJournal('journal_test_not_loaded'), [('volume', 'v', 55)])
+        self.assertEqual(journaledData('journal_test_not_loaded')._getSetting('volume'), 55)
+        # Purged objects do not get their journaled changes back
+        obj._setSetting('volume', 90.0)
+        obj.purge()
+        self.assertFalse(journaledData(self.name)._settingPresent('volume'))
+    
+    def test_sqlite_storage(self):
+        directory = tempfile.mkdtemp()
+        db_path = os.path.join(directory, 'settings.db')
+        storage = general.sqliteStorage(db_path)
+        general.setStorage(storage)
+        try:
+            # Settings of the file storage are kept
+            obj = general.data(self.name)
+            self.assertEqual(obj._getSetting('the_other_setting'), 38)
+            with general.transaction():
+                obj._setSetting('this_one_setting', [1, 2.5])
+                general.data('other_setting_name')._setSetting('other', 'text', sync=True)
+            general.checkpoint()
+            rows = sqlite3.connect(db_path).execute('SELECT object, key, value FROM settings').fetchall()
+            self.assertIn((self.name, 'this_one_setting', '[1, 2.5]'), rows)
+            self.assertIn(('other_setting_name', 'other', '"text"'), rows)
+            self.assertEqual(general.data(self.name)._getSetting('this_one_setting'), [1, 2.5])
+            # All objects are read with one query on the start
+            general.setStorage(general.sqliteStorage(db_path))
+            storage.close()
+            storage = general._storage
+            self.assertEqual(general.data('other_setting_name')._getSetting('other'), 'text')
+            general.data('other_setting_name').purge()
+            self.assertFalse(general.data('other_setting_name')._settingPresent('other'))
+        finally:
+            general.setStorage(general.jsonFileStorage())
+            storage.close()
+            shutil.rmtree(directory)
+    
+    def test_sqlite_storage_purge_does_not_bring_file_back(self):
+        directory = tempfile.mkdtemp()
+        storage = general.sqliteStorage(os.path.join(directory, 'settings.db'))
+        general.setStorage(storage)
+        try:
+            # Only in the file of the file storage
+            obj = general.data(self.name)
+            self.assertEqual(obj._getSetting('the_other_setting'), 38)
+            obj.purge()
+            obj.loadData()
+            self.assertFalse(obj._settingPresent('the_other_setting'))
+            self.assertFalse(general.data(self.name)._settingPresent('the_other_setting'))
+        finally:
+            general.setStorage(general.jsonFileStorage())
+            storage.close()
+            shutil.rmtree(directory)
+    
+    def test_shared_objects(self):
+        obj = general.data.shared(self.name)
+        self.assertIs(general.data.shared(self.name), obj)
+        obj._setSetting('this_one_setting', 42)
+        general.data.evict(self.name)
+        # Unsaved changes are written on eviction
+        self.assertEqual(general.data(self.name)._getSetting('this_one_setting'), 42)
+        self.assertIsNot(general.data.shared(self.name), obj)
+        general.data.evict()
+        
+    def test_journal_kept_till_outer_transaction_commits(self):
+        class journaledData(general.data):
+            journaled_settings = ('volume',)
+        directory = tempfile.mkdtemp()
+        storage = general.sqliteStorage(os.path.join(directory, 'settings.db'))
+        general.setStorage(storage)
+        try:
+            obj = journaledData(self.name)
+            obj._setSetting('volume', 120.0)
+            with self.assertRaises(RuntimeError):
+                with general.transaction():
+                    general.checkpoint()
+                    self.assertEqual(general._readJournal(self.name), [('volume', 'v', 120.0)])
+                    raise RuntimeError("crash before the commit")
+            self.assertEqual(general._readJournal(self.name), [('volume', 'v', 120.0)])
+            self.assertIn(obj, general._unsaved)
+            with general.transaction():
+                general.checkpoint()
+            self.assertEqual(general._readJournal(self.name), [])
+            self.assertEqual(storage.load(self.name)['volume'], 120.0)
+        finally:
+            general.setStorage(general.jsonFileStorage())
+            storage.close()
+            shutil.rmtree(directory)
+    
     def test__request_nonexisting_setting(self):
         self.assertFalse(self.dummy_obj._settingPresent('this_one_setting'))
         self.assertIsNone(self.dummy_obj._getSetting('this_one_setting'))
@@ -98,6 +257,39 @@ class settings_test_case(unittest.TestCase):
         self.assertTrue(self.dummy_obj._settingPresent('setting_only_in_factory_default'))
         
 
+    def test__loadFactoryDefault_cached_till_modified(self):
+        self.dummy_obj.factory_default_path = self.setting_path
+        general.preloadFactoryDefaults(self.factory_default_test_dir)
+        with patch('general.open', side_effect=open) as mock_open:
+            data = self.dummy_obj.loadFactoryDefault()
+            data['setting_only_in_factory_default'] = 0
+            self.assertEqual(self.dummy_obj.loadFactoryDefault()['setting_only_in_factory_default'], 19)
+            self.assertEqual(mock_open.call_count, 0)
+            with open(self.setting_path, 'w') as f:
+                f.write(json.dumps({'setting_only_in_factory_default': 20}))
+            stat = os.stat(self.setting_path)
+            os.utime(self.setting_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(self.dummy_obj.loadFactoryDefault()['setting_only_in_factory_default'], 20)
+            self.assertEqual(mock_open.call_count, 1)
+        
+    def test__loadFactoryDefault_cached_by_absolute_path(self):
+        relative_path = os.path.join('factory_default_for_test_purposes', self.name + '.json')
+        self.assertEqual(general.readFactoryDefault(relative_path)['setting_only_in_factory_default'], 19)
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.mkdir(os.path.join(directory, 'factory_default_for_test_purposes'))
+            with open(os.path.join(directory, relative_path), 'w') as f:
+                f.write(json.dumps({'setting_only_in_factory_default': 21}))
+            # Same modification time, so only the path tells the files apart
+            stat = os.stat(self.setting_path)
+            os.utime(os.path.join(directory, relative_path), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.chdir(directory)
+            self.assertEqual(general.readFactoryDefault(relative_path)['setting_only_in_factory_default'], 21)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+        
     def test__internal_factory_default_mock_exist(self):
         self.assertTrue(os.path.exists(self.setting_path))
 
@@ -111,6 +303,14 @@ class settings_test_case(unittest.TestCase):
             os.remove('setting_file_creation_test.json')
         except:
             pass
+        try:
+            os.remove(general.JOURNAL_PATH)
+        except:
+            pass
+        try:
+            os.remove('journal_test_not_loaded.json')
+        except:
+            pass
         try:
             os.remove(self.setting_path)
         except:
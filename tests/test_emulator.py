@@ -0,0 +1,380 @@
+import unittest
+import mock
+
+import time
+import threading
+import logging
+
+import emulator
+import serialcomm
+import loadcellstream
+import bernielib as bl
+
+
+from mock import patch
+
+class silentDevice(emulator.emulatedDevice):
+    """
+    Device that never replies.
+    """
+    def receive(self, data, now):
+        return []
+
+
+class drivenCondition(threading.Condition):
+    """
+    Condition whose wait feeds one reading instead of waiting for the port listener.
+    """
+    def __init__(self, feed):
+        super().__init__()
+        self.feed = feed
+
+    def wait(self, timeout=None):
+        self.feed()
+        return True
+
+
+class drivenLoadStream(loadcellstream.loadRingBuffer):
+    """
+    Load cells readings taken from the emulator when the robot waits for them, sample_period 
+    apart; does not depend on the port listener thread and the wall clock.
+    """
+    def __init__(self, loadcells, sample_period=0.01):
+        super().__init__(size=64)
+        self.loadcells = loadcells
+        self.sample_period = sample_period
+        self.clock = 0
+        self.condition = drivenCondition(self.feedReading)
+
+    def feedReading(self):
+        self.clock += self.sample_period
+        left, right = self.loadcells.rawLoads(time.time())
+        self.append(self.clock, left - self.loadcells.offset_left, right - self.loadcells.offset_right)
+
+
+class emulator_test_case(unittest.TestCase):
+
+    def test_smoothie_move_and_status(self):
+        smoothie = emulator.smoothieEmulator(time_scale=0)
+        port = emulator.emulatedPort(smoothie, timeout=1)
+        port.write(b'G0 X10 Y20 Z30 F3000\r')
+        self.assertEqual(port.read(3), b'ok\n')
+        port.write(b'?\r')
+        reply = port.read(port.in_waiting).decode()
+        self.assertEqual(serialcomm.parseStatusReply(reply), ('Idle', 10.0, 20.0, 30.0, 0.0))
+        port.write(b'G28.2 Z\r')
+        port.read(3)
+        self.assertEqual(smoothie.targetPosition()['Z'], 0)
+        self.assertEqual(smoothie.command_counts['G0'], 1)
+
+    def test_smoothie_M400_waits_for_the_move(self):
+        smoothie = emulator.smoothieEmulator(time_scale=1)
+        port = emulator.emulatedPort(smoothie, timeout=2)
+        # 6 mm at 3600 mm/min takes 0.1 s
+        port.write(b'G0 X6 F3600\r')
+        self.assertEqual(port.read(3), b'ok\n')
+        before = time.time()
+        port.write(b'M400\r')
+        self.assertEqual(port.read(3), b'ok\n')
+        self.assertGreaterEqual(time.time() - before, 0.08)
+        self.assertEqual(smoothie.positionAt(time.time())['X'], 6)
+
+    def test_deck_loads(self):
+        deck = emulator.virtualDeck(floor_z=100, stiffness=1000)
+        deck.addSurface(50, x_range=(0, 10), y_range=(0, 10), stiffness=100, left_share=1)
+        self.assertEqual(deck.loads(20, 20, 99), (0, 0))
+        self.assertEqual(deck.loads(20, 20, 101), (500, 500))
+        self.assertEqual(deck.loads(5, 5, 60), (1000, 0))
+
+    def test_loadcell_tare_and_read(self):
+        vr = emulator.virtualRobot(deck=emulator.virtualDeck(floor_z=10, stiffness=100), time_scale=0)
+        port = emulator.emulatedPort(vr.loadcells, timeout=1)
+        vr.smoothie.execute('G0 Z12', 0)
+        port.write(b'RL')
+        self.assertEqual(port.read(port.in_waiting), b'100.00\r\n')
+        port.write(b'T')
+        self.assertEqual(port.read(port.in_waiting), b'ok/n\r\n')
+        port.write(b'RR')
+        self.assertEqual(port.read(port.in_waiting), b'0.00\r\n')
+        port.write(b'version')
+        self.assertEqual(port.read(port.in_waiting), b"Bernie's load cells controller, protocol 2\r\n")
+
+    def test_port_read_timeout(self):
+        port = emulator.emulatedPort(emulator.smoothieEmulator(time_scale=0), timeout=0.05)
+        before = time.time()
+        self.assertEqual(port.read(1), b'')
+        self.assertGreaterEqual(time.time() - before, 0.05)
+
+    @patch('time.sleep')
+    def test_robot_on_emulator(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(deck=emulator.virtualDeck(floor_z=120, stiffness=1000), time_scale=0)
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_emulator')
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            ber.move(x=10, y=10, z=100)
+            z = ber.moveDownUntilPress(step=0.5, threshold=400)
+            self.assertEqual(z, 120.5)
+            self.assertEqual(ber.resyncPosition(), (10.0, 10.0, 120.5, 0.0))
+            ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+        self.assertEqual(vr.commandCounts()['loadcell']['T'], 1)
+
+    @patch('time.sleep')
+    def test_robot_loadcell_streaming(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(deck=emulator.virtualDeck(floor_z=120, stiffness=1000), time_scale=0)
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_stream')
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            stream = ber.startLoadCellStreaming(buffer_size=64)
+            self.assertIsNotNone(stream)
+            ber.move(x=10, y=10, z=121)
+            self.assertEqual(ber.readBothLoads(), (500, 500))
+            reading = stream.waitForThreshold(900, timeout=1)
+            self.assertEqual(reading[1:], (500, 500))
+            ber.tareAll()
+            self.assertEqual(ber.getCombinedLoad(), 0)
+            ber.stopLoadCellStreaming()
+            self.assertIsNone(ber.load_stream)
+            self.assertEqual(ber.getCombinedLoad(), 0)
+            ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+        counts = vr.commandCounts()['loadcell']
+        self.assertEqual(counts['S'], 2)
+        self.assertEqual(counts['RB'], 1)
+
+    @patch('time.sleep')
+    def test_moveDownUntilPress_continuous(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(deck=emulator.virtualDeck(floor_z=120, stiffness=1000), time_scale=1)
+        # Load readings every 10 ms
+        vr.loadcells.sample_period = 0.01
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_probe')
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            ber.startLoadCellStreaming()
+            ber.move(x=10, y=10, z=118)
+            z = ber.moveDownUntilPress(step=0.1, threshold=400, z_max=130, continuous=True)
+            # Touched at 120, threshold at 120.4; stopped within about one step after that
+            self.assertGreater(z, 120.35)
+            self.assertLess(z, 120.7)
+            self.assertEqual(ber.getPosition(axis='Z'), z)
+            self.assertFalse(vr.smoothie.halted)
+            ber.move(z=100)
+            self.assertEqual(ber.resyncPosition()[2], 100)
+            ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+        counts = vr.commandCounts()
+        self.assertEqual(counts['cartesian']['$X'], 1)
+        self.assertEqual(counts['loadcell']['RL'] + counts['loadcell']['RB'], 0)
+
+    @patch('time.sleep')
+    def test_moveDownUntilPress_predicted(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(deck=emulator.virtualDeck(floor_z=120, stiffness=1000), time_scale=0)
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_predicted')
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            ber.move(x=10, y=10, z=100)
+            with patch.object(ber, 'moveAxis', wraps=ber.moveAxis) as mock_moveAxis:
+                z = ber.moveDownUntilPress(step=0.1, threshold=400, z_predicted=120.3)
+            # Threshold is reached at 120.4
+            self.assertGreaterEqual(z, 120.4)
+            self.assertLessEqual(z, 120.5)
+            self.assertLess(mock_moveAxis.call_count, 10)
+            # Contact below the expected window
+            ber.move(z=100)
+            self.assertEqual(ber.moveDownUntilPress(step=0.5, threshold=400, z_predicted=110), 120.5)
+            # Contact above the expected window
+            ber.move(z=100)
+            self.assertEqual(ber.moveDownUntilPress(step=0.5, threshold=400, z_predicted=130), 120.5)
+            ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+
+    @patch('time.sleep')
+    def test_moveDownUntilPress_refined(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(deck=emulator.virtualDeck(floor_z=120.23, stiffness=1000), time_scale=0)
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_refined')
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            ber.move(x=10, y=10, z=118)
+            # Steps reach the threshold at 121; the threshold itself is at 120.63
+            z = ber.moveDownUntilPress(step=0.5, threshold=400, refine=True)
+            self.assertAlmostEqual(z, 120.63, places=2)
+            self.assertEqual(ber.resyncPosition()[2], z)
+            # 770 at 121 is over 1.5 thresholds already; no step past it
+            self.assertEqual(ber.last_force_curve.asArray()[-1, 0], 121)
+            ber.move(z=118)
+            # 770 at 121 is under 1.5 thresholds; stepping on to 900 only, not the half step
+            z = ber.moveDownUntilPress(step=0.5, threshold=600, refine=True)
+            self.assertAlmostEqual(z, 120.83, places=2)
+            self.assertAlmostEqual(ber.last_force_curve.asArray()[-1, 0], 121.13)
+            ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+
+    @patch('time.sleep')
+    def test_tare_during_travel(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(deck=emulator.virtualDeck(floor_z=120, stiffness=1000), time_scale=1)
+        # Tare takes 0.3 s
+        vr.loadcells.sample_period = 0.03
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_tare')
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            ber.move(x=0, y=0, z=119.5)
+            before = time.time()
+            ber.startTare()
+            # 0.3 s of travel
+            ber.move(x=30, speed_xy=6000)
+            z = ber.moveDownUntilPress(step=0.5, threshold=400)
+            elapsed = time.time() - before
+            ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+        self.assertEqual(z, 120.5)
+        self.assertEqual(vr.commandCounts()['loadcell']['T'], 1)
+        self.assertLess(elapsed, 0.5)
+
+    @patch('time.sleep')
+    def test_tare_discarded_after_lift(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(deck=emulator.virtualDeck(floor_z=120, stiffness=1000), time_scale=0)
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_stale_tare')
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            ber.move(x=0, y=0, z=110)
+            ber.startTare()
+            ber.move(x=30, z=119.5, z_first=False)
+            # Not probed there; lifted and moved on
+            ber.move(z=100)
+            ber.move(x=60, z=119.5, z_first=False)
+            z = ber.moveDownUntilPress(step=0.5, threshold=400)
+            ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+        self.assertEqual(z, 120.5)
+        self.assertEqual(vr.commandCounts()['loadcell']['T'], 2)
+
+    @patch('time.sleep')
+    def test_scanForStairFine_continuous(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        deck = emulator.virtualDeck(floor_z=140, stiffness=1000)
+        deck.addSurface(120, x_range=(0, 50.3))
+        # Instant moves: the slide is over when the first reading after it is taken
+        vr = emulator.virtualRobot(deck=deck, time_scale=0)
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_stair')
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            ber.setPositioningParameters(step_list=[1, 0.2], z_increment=0.1, z_retract=-1, 
+                                         z_max_travel=3, z_threshold=500)
+            ber.load_stream = drivenLoadStream(vr.loadcells)
+            ber.move(x=45, y=10, z=119)
+            with patch.object(ber, 'writeAndWaitCartesian', wraps=ber.writeAndWaitCartesian) as mock_write:
+                x = ber.scanForStairFine('X', direction=1, continuous=True)
+            sent = [c[1][0] for c in mock_write.mock_calls]
+            ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+        # Pressed with 600 at Z 120.3, lifted to 200 at Z 120.1 for the slide of 0.2 mm per reading
+        slide = sent.index('G1 X60.0 F1200.0')
+        self.assertEqual(sent[slide-2], 'G0 Z120.1 F10000')
+        self.assertAlmostEqual(vr.smoothie.positionAt(time.time())['X'], x)
+        # The load dropped at the first reading, X 45.2; refined from one coarse step back, 
+        # though the pipette went on to X 60.
+        self.assertAlmostEqual(x, 50.4)
+        self.assertEqual(vr.commandCounts()['cartesian']['$X'], 1)
+
+    @patch('time.sleep')
+    def test_mapPorts_probes_ports_concurrently(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(time_scale=0)
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_map')
+        silent_names = ['test_map:silent%s' % i for i in range(3)]
+        for name in silent_names:
+            serialcomm.registerTransport(name, lambda baudrate, timeout: 
+                    emulator.emulatedPort(silentDevice(), timeout=timeout))
+        port_names = silent_names + [loadcell_port_name, cartesian_port_name]
+        ports_info = [mock.MagicMock(device=name, vid=0x2341) for name in port_names]
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            with patch('bernielib.listSerialPortsInfo', return_value=ports_info):
+                before = time.time()
+                ports = ber._mapPorts(timeout=0.3)
+                elapsed = time.time() - before
+            ber.close()
+        finally:
+            vr.unregister()
+            for name in silent_names:
+                serialcomm.unregisterTransport(name)
+            logging.disable(logging.NOTSET)
+        self.assertEqual(ports, {'cartesian': cartesian_port_name, 'loadcell': loadcell_port_name})
+        self.assertLess(elapsed, 0.6)
+
+    @patch('time.sleep')
+    def test_robot_start_with_saved_ports(self, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        vr = emulator.virtualRobot(time_scale=0)
+        cartesian_port_name, loadcell_port_name = vr.register(prefix='test_cache')
+        port_map = {'cartesian': cartesian_port_name, 'loadcell': loadcell_port_name}
+        ports_info = [mock.MagicMock(device=cartesian_port_name, vid=0x1d50, pid=0x6015, serial_number='S1'),
+                      mock.MagicMock(device=loadcell_port_name, vid=0x2341, pid=0x0043, serial_number='A1')]
+        try:
+            ber = bl.robot(cartesian_port_name=cartesian_port_name, loadcell_port_name=loadcell_port_name)
+            ber.forgetPortMap()
+            ber.close()
+            with patch('bernielib.listSerialPortsInfo', return_value=ports_info), \
+                 patch('bernielib.robot._mapPortsWithRetries', return_value=port_map) as mock_map:
+                # First start searches for the ports
+                ber = bl.robot()
+                ber.close()
+                self.assertEqual(mock_map.call_count, 1)
+                mock_sleep.reset_mock()
+                # Second start uses the saved ones, without the waiting
+                ber = bl.robot()
+                self.assertEqual(mock_map.call_count, 1)
+                mock_sleep.assert_not_called()
+                self.assertEqual(ber.getCombinedLoad(), 0)
+                ber.close()
+                # Swapped ports fail the check and are searched for again
+                ports_info[0].serial_number, ports_info[1].serial_number = 'A1', 'S1'
+                ports_info[0].vid, ports_info[1].vid = 0x2341, 0x1d50
+                ports_info[0].pid, ports_info[1].pid = 0x0043, 0x6015
+                ber = bl.robot()
+                self.assertEqual(mock_map.call_count, 2)
+                ber.close()
+                # Saved port that fails to open is forgotten and searched for again
+                vr.unregister()
+                def reconnected():
+                    vr.register(prefix='test_cache')
+                    return port_map
+                mock_map.side_effect = reconnected
+                with patch.object(bl.robot, 'forgetPortMap', autospec=True, 
+                                  side_effect=bl.robot.forgetPortMap) as mock_forget:
+                    ber = bl.robot()
+                mock_forget.assert_called_once()
+                self.assertEqual(mock_map.call_count, 3)
+                self.assertEqual(ber.getCombinedLoad(), 0)
+                ber.forgetPortMap()
+                ber.close()
+        finally:
+            vr.unregister()
+            logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
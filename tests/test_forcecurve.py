@@ -0,0 +1,43 @@
+import unittest
+import mock
+
+import os
+import tempfile
+
+import numpy as np
+
+import forcecurve
+
+
+class forcecurve_test_case(unittest.TestCase):
+
+    def test_fitContact(self):
+        z = np.arange(100, 104, 0.5)
+        load = 5 + 1000 * np.maximum(0, z - 102.3)
+        z_contact, baseline, slope = forcecurve.fitContact(z, load)
+        self.assertAlmostEqual(z_contact, 102.3, places=2)
+        self.assertAlmostEqual(baseline, 5, places=0)
+        self.assertAlmostEqual(slope, 1000, delta=10)
+
+    def test_fitContact_needs_two_readings_on_the_ramp(self):
+        z = [100, 100.5, 101, 101.5]
+        self.assertIsNone(forcecurve.fitContact(z, [0, 0, 0, 300]))
+        self.assertIsNone(forcecurve.fitContact(z, [0, 0, 0, 0]))
+
+    def test_thresholdZ_and_save(self):
+        curve = forcecurve.forceCurve()
+        for z in [119.5, 120, 120.5, 121, 121.5]:
+            load = 1000 * max(0, z - 120.23)
+            curve.add(z, load * 0.4, load * 0.6)
+        self.assertAlmostEqual(curve.thresholdZ(400), 120.63, places=2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'probe.csv')
+            curve.save(path)
+            saved = np.loadtxt(path, delimiter=',')
+            with open(path) as f:
+                self.assertTrue(f.readline().startswith('# contact z 120.23'))
+        np.testing.assert_allclose(saved, curve.asArray(), atol=1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
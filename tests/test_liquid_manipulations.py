@@ -139,6 +139,8 @@ class bernielib_test_case(unittest.TestCase):
 
 
     @patch('time.sleep')
+    @patch('purify.bl.robot.getPosition', return_value=100)
+    @patch('purify.bl.robot.moveTo')
     @patch('purify.bl.robot.movePipetteToVolume')
     @patch('purify.bl.robot.moveDownUntilPress')
     @patch('purify.bl.robot.moveAxisDelta')
@@ -147,7 +149,8 @@ class bernielib_test_case(unittest.TestCase):
             sample, volume, v_insert_override, lag_vol, dry_tube,
             in_place, ignore_calibration, z_bottom,
             mock_moveToSample, mock_moveAxisDelta,
-            mock_moveDownUntilPress, mock_movePipetteToVolume, mock_sleep):
+            mock_moveDownUntilPress, mock_movePipetteToVolume, 
+            mock_moveTo, mock_getPosition, mock_sleep):
         
         # Mocked Z coordinate of the bottom of the tube
         self.ber.moveDownUntilPress.return_value = z_bottom
@@ -0,0 +1,61 @@
+import unittest
+import mock
+
+import time
+import threading
+
+import loadcellstream
+
+
+class loadcellstream_test_case(unittest.TestCase):
+
+    def test_feedLine(self):
+        stream = loadcellstream.loadRingBuffer(size=4)
+        self.assertTrue(stream.feedLine('D 1.50 -2.00 7\r\n'))
+        self.assertFalse(stream.feedLine('ok/n\r\n'))
+        self.assertFalse(stream.feedLine('1.50 -2.00 7\r\n'))
+        timestamp, left, right = stream.latest()
+        self.assertEqual((left, right), (1.5, -2.0))
+        self.assertEqual(stream.last_counter, 7)
+        self.assertEqual(stream.count, 1)
+
+    def test_buffer_keeps_latest_readings(self):
+        stream = loadcellstream.loadRingBuffer(size=4)
+        self.assertIsNone(stream.latest())
+        for i in range(10):
+            stream.append(100 + i, i, 2 * i)
+        self.assertEqual(stream.latest(), (109, 9, 18))
+        self.assertEqual(stream.window(100, now=109)[:, 0].tolist(), [106, 107, 108, 109])
+        self.assertEqual(stream.window(1.5, now=109)[:, 1].tolist(), [8, 9])
+        self.assertEqual(stream.windowMean(1.5, now=109), (8.5, 17))
+        self.assertIsNone(stream.windowMean(1, now=200))
+
+    def test_waitForThreshold(self):
+        stream = loadcellstream.loadRingBuffer(size=16)
+        # Readings before the call are not checked
+        stream.append(1, 500, 500)
+
+        def feed():
+            for i in range(5):
+                time.sleep(0.01)
+                stream.append(2 + i, 50 * i, 50 * i)
+        thread = threading.Thread(target=feed)
+        thread.start()
+        reading = stream.waitForThreshold(300, timeout=1)
+        thread.join()
+        self.assertEqual(reading, (5, 150, 150))
+        before = time.time()
+        self.assertIsNone(stream.waitForThreshold(300, timeout=0.05))
+        self.assertGreaterEqual(time.time() - before, 0.05)
+
+    def test_nextReading(self):
+        stream = loadcellstream.loadRingBuffer(size=4)
+        stream.append(1, 1, 1)
+        timer = threading.Timer(0.02, stream.append, args=(2, 3, 4))
+        timer.start()
+        self.assertEqual(stream.nextReading(timeout=1), (2, 3, 4))
+        self.assertIsNone(stream.nextReading(timeout=0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
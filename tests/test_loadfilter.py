@@ -0,0 +1,64 @@
+import unittest
+import mock
+
+import logging
+
+import numpy as np
+
+import bernielib as bl
+import loadfilter
+
+
+from mock import patch
+
+class loadfilter_test_case(unittest.TestCase):
+
+    def test_raw_readings_by_default(self):
+        load_filter = loadfilter.loadFilter.fromProfile({})
+        self.assertEqual(load_filter.feed([0, 1, 2], [10, 150, 20], 100), 1)
+
+    def test_median_ignores_spike(self):
+        load_filter = loadfilter.loadFilter(median=3)
+        loads = [0, 0, 300, 0, 0, 120, 130, 140]
+        self.assertEqual(load_filter.feed(np.arange(len(loads)), loads, 100), 6)
+
+    def test_chunks_give_same_result(self):
+        rng = np.random.default_rng(0)
+        loads = rng.normal(50, 20, 40)
+        whole = loadfilter.loadFilter(median=5, ema_alpha=0.3).filter(loads)
+        load_filter = loadfilter.loadFilter(median=5, ema_alpha=0.3)
+        chunks = np.concatenate([load_filter.filter(loads[i:i+7]) for i in range(0, len(loads), 7)])
+        np.testing.assert_allclose(chunks, whole)
+
+    def test_rate_of_change(self):
+        load_filter = loadfilter.loadFilter(rate_threshold=1000)
+        times = [0, 0.1, 0.2, 0.3]
+        self.assertIsNone(load_filter.feed(times, [0, 10, 20, 30], 500))
+        self.assertEqual(load_filter.feed([0.4, 0.5], [40, 200], 500), 1)
+
+    @patch('time.sleep')
+    @patch('serial.Serial')
+    def test_robot_filter_profiles(self, mock_serial, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        ber = bl.robot(cartesian_port_name='COM1', loadcell_port_name='COM2')
+        try:
+            self.assertEqual(ber.getLoadFilterProfile('test_probe'), loadfilter.FILTER_DEFAULTS)
+            ber.setLoadFilterProfile('test_probe', median=3)
+            self.assertEqual(ber.getLoadFilterProfile('test_probe')['median'], 3)
+            loads = [0, 0, 300, 0, 0, 120, 130, 140]
+            with patch.object(ber, 'moveAxis'), \
+                 patch.object(ber, 'getCombinedLoad', side_effect=loads), \
+                 patch.object(ber, 'getPosition', return_value=100):
+                ber.moveDownUntilPress(1, 100, tare=False, filter_profile='test_probe')
+                # Stopped at the second reading above the threshold, not at the spike
+                self.assertEqual(ber.moveAxis.call_count, 6)
+        finally:
+            profiles = ber._getSetting('load_filter_profiles')
+            del profiles['test_probe']
+            ber._setSetting('load_filter_profiles', profiles)
+            ber.close()
+            logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -46,6 +46,25 @@ class bernielib_test_case(unittest.TestCase):
         self.assertEqual(s1.getWell(), (1, 0))
         self.assertEqual(s1.getVolume(), 0)
 
+    def test_predictZBottom_from_other_samples(self):
+        s1 = bl.createSample(self.sample_type, 's1', self.ber.samples_rack, 1, 0, 0)
+        s1.stype.purge()
+        s2 = bl.createSample(self.sample_type, 's2', self.ber.samples_rack, 2, 0, 0)
+        with patch('samples.sample.getSampleTopAbsZ', return_value=100):
+            self.assertIsNone(s2.predictZBottom())
+            s1.setZBottom(140)
+            s1.shareZBottom(140)
+            self.assertEqual(s1.predictZBottom(), 140)
+            self.assertEqual(s2.predictZBottom(), 140)
+        s1.stype.purge()
+
+    def test_createSample_shares_objects(self):
+        s1 = bl.createSample(self.sample_type, 's1', self.ber.samples_rack, 1, 0, 100)
+        s2 = bl.createSample(self.sample_type, 's2', self.ber.samples_rack, 2, 0, 0)
+        self.assertIs(s1.stype, s2.stype)
+        self.assertIs(bl.createSample(self.sample_type, 's1', self.ber.samples_rack, 1, 0, 50), s1)
+        self.assertEqual(s1.getVolume(), 50)
+
     def test_SaveSampleTypeSetting(self):
         s1 = bl.createSample(self.sample_type, self.sample_name, self.ber.samples_rack, 1, 0, 0)
         
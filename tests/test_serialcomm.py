@@ -0,0 +1,103 @@
+import unittest
+import mock
+import time
+import threading
+
+import serialcomm
+
+
+class chunkedPort():
+    """
+    Minimal port: returns prepared chunks, then blocks like a port with a timeout.
+    """
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.closed = threading.Event()
+
+    @property
+    def in_waiting(self):
+        if self.chunks:
+            return len(self.chunks[0])
+        return 0
+
+    def read(self, size=1):
+        if self.chunks:
+            return self.chunks.pop(0)
+        if self.closed.wait(0.05):
+            raise OSError("Port closed")
+        return b''
+
+    def close(self):
+        self.closed.set()
+
+
+class serialcomm_test_case(unittest.TestCase):
+
+    def test_readAvailable_reads_everything_at_once(self):
+        port = mock.MagicMock()
+        port.in_waiting = 5
+        port.read.return_value = b'ok\nok'
+        self.assertEqual(serialcomm.readAvailable(port), b'ok\nok')
+        port.read.assert_called_once_with(5)
+
+    def test_readAvailable_nothing_waiting(self):
+        port = mock.MagicMock()
+        port.in_waiting = 0
+        self.assertEqual(serialcomm.readAvailable(port), b'')
+        self.assertFalse(port.read.called)
+
+    def test_lineBuffer_splits_lines_across_chunks(self):
+        buf = serialcomm.lineBuffer()
+        self.assertEqual(buf.feed(b'o'), [])
+        self.assertEqual(buf.feed(b'k\r\n12.'), ['ok\r\n'])
+        self.assertEqual(buf.pending(), '12.')
+        self.assertEqual(buf.feed(b'5\r\nok\nok\n'), ['12.5\r\n', 'ok\n', 'ok\n'])
+        self.assertEqual(buf.pending(), '')
+
+    def test_matchBuffer_terminator_split_between_reads(self):
+        reply = serialcomm.matchBuffer('ok\n')
+        self.assertFalse(reply.feed('asdf'))
+        self.assertFalse(reply.feed('o'))
+        self.assertFalse(reply.feed(''))
+        self.assertTrue(reply.feed('k\n'))
+        self.assertEqual(reply.message, 'asdfok\n')
+
+    def test_matchBuffer_regex_terminator_split_between_reads(self):
+        reply = serialcomm.matchBuffer('ALARM[^\n]*\n')
+        self.assertFalse(reply.feed('ok\r\nALARM: Hard limit -X'))
+        self.assertTrue(reply.feed(' triggered\n'))
+
+    def test_parseStatusReply(self):
+        msg = 'ok\n<Idle|MPos:1.5000,-2.0000,100.2500,3.0000|WPos:1.5000,-2.0000,100.2500|F:3000.0,100.0>\n'
+        self.assertEqual(serialcomm.parseStatusReply(msg), ('Idle', 1.5, -2.0, 100.25, 3.0))
+        self.assertIsNone(serialcomm.parseStatusReply('ok\n'))
+
+    def test_portListener_queues_complete_lines(self):
+        port = chunkedPort([b'Build vers', b'ion: 1\r\nok', b'\n'])
+        listener = serialcomm.portListener(port, name='test')
+        listener.start()
+        self.assertEqual(listener.readLine(timeout=1), 'Build version: 1\r\n')
+        self.assertEqual(listener.readLine(timeout=1), 'ok\n')
+        before = time.time()
+        self.assertIsNone(listener.readLine(timeout=0.1))
+        self.assertTrue(time.time() - before >= 0.1)
+        listener.stop()
+        port.close()
+        listener.join(1)
+        self.assertFalse(listener.is_alive())
+
+    def test_portListener_drain(self):
+        port = chunkedPort([b'ALARM: Hard limit\nok\n'])
+        listener = serialcomm.portListener(port, name='test')
+        listener.start()
+        before = time.time()
+        while listener.lines.qsize() < 2 and time.time() - before < 1:
+            time.sleep(0.01)
+        self.assertEqual(listener.drain(), ['ALARM: Hard limit\n', 'ok\n'])
+        self.assertEqual(listener.drain(), [])
+        listener.stop()
+        port.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
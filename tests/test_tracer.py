@@ -0,0 +1,78 @@
+import unittest
+import mock
+
+import os
+import csv
+import json
+import logging
+import tempfile
+
+import tracer
+import bernielib as bl
+
+
+from mock import patch
+
+class tracer_test_case(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = tracer.commandTracer()
+        self.tracer.record('cartesian', 'G0 X10 F3000', 1.0, 1.001, 14, 3)
+        self.tracer.record('cartesian', 'M400', 1.001, 1.5, 5, 3)
+        self.tracer.record('cartesian', 'M400', 2.0, 2.5, 5, 3)
+        self.tracer.record('loadcell', 'RR', 3.0, 3.1, 2, 7)
+        self.tracer.record('loadcell', 'T', 4.0, 9.0, 1, 0, acknowledged=False)
+
+    def test_getOpcode(self):
+        self.assertEqual(tracer.getOpcode(' g0 X1 Y2'), 'G0')
+        self.assertEqual(tracer.getOpcode('?'), '?')
+        self.assertEqual(tracer.getOpcode(''), '')
+
+    def test_summary(self):
+        summary = self.tracer.summary()
+        m400 = summary['cartesian']['M400']
+        self.assertEqual(m400['count'], 2)
+        self.assertAlmostEqual(m400['total'], 0.999)
+        self.assertEqual(m400['histogram']['<=0.5'], 2)
+        self.assertEqual(summary['loadcell']['T']['timeouts'], 1)
+        self.assertEqual(summary['loadcell']['T']['histogram']['<=5'], 1)
+        self.assertAlmostEqual(self.tracer.totalTime(port='loadcell'), 5.1)
+
+    def test_dump(self):
+        folder = tempfile.mkdtemp()
+        json_path = os.path.join(folder, 'trace.json')
+        csv_path = os.path.join(folder, 'trace.csv')
+        self.tracer.dump(json_path)
+        self.tracer.dump(csv_path)
+        with open(json_path) as f:
+            self.assertEqual(json.load(f)['summary']['loadcell']['RR']['count'], 1)
+        with open(csv_path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[1]['opcode'], 'M400')
+
+    @patch('time.sleep')
+    @patch('serial.Serial')
+    def test_robot_traces_commands(self, mock_serial, mock_sleep):
+        logging.disable(logging.CRITICAL)
+        # Separate port objects, so the robot can tell them apart
+        mock_serial.side_effect = lambda *args, **kwargs: mock.MagicMock()
+        ber = bl.robot(cartesian_port_name='COM18', loadcell_port_name='COM7')
+        ber.loadcell_eol = ''
+        t = ber.startTracing()
+        with patch.object(ber, '_readUntilMatch', return_value='ok\n'):
+            ber.writeAndWaitCartesian('G0 X10 F3000')
+        with patch.object(ber, '_readUntilMatch', return_value=None):
+            ber.writeAndWaitLoadCell('RR')
+        self.assertIs(ber.stopTracing(), t)
+        with patch.object(ber, '_readUntilMatch', return_value='ok\n'):
+            ber.writeAndWaitCartesian('M400')
+        ber.close()
+        logging.disable(logging.NOTSET)
+        self.assertEqual([(r['port'], r['opcode'], r['bytes_sent'], r['bytes_received'], r['acknowledged'])
+                          for r in t.records],
+                         [('cartesian', 'G0', 13, 3, True), ('loadcell', 'RR', 2, 0, False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
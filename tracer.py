@@ -0,0 +1,162 @@
+import csv
+import json
+import bisect
+import threading
+
+
+"""
+Timing of the commands sent to the robot controllers.
+
+    tracer = ber.startTracing()
+    ...
+    ber.stopTracing()
+    tracer.dumpJSON('trace.json')
+
+Part of BernieLib.
+"""
+
+
+# Upper edges of the latency histogram bins, seconds
+HISTOGRAM_BINS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60)
+
+CSV_FIELDS = ['port', 'opcode', 'command', 'send_time', 'ack_time', 'latency',
+              'bytes_sent', 'bytes_received', 'acknowledged']
+
+
+def getOpcode(expression):
+    """
+    Returns the command name without its parameters, like 'G0' for 'G0 X10 F3000'.
+    """
+    words = expression.strip().split()
+    if not words:
+        return ''
+    return words[0].upper()
+
+
+def histogramLabels():
+    labels = ['<=%s' % edge for edge in HISTOGRAM_BINS]
+    labels.append('>%s' % HISTOGRAM_BINS[-1])
+    return labels
+
+
+class commandTracer():
+    """
+    Records every command with its timing, and summarizes the latencies per port and opcode.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+
+    def record(self, port, expression, send_time, ack_time, bytes_sent, bytes_received,
+               acknowledged=True):
+        """
+        Inputs
+            port
+                Name of the port, like 'cartesian' or 'loadcell'.
+            expression
+                Command sent.
+            send_time, ack_time
+                time.time() when the command was sent, and when its reply was received.
+            bytes_sent, bytes_received
+                Sizes of the command and the reply.
+            acknowledged
+                False if the reply did not come before the timeout.
+        """
+        entry = {
+            'port': port,
+            'opcode': getOpcode(expression),
+            'command': expression.strip(),
+            'send_time': send_time,
+            'ack_time': ack_time,
+            'latency': ack_time - send_time,
+            'bytes_sent': bytes_sent,
+            'bytes_received': bytes_received,
+            'acknowledged': acknowledged,
+        }
+        with self.lock:
+            self.records.append(entry)
+
+
+    def clear(self):
+        with self.lock:
+            self.records = []
+
+
+    def summary(self):
+        """
+        Returns {port: {opcode: statistics}}, where statistics is a dictionary with count,
+        total, mean, min and max latency (seconds), bytes and the latency histogram.
+        """
+        labels = histogramLabels()
+        result = {}
+        with self.lock:
+            records = list(self.records)
+        for entry in records:
+            opcodes = result.setdefault(entry['port'], {})
+            try:
+                stats = opcodes[entry['opcode']]
+            except KeyError:
+                stats = {'count': 0, 'total': 0.0, 'min': entry['latency'], 'max': entry['latency'],
+                         'bytes_sent': 0, 'bytes_received': 0, 'timeouts': 0,
+                         'histogram': {label: 0 for label in labels}}
+                opcodes[entry['opcode']] = stats
+            latency = entry['latency']
+            stats['count'] += 1
+            stats['total'] += latency
+            stats['min'] = min(stats['min'], latency)
+            stats['max'] = max(stats['max'], latency)
+            stats['bytes_sent'] += entry['bytes_sent']
+            stats['bytes_received'] += entry['bytes_received']
+            if not entry['acknowledged']:
+                stats['timeouts'] += 1
+            stats['histogram'][labels[bisect.bisect_left(HISTOGRAM_BINS, latency)]] += 1
+        for opcodes in result.values():
+            for stats in opcodes.values():
+                stats['mean'] = stats['total'] / stats['count']
+        return result
+
+
+    def totalTime(self, port=None, opcode=None):
+        """
+        Returns the time spent waiting for the replies, optionally for one port and/or opcode.
+        """
+        with self.lock:
+            return sum(entry['latency'] for entry in self.records
+                       if (port is None or entry['port'] == port)
+                       and (opcode is None or entry['opcode'] == opcode))
+
+
+    def dumpJSON(self, path, include_records=False):
+        """
+        Saves the summary (and optionally every record) to a JSON file.
+        """
+        output = {'summary': self.summary()}
+        if include_records:
+            with self.lock:
+                output['records'] = list(self.records)
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+    def dumpCSV(self, path):
+        """
+        Saves every record as a row of a CSV file.
+        """
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+
+
+    def dump(self, path):
+        """
+        Saves to CSV if the path ends with .csv, and to JSON otherwise.
+        """
+        if path.lower().endswith('.csv'):
+            self.dumpCSV(path)
+        else:
+            self.dumpJSON(path)